@@ -8,20 +8,4981 @@
 
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
+import tkinter.font as tkfont
 import requests
 import json
 import threading
 import os
+import re
+import socket
 import time
 from datetime import datetime
 import queue
+import gzip
+import shutil
+import sqlite3
+import uuid
+import hashlib
+import zlib
+import bisect
+import math
+import sys
+import io
+import csv
+import unicodedata
+import difflib
+import argparse
+import tempfile
+import html
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+import faulthandler
+import signal
+import random
+import timeit
+import statistics
+import platform
+import types
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时回退到gzip
+    zstandard = None
+
+
+# 流式请求附带的选项：要求服务端在最后一个数据块中返回usage
+STREAM_OPTIONS = {"include_usage": True}
+
+# 中日韩字符及全角标点，按DeepSeek官方估算：约0.6 token/字，其他字符约0.3 token/字
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """本地粗略估算文本的token数量（返回浮点数，由调用方取整）"""
+    if not text:
+        return 0.0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count * 0.6 + (len(text) - cjk_count) * 0.3
+
+
+def estimate_messages_tokens(messages):
+    """估算消息列表的输入token数量（每条消息额外计入少量格式开销）"""
+    total = 0.0
+    for message in messages or []:
+        total += estimate_tokens(message.get("content", "")) + 4
+    return int(round(total))
+
+
+def iter_sse_json(response, should_stop=None, timer=None):
+    """逐行解析SSE流式响应，产出每个data块解析后的JSON对象
+
+    取消时连接会被强制关闭，此时读取抛出的异常视为正常结束。
+    传入timer（RequestTimer）时记录接收字节数、数据块间隔和本地解析耗时。
+    """
+    done = False
+    try:
+        for line in response.iter_lines():
+            if should_stop and should_stop():
+                break
+
+            if timer is not None:
+                timer.add_bytes(len(line) + 1)
+            if not line or done:
+                # [DONE]之后继续读到流结束而不是break：中途关闭iter_lines会让urllib3关闭连接，无法复用
+                continue
+
+            parse_started = time.perf_counter()
+            line = line.decode('utf-8')
+            if not line.startswith('data: '):
+                continue
+
+            data_str = line[6:]
+            if data_str == '[DONE]':
+                done = True
+                continue
+
+            try:
+                data_json = json.loads(data_str)
+            except json.JSONDecodeError as e:
+                print(f"JSON解析错误: {e}")
+                continue
+            if timer is not None:
+                timer.add_parse(time.perf_counter() - parse_started)
+                timer.on_chunk()
+            yield data_json
+    except Exception:
+        if should_stop and should_stop():
+            return
+        raise
+
+
+def _response_socket(response):
+    """取得流式响应底层的socket（取不到时返回None）"""
+    raw = getattr(response, "raw", None)
+    connection = getattr(raw, "_connection", None) or getattr(raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        fp = getattr(getattr(raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    return sock
+
+
+def release_response(response, aborted=False):
+    """结束流式响应：正常读完时把连接归还连接池以便复用，中途取消或出错时直接关闭连接"""
+    raw = getattr(response, "raw", None)
+    try:
+        if not aborted and raw is not None and hasattr(raw, "drain_conn"):
+            raw.drain_conn()
+            raw.release_conn()
+        else:
+            response.close()
+    except Exception:
+        response.close()
+    # 归还密钥池中占用的密钥（保留引用，请求结束后据此计入token）
+    state = getattr(response, "key_state", None)
+    if state is not None:
+        response.key_state = None
+        response.key_used = state
+        state.pool.release(state)
+
+
+class RequestCancelled(Exception):
+    """请求在发出之前（如等待密钥池额度时）被取消"""
+
+
+class CancelToken:
+    """请求取消令牌
+
+    cancel()会立即shutdown当前登记的响应所用的socket，使工作线程中阻塞的读取
+    在毫秒级返回，而不必等到读超时；也可用wait()代替time.sleep()实现可中断的等待。
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.response = None
+        self.cancelled_at = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def attach(self, response):
+        """登记当前正在读取的响应，如果已经取消则立即中断"""
+        with self.lock:
+            self.response = response
+        if self.cancelled:
+            self._abort(response)
+
+    def detach(self, response):
+        with self.lock:
+            if self.response is response:
+                self.response = None
+
+    def cancel(self):
+        """取消：设置标志并中断正在进行的读取"""
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.cancelled_at = time.time()
+            self.event.set()
+            response = self.response
+        if response is not None:
+            self._abort(response)
+
+    def wait(self, seconds):
+        """可被取消打断的等待，返回是否已取消"""
+        return self.event.wait(seconds)
+
+    def stop_latency(self):
+        """从请求取消到调用此方法的耗时（秒），未取消时返回None"""
+        if self.cancelled_at is None:
+            return None
+        return time.time() - self.cancelled_at
+
+    @staticmethod
+    def _abort(response):
+        # shutdown能唤醒其他线程中阻塞的recv，close由读取线程在收尾时完成
+        sock = _response_socket(response)
+        if sock is None and hasattr(response, "abort"):
+            # 回放的响应没有socket
+            response.abort()
+        elif sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class StreamTokenMeter:
+    """流式Token计量器
+
+    在usage未到达前按接收到的内容实时估算token并计算生成速度，
+    真实usage到达后以其为准，并通过take_delta()给出需要补差的增量。
+    """
+
+    def __init__(self, messages=None, refresh_interval=0.25):
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.last_token_time = None
+        self.refresh_interval = refresh_interval
+        self.prompt_estimate = estimate_messages_tokens(messages)
+        self.completion_estimate = 0.0
+        self.chunk_count = 0
+        self.usage = None
+
+        # 深度思考（reasoning_content）计时与计量
+        self.first_answer_time = None
+        self.reasoning_start_time = None
+        self.reasoning_end_time = None
+        self.reasoning_estimate = 0.0
+
+        # 已经计入统计的数量，用于计算增量
+        self.reported_prompt = 0
+        self.reported_completion = 0
+        self._last_refresh = 0.0
+
+    def _mark_token(self, text):
+        now = time.time()
+        if self.first_token_time is None:
+            self.first_token_time = now
+        self.last_token_time = now
+        self.chunk_count += 1
+        tokens = estimate_tokens(text)
+        self.completion_estimate += tokens
+        return now, tokens
+
+    def feed(self, text):
+        """记录一个正文内容块"""
+        if not text:
+            return
+        now, _ = self._mark_token(text)
+        if self.first_answer_time is None:
+            self.first_answer_time = now
+            if self.reasoning_start_time is not None:
+                self.reasoning_end_time = now
+
+    def feed_reasoning(self, text):
+        """记录一个思考过程（reasoning_content）内容块，思考token同样计入输出"""
+        if not text:
+            return
+        now, tokens = self._mark_token(text)
+        if self.reasoning_start_time is None:
+            self.reasoning_start_time = now
+        self.reasoning_estimate += tokens
+
+    @property
+    def is_reasoning(self):
+        """是否处于思考阶段（已收到思考内容但尚未收到正文）"""
+        return self.reasoning_start_time is not None and self.first_answer_time is None
+
+    @property
+    def reasoning_tokens(self):
+        if self.usage is not None:
+            details = self.usage.get("completion_tokens_details") or {}
+            if "reasoning_tokens" in details:
+                return details["reasoning_tokens"]
+        return int(round(self.reasoning_estimate))
+
+    def reasoning_seconds(self):
+        """思考阶段耗时"""
+        if self.reasoning_start_time is None:
+            return 0.0
+        end = self.reasoning_end_time or self.last_token_time or time.time()
+        return end - self.reasoning_start_time
+
+    def time_to_first_answer(self):
+        """从发出请求到首个正文token的耗时，尚未收到正文时返回None"""
+        if self.first_answer_time is None:
+            return None
+        return self.first_answer_time - self.start_time
+
+    def set_usage(self, usage):
+        """记录服务端返回的真实usage"""
+        if usage:
+            self.usage = usage
+
+    @property
+    def is_estimated(self):
+        """当前数值是否仍为本地估算"""
+        return self.usage is None
+
+    @property
+    def prompt_tokens(self):
+        if self.usage is not None:
+            return self.usage.get("prompt_tokens", 0)
+        return self.prompt_estimate
+
+    @property
+    def completion_tokens(self):
+        if self.usage is not None:
+            return self.usage.get("completion_tokens", 0)
+        return int(round(self.completion_estimate))
+
+    def tokens_per_second(self):
+        """生成速度（从首个token开始计算）"""
+        if self.first_token_time is None:
+            return 0.0
+        elapsed = (self.last_token_time or time.time()) - self.first_token_time
+        if elapsed <= 0:
+            return 0.0
+        return self.completion_tokens / elapsed
+
+    def should_refresh(self):
+        """节流：距上次刷新超过refresh_interval才返回True"""
+        now = time.time()
+        if now - self._last_refresh >= self.refresh_interval:
+            self._last_refresh = now
+            return True
+        return False
+
+    def take_delta(self):
+        """返回自上次调用以来需要计入统计的(输入, 输出)token增量，usage到达后自动校正估算误差"""
+        prompt_delta = self.prompt_tokens - self.reported_prompt
+        completion_delta = self.completion_tokens - self.reported_completion
+        self.reported_prompt += prompt_delta
+        self.reported_completion += completion_delta
+        return prompt_delta, completion_delta
+
+    def status_text(self):
+        """流式过程中的状态文本"""
+        prefix = "≈" if self.is_estimated else ""
+        if self.is_reasoning:
+            return (f"思考中... {self.reasoning_seconds():.1f}s, {prefix}{self.reasoning_tokens} tokens, "
+                    f"{self.tokens_per_second():.1f} tokens/s")
+        return f"生成中... {prefix}{self.completion_tokens} tokens, {self.tokens_per_second():.1f} tokens/s"
+
+    def summary(self):
+        """用于写入日志的统计摘要"""
+        return {
+            "estimated": self.is_estimated,
+            "prompt_tokens_estimate": self.prompt_estimate,
+            "completion_tokens_estimate": int(round(self.completion_estimate)),
+            "chunk_count": self.chunk_count,
+            "duration": round(time.time() - self.start_time, 3),
+            "tokens_per_second": round(self.tokens_per_second(), 2)
+        }
+
+    def reasoning_summary(self):
+        """本轮的思考统计：思考耗时、首个正文token耗时、思考token数"""
+        ttfa = self.time_to_first_answer()
+        return {
+            "reasoning_seconds": round(self.reasoning_seconds(), 3),
+            "time_to_first_answer": round(ttfa, 3) if ttfa is not None else None,
+            "reasoning_tokens": self.reasoning_tokens
+        }
+
+
+class CollapsibleReasoningView:
+    """在Text控件中渲染可折叠的思考过程区域
+
+    思考内容使用独立的tag渲染，每段思考有一个可点击的标题行用于展开/折叠，
+    正文开始输出时自动折叠。
+    """
+
+    def __init__(self, text_widget):
+        self.text = text_widget
+        self.block_count = 0
+        self.current_tag = None
+        self.collapsed = {}
+
+        self.text.tag_configure("reasoning", foreground="#7f8c8d", font=("微软雅黑", 9),
+                                lmargin1=20, lmargin2=20)
+        self.text.tag_configure("reasoning_header", foreground="#2980b9", font=("微软雅黑", 9, "bold"))
+
+    def append(self, content):
+        """追加思考内容，必要时先创建新的思考区域"""
+        self.text.config(state='normal')
+        if self.current_tag is None:
+            self.block_count += 1
+            self.current_tag = f"reasoning_block_{self.block_count}"
+            header_tag = f"{self.current_tag}_header"
+            self.collapsed[self.current_tag] = False
+            self.text.insert(tk.END, "💭 思考过程（点击展开/折叠）\n", ("reasoning_header", header_tag))
+            self.text.tag_bind(header_tag, "<Button-1>",
+                               lambda e, tag=self.current_tag: self.toggle(tag))
+            self.text.tag_bind(header_tag, "<Enter>", lambda e: self.text.config(cursor="hand2"))
+            self.text.tag_bind(header_tag, "<Leave>", lambda e: self.text.config(cursor=""))
+        self.text.insert(tk.END, content, ("reasoning", self.current_tag))
+        self.text.see(tk.END)
+        self.text.config(state='disabled')
+
+    def close(self, summary=None):
+        """结束当前思考区域并折叠"""
+        if self.current_tag is None:
+            return
+        tag = self.current_tag
+        self.current_tag = None
+
+        self.text.config(state='normal')
+        footer = "\n"
+        if summary:
+            footer += (f"（思考 {summary['reasoning_seconds']:.1f}s, "
+                       f"{summary['reasoning_tokens']} tokens）\n")
+        self.text.insert(tk.END, footer, ("reasoning", tag))
+        self.text.config(state='disabled')
+        self.set_collapsed(tag, True)
+
+    def toggle(self, tag):
+        """切换指定思考区域的折叠状态"""
+        self.set_collapsed(tag, not self.collapsed.get(tag, False))
+
+    def set_collapsed(self, tag, collapsed):
+        self.collapsed[tag] = collapsed
+        self.text.tag_configure(tag, elide=collapsed)
+
+    def reset(self):
+        """清空文本后重置状态"""
+        self.current_tag = None
+        self.collapsed = {}
+
+
+DEFAULT_CHAT_MODEL = "deepseek-chat"
+DEFAULT_REASONER_MODEL = "deepseek-reasoner"
+
+
+def resolve_model(role_config):
+    """角色使用的模型：优先角色配置的model，否则按是否深度思考选择默认模型"""
+    model = (role_config.get("model") or "").strip()
+    if model:
+        return model
+    return DEFAULT_REASONER_MODEL if role_config.get("deep_thought", False) else DEFAULT_CHAT_MODEL
+
+
+def mask_api_key(api_key):
+    """日志中使用的脱敏API Key"""
+    return "Bearer ***" + api_key[-4:] if api_key else ""
+
+
+class _TimedConnectionMixin:
+    """记录新建连接（DNS + TCP + TLS握手）的耗时；连接被复用时不会再次调用connect"""
+
+    connect_seconds = None
+    fresh = False
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        self.connect_seconds = time.perf_counter() - started
+        self.fresh = True
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """连接池中的连接会记录建连耗时，供RequestTimer读取"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+def connection_connect_time(response):
+    """本次请求新建连接的耗时（秒）；复用连接池中的连接时返回0，取不到时返回None"""
+    raw = getattr(response, "raw", None)
+    connection = getattr(raw, "_connection", None) or getattr(raw, "connection", None)
+    if connection is None or not hasattr(connection, "fresh"):
+        return None
+    if connection.fresh:
+        connection.fresh = False
+        return connection.connect_seconds
+    return 0.0
+
+
+# 每个标签页在内存中保留的最近请求计时数量
+REQUEST_TIMING_HISTORY = 50
+# 入队到显示超过此秒数的正文数据块计为迟到
+LATE_RENDER_SECONDS = 0.5
+
+
+class RequestTimer:
+    """单次请求的分阶段计时（秒，基于perf_counter）
+
+    - connect：新建连接耗时，复用连接时为0
+    - headers：从发出请求到收到响应头
+    - first_token：从发出请求到第一个正文/思考token
+    - total：从发出请求到响应读取结束
+    - chunks / bytes：SSE数据块数和接收的字节数
+    - parse：本地解析SSE行和JSON的累计耗时
+    - gaps：相邻数据块间隔的直方图
+    - render_delay：正文入队到界面显示的平均/最大延迟（由界面线程记录）
+    - rendered / render_late：已显示的正文数据块数，以及其中延迟超过LATE_RENDER_SECONDS的块数
+    """
+
+    GAP_BOUNDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.connect = None
+        self.headers = None
+        self.first_token = None
+        self.total = None
+        self.chunks = 0
+        self.bytes = 0
+        self.parse = 0.0
+        self.last_chunk_at = None
+        self.gap_counts = [0] * (len(self.GAP_BOUNDS) + 1)
+        self.max_gap = 0.0
+        self.render_count = 0
+        self.render_total = 0.0
+        self.render_max = 0.0
+        self.render_late = 0
+        self.api_key = None  # 使用密钥池时实际使用的密钥（脱敏）
+
+    def mark_headers(self, response):
+        self.headers = time.perf_counter() - self.started
+        self.connect = connection_connect_time(response)
+        state = getattr(response, "key_state", None)
+        if state is not None:
+            self.api_key = state.masked
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+    def add_parse(self, seconds):
+        self.parse += seconds
+
+    def on_chunk(self):
+        now = time.perf_counter()
+        if self.last_chunk_at is not None:
+            gap = now - self.last_chunk_at
+            self.gap_counts[bisect.bisect_left(self.GAP_BOUNDS, gap)] += 1
+            if gap > self.max_gap:
+                self.max_gap = gap
+        self.last_chunk_at = now
+        self.chunks += 1
+
+    def mark_first_token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def timed_text(self, text):
+        """包装要显示的正文，界面线程显示时据此计算入队到显示的延迟"""
+        return ("text", (text, self, time.perf_counter()))
+
+    def on_render(self, enqueued_at):
+        delay = time.perf_counter() - enqueued_at
+        self.render_count += 1
+        self.render_total += delay
+        if delay > self.render_max:
+            self.render_max = delay
+        if delay > LATE_RENDER_SECONDS:
+            self.render_late += 1
+
+    def summary(self):
+        """写入日志的计时（保留旧日志的first_token/total字段）"""
+        def rounded(value):
+            return round(value, 4) if value is not None else None
+
+        return {
+            "first_token": rounded(self.first_token),
+            "total": rounded(self.total),
+            "connect": rounded(self.connect),
+            "headers": rounded(self.headers),
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "parse": rounded(self.parse),
+            "gaps": {"bounds": list(self.GAP_BOUNDS), "counts": list(self.gap_counts),
+                     "max": rounded(self.max_gap)},
+            "render_delay_avg": rounded(self.render_total / self.render_count) if self.render_count else None,
+            "render_delay_max": rounded(self.render_max) if self.render_count else None,
+            "rendered": self.render_count,
+            "render_late": self.render_late,
+            **({"api_key": self.api_key} if self.api_key else {}),
+        }
+
+
+# 密钥池：窗口内429/5xx/网络错误达到次数时暂停该密钥，暂停到期后先放行一个探测请求，探测失败时暂停时间加倍
+KEY_ERROR_WINDOW = 30.0
+KEY_ERROR_BURST = 3
+KEY_BENCH_SECONDS = 30.0
+KEY_BENCH_MAX_SECONDS = 600.0
+KEY_AUTH_BENCH_SECONDS = 600.0  # 401/403：密钥无效或被停用，暂停更久
+KEY_PROBE_POLL_SECONDS = 0.2  # 没有可用密钥且只等探测结果时的轮询间隔
+
+
+class ApiKeyState:
+    """密钥池中的一个API Key：权重、每分钟请求数/token数限制、进行中的请求数、计数和暂停状态"""
+
+    def __init__(self, pool, api_key, weight=1.0, rpm=0, tpm=0):
+        self.pool = pool
+        self.api_key = api_key
+        self.masked = mask_api_key(api_key)
+        self.weight = max(0.01, float(weight or 1))
+        self.rpm = int(rpm or 0)
+        self.tpm = int(tpm or 0)
+        self.rpm_limiter = RateLimiter(self.rpm)
+        self.tpm_limiter = RateLimiter(self.tpm)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.last_error = ""
+        self.error_times = deque()
+        self.recent = deque()  # 最近一分钟的(时间, 请求数, token数)，用于显示吞吐
+        self.benched_until = 0.0
+        self.bench_seconds = KEY_BENCH_SECONDS
+        self.probing = False
+
+    def load(self, tokens=0):
+        """选择密钥时的排序键：额度已用尽的排在后面，其次按权重折算的进行中请求数"""
+        exhausted = ((self.rpm and self.rpm_limiter.available() < 1)
+                     or (self.tpm and self.tpm_limiter.available() < tokens))
+        return bool(exhausted), (self.in_flight + 1) / self.weight, self.requests / self.weight
+
+
+class ApiKeyPool:
+    """一条路由的多个API Key：按最少负载选择，超过RPM/TPM时等待，连续出错时暂停并在到期后探测恢复"""
+
+    def __init__(self, keys):
+        self.keys = [ApiKeyState(self, **key) for key in keys]
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0, cancel_token=None):
+        """选择一个密钥并占用（等待其RPM/TPM额度），tokens为本次请求估算的输入token
+
+        全部密钥都在暂停（或暂停到期、正在等探测结果）时等到最早恢复的时间，同一密钥只放行一个探测请求。
+        等待时被取消则归还密钥（及已取得的RPM额度）并抛出RequestCancelled。
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                candidates = [key for key in self.keys
+                              if key.benched_until <= now and not (key.probing and key.in_flight)]
+                if candidates:
+                    state = min(candidates, key=lambda key: key.load(tokens))
+                    if state.benched_until:
+                        state.probing = True
+                    state.in_flight += 1
+                    break
+                resume_at = [key.benched_until for key in self.keys if key.benched_until > now]
+                wait = min(resume_at) - now if resume_at else KEY_PROBE_POLL_SECONDS
+            if cancel_token is not None:
+                if cancel_token.wait(wait):
+                    raise RequestCancelled("等待API Key恢复时已停止")
+            else:
+                time.sleep(wait)
+
+        if state.rpm_limiter.acquire(1, cancel_token):
+            if state.tpm_limiter.acquire(tokens, cancel_token):
+                return state
+            state.rpm_limiter.refund(1)
+        self.release(state)
+        raise RequestCancelled("等待API Key额度时已停止")
+
+    def release(self, state):
+        with self.lock:
+            state.in_flight -= 1
+
+    def on_response(self, state, status_code):
+        """收到响应头：成功时结束探测，401/403立即暂停，429/5xx按窗口内次数暂停"""
+        with self.lock:
+            state.requests += 1
+            now = time.monotonic()
+            state.recent.append((now, 1, 0))
+            if status_code == 200:
+                if state.probing:
+                    state.probing = False
+                    state.benched_until = 0.0
+                    state.bench_seconds = KEY_BENCH_SECONDS
+                    state.error_times.clear()
+                return
+            state.errors += 1
+            state.last_error = str(status_code)
+            if status_code in (401, 403):
+                self._bench(state, KEY_AUTH_BENCH_SECONDS, f"HTTP {status_code}")
+            elif status_code == 429 or status_code >= 500:
+                self._on_failure(state, now, f"HTTP {status_code}")
+
+    def on_error(self, state, error):
+        """请求未得到响应（连接失败、超时等）"""
+        with self.lock:
+            state.requests += 1
+            state.errors += 1
+            state.last_error = type(error).__name__
+            self._on_failure(state, time.monotonic(), state.last_error)
+
+    def _on_failure(self, state, now, reason):
+        state.error_times.append(now)
+        while state.error_times and now - state.error_times[0] > KEY_ERROR_WINDOW:
+            state.error_times.popleft()
+        if state.probing:
+            self._bench(state, min(KEY_BENCH_MAX_SECONDS, state.bench_seconds * 2), reason)
+        elif len(state.error_times) >= KEY_ERROR_BURST:
+            self._bench(state, state.bench_seconds, reason)
+
+    def _bench(self, state, seconds, reason):
+        """暂停密钥（需持有锁）"""
+        state.bench_seconds = seconds
+        state.benched_until = time.monotonic() + seconds
+        state.probing = False
+        state.error_times.clear()
+        print(f"API Key {state.masked} 暂停 {seconds:.0f} 秒: {reason}")
+
+    def record_usage(self, state, prompt_tokens, completion_tokens):
+        """请求结束后计入token（输入token已在选择时按估算预扣，这里补扣输出token）"""
+        state.tpm_limiter.consume(completion_tokens)
+        with self.lock:
+            state.prompt_tokens += prompt_tokens
+            state.completion_tokens += completion_tokens
+            state.recent.append((time.monotonic(), 0, prompt_tokens + completion_tokens))
+
+    def snapshot(self):
+        """各密钥的状态和计数（界面显示用，只含脱敏的Key）"""
+        rows = []
+        with self.lock:
+            now = time.monotonic()
+            for state in self.keys:
+                while state.recent and now - state.recent[0][0] > 60:
+                    state.recent.popleft()
+                if state.benched_until > now:
+                    status = f"暂停 {state.benched_until - now:.0f}秒"
+                elif state.probing:
+                    status = "探测中"
+                else:
+                    status = "正常"
+                rows.append({
+                    "api_key": state.api_key, "masked": state.masked, "weight": state.weight,
+                    "rpm": state.rpm, "tpm": state.tpm, "status": status, "in_flight": state.in_flight,
+                    "requests_per_minute": sum(requests for _, requests, _ in state.recent),
+                    "tokens_per_minute": sum(tokens for _, _, tokens in state.recent),
+                    "requests": state.requests, "errors": state.errors,
+                    "prompt_tokens": state.prompt_tokens, "completion_tokens": state.completion_tokens,
+                    "last_error": state.last_error})
+        return rows
+
+
+class ApiRoute:
+    """一条API路由：端点 + API Key，拥有独立的连接池、并发限制和延迟统计"""
+
+    transport = None  # 整个进程的请求改经磁带录制器/回放器（CassetteRecorder/CassettePlayer）发送
+
+    def __init__(self, name, base_url, api_key, max_connections=10, max_concurrency=8, api_keys=None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        # 多个密钥（或设置了RPM/TPM限制）时每个请求从密钥池中选择密钥
+        self.key_pool = ApiKeyPool(api_keys) if api_keys else None
+
+        # 独立的连接池，复用同一端点的TCP/TLS连接
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.first_token_latencies = deque(maxlen=50)
+        self.total_latencies = deque(maxlen=50)
+        self.request_count = 0
+
+    def headers(self, api_key=None):
+        headers = {"Content-Type": "application/json"}
+        api_key = api_key or self.api_key
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+
+    def masked_key(self):
+        """日志中的脱敏API Key（使用密钥池时实际使用的密钥记录在计时的api_key中）"""
+        if self.key_pool is not None:
+            return f"密钥池({len(self.key_pool.keys)}个)"
+        return mask_api_key(self.api_key)
+
+    @contextmanager
+    def slot(self):
+        """占用一个并发槽位（流式请求需在整个读取过程中持有）"""
+        self.semaphore.acquire()
+        try:
+            yield self
+        finally:
+            self.semaphore.release()
+
+    def acquire_key(self, data, cancel_token=None):
+        """使用密钥池时选择并占用密钥，否则返回None
+
+        应在占用并发槽位之前调用：等待RPM/TPM额度时不占用槽位，且可被cancel_token打断（抛出RequestCancelled）。
+        """
+        if self.key_pool is None:
+            return None
+        return self.key_pool.acquire(estimate_messages_tokens(data.get("messages")), cancel_token)
+
+    def post(self, data, timeout, stream=False, key_state=None):
+        """发送请求：设置了磁带录制/回放（ApiRoute.transport）时经由它发送
+
+        使用密钥池时使用acquire_key取得的key_state（未传入时在此选择），
+        响应记录所用的密钥（key_state），由release_response归还。
+        """
+        if self.key_pool is None:
+            return self._post(data, timeout, stream, None)
+        state = key_state or self.acquire_key(data)
+        try:
+            response = self._post(data, timeout, stream, state.api_key)
+        except Exception as e:
+            self.key_pool.on_error(state, e)
+            self.key_pool.release(state)
+            raise
+        self.key_pool.on_response(state, response.status_code)
+        response.key_state = state
+        return response
+
+    def _post(self, data, timeout, stream, api_key):
+        if ApiRoute.transport is not None:
+            return ApiRoute.transport.post(self, data, timeout, stream, api_key=api_key)
+        return self.send(data, timeout, stream, api_key)
+
+    def send(self, data, timeout, stream=False, api_key=None):
+        """通过本路由的连接池发送请求"""
+        return self.session.post(self.base_url, headers=self.headers(api_key), json=data,
+                                 timeout=timeout, stream=stream)
+
+    @contextmanager
+    def open_stream(self, data, timeout, cancel_token=None, key_state=None):
+        """发送流式请求：先取得密钥（未传入key_state时），再占用并发槽位并登记取消令牌，结束时回收或关闭连接"""
+        if key_state is None:
+            key_state = self.acquire_key(data, cancel_token)
+        with self.slot():
+            response = self.post(data, timeout=timeout, stream=True, key_state=key_state)
+            if cancel_token is not None:
+                cancel_token.attach(response)
+            aborted = False
+            try:
+                yield response
+            except BaseException:
+                aborted = True
+                raise
+            finally:
+                if cancel_token is not None:
+                    cancel_token.detach(response)
+                    aborted = aborted or cancel_token.cancelled
+                release_response(response, aborted)
+
+    def record_latency(self, first_token, total):
+        """记录一次请求的首token延迟和总耗时（秒）"""
+        with self.lock:
+            self.request_count += 1
+            if first_token is not None:
+                self.first_token_latencies.append(first_token)
+            self.total_latencies.append(total)
+
+    def record_usage(self, response, prompt_tokens, completion_tokens):
+        """请求结束后把token计入所用的密钥（用于TPM限制和密钥池统计）"""
+        state = getattr(response, "key_used", None)
+        if state is not None:
+            state.pool.record_usage(state, prompt_tokens, completion_tokens)
+
+    def latency_text(self):
+        """最近请求的平均延迟文本"""
+        with self.lock:
+            if not self.total_latencies:
+                return f"{self.name}: 暂无"
+            avg_total = sum(self.total_latencies) / len(self.total_latencies)
+            if self.first_token_latencies:
+                avg_first = sum(self.first_token_latencies) / len(self.first_token_latencies)
+                return f"{self.name}: 首token {avg_first:.2f}s / 总 {avg_total:.1f}s"
+            return f"{self.name}: 总 {avg_total:.1f}s"
+
+
+class ApiRouter:
+    """按角色配置选择API路由
+
+    角色可配置 model、base_url 和 api_profile；api_profile 引用 api_profiles.json 中的接口配置：
+    {"名称": {"base_url": "...", "api_key": "...", "api_key_env": "环境变量名",
+              "max_connections": 10, "max_concurrency": 8,
+              "api_keys": [{"api_key": "...", "api_key_env": "...", "weight": 1, "rpm": 0, "tpm": 0}]}}
+    未配置的部分回退到全局 Base URL 和 API Key。api_keys 为附加的密钥（密钥池），
+    名为"默认"的接口配置中的 api_keys 与全局 API Key 一起组成默认路由的密钥池。
+    """
+
+    DEFAULT_PROFILE = "默认"
+
+    def __init__(self, profile_file="api_profiles.json"):
+        self.profile_file = profile_file
+        self.profiles = {}
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.load_profiles()
+
+    def load_profiles(self):
+        """从文件加载接口配置"""
+        if os.path.exists(self.profile_file):
+            try:
+                with open(self.profile_file, 'r', encoding='utf-8') as f:
+                    self.profiles = json.load(f)
+            except Exception as e:
+                print(f"加载接口配置失败: {e}")
+                self.profiles = {}
+
+    def save_profiles(self):
+        """保存接口配置到文件（临时文件+重命名，写入中断不会丢失已保存的密钥），并让后续请求按新配置重建路由"""
+        atomic_write_text(self.profile_file, json.dumps(self.profiles, ensure_ascii=False, indent=2))
+        with self.lock:
+            self.routes = {}
+
+    def profile_names(self):
+        return list(self.profiles.keys())
+
+    def resolve(self, role_config, default_base_url, default_api_key):
+        """返回角色对应的ApiRoute"""
+        profile_name = (role_config.get("api_profile") or "").strip()
+        profile = self.profiles.get(profile_name, {}) if profile_name else {}
+
+        base_url = ((role_config.get("base_url") or "").strip()
+                    or profile.get("base_url") or default_base_url)
+        if profile:
+            api_key = profile.get("api_key") or os.environ.get(profile.get("api_key_env") or "", "")
+        else:
+            api_key = default_api_key
+
+        route_name = profile_name or self.DEFAULT_PROFILE
+        host = urlparse(base_url).netloc or base_url
+        if role_config.get("base_url") or not profile_name:
+            route_name = f"{route_name}@{host}"
+
+        key = (route_name, base_url, api_key)
+        with self.lock:
+            route = self.routes.get(key)
+            if route is None:
+                pool_profile = profile or self.profiles.get(self.DEFAULT_PROFILE, {})
+                route = ApiRoute(route_name, base_url, api_key,
+                                 max_connections=int(profile.get("max_connections", 10)),
+                                 max_concurrency=int(profile.get("max_concurrency", 8)),
+                                 api_keys=self.pool_keys(api_key, pool_profile))
+                self.routes[key] = route
+            return route
+
+    @staticmethod
+    def pool_keys(api_key, profile):
+        """路由的密钥池：主密钥（权重1、不限速）+ 接口配置中的api_keys；只有主密钥时返回None"""
+        keys = [{"api_key": api_key}] if api_key else []
+        for entry in profile.get("api_keys") or []:
+            key = entry.get("api_key") or os.environ.get(entry.get("api_key_env") or "", "")
+            if key and key not in [existing["api_key"] for existing in keys]:
+                keys.append({"api_key": key, "weight": entry.get("weight", 1), "rpm": entry.get("rpm", 0),
+                             "tpm": entry.get("tpm", 0)})
+        if len(keys) == (1 if api_key else 0):
+            return None
+        return keys
+
+    def key_stats(self):
+        """各路由密钥池中每个密钥的状态和计数，按密钥汇总（同一密钥可能用于多条路由）"""
+        with self.lock:
+            routes = list(self.routes.values())
+        stats = {}
+        for route in routes:
+            if route.key_pool is None:
+                continue
+            for row in route.key_pool.snapshot():
+                total = stats.get(row["api_key"])
+                if total is None:
+                    stats[row["api_key"]] = dict(row, routes=[route.name])
+                    continue
+                total["routes"].append(route.name)
+                for field in ("in_flight", "requests_per_minute", "tokens_per_minute", "requests", "errors",
+                              "prompt_tokens", "completion_tokens"):
+                    total[field] += row[field]
+                if row["status"] != "正常":
+                    total["status"] = row["status"]
+        return stats
+
+    def has_key(self, role_config, default_api_key):
+        """角色是否可以发起请求：使用全局配置时必须有API Key（或默认密钥池），自定义接口配置（如本地服务）可以不需要"""
+        profile_name = (role_config.get("api_profile") or "").strip()
+        if profile_name and profile_name in self.profiles:
+            return True
+        return bool(default_api_key or self.pool_keys("", self.profiles.get(self.DEFAULT_PROFILE, {})))
+
+
+class ReplayResponse:
+    """回放的响应，代替真实的requests响应（基准测试和磁带回放使用）
+
+    lines为流式响应的各行（不含换行），delays为读取每行之前等待的秒数（为None时不等待）；
+    body为非流式响应或错误响应的正文。abort()使正在等待的读取立即结束（取消请求时调用）。
+    """
+
+    def __init__(self, lines=(), status_code=200, delays=None, body=None, body_delay=0.0):
+        self.lines = lines
+        self.status_code = status_code
+        self.delays = delays
+        self.body = body
+        self.body_delay = body_delay
+        self.aborted = threading.Event()
+
+    @property
+    def content(self):
+        if self.body is None:
+            return b"\n".join(self.lines)
+        if self.body_delay > 0:
+            self.aborted.wait(self.body_delay)
+        return self.body
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_lines(self):
+        if self.delays is None:
+            return iter(self.lines)
+        return self._timed_lines()
+
+    def _timed_lines(self):
+        for delay, line in zip(self.delays, self.lines):
+            if delay > 0 and self.aborted.wait(delay):
+                return
+            if self.aborted.is_set():
+                return
+            yield line
+
+    def abort(self):
+        self.aborted.set()
+
+    def close(self):
+        pass
+
+
+def cassette_key(data):
+    """录制的匹配键：模型、消息和是否流式都相同的请求回放同一段录制"""
+    payload = json.dumps({"model": data.get("model"), "messages": data.get("messages"),
+                          "stream": bool(data.get("stream"))}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class RecordingResponse:
+    """包装真实响应：记录读到的每一行（不含换行）及其与上一行的间隔，
+    读完、中途停止或取得正文时交给录制器保存；其余属性（raw等）转给真实响应，连接复用和取消不受影响"""
+
+    def __init__(self, response, recorder, data, headers_delay):
+        self.response = response
+        self.recorder = recorder
+        self.interaction = {
+            "key": cassette_key(data),
+            "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "request": data,
+            "status_code": response.status_code,
+            "headers_delay": round(headers_delay, 4),
+        }
+        self.saved = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_lines(self):
+        lines = []
+        last = time.perf_counter()
+        complete = False
+        try:
+            for line in self.response.iter_lines():
+                now = time.perf_counter()
+                lines.append([round(now - last, 4), line.decode('utf-8', errors='replace')])
+                last = now
+                yield line
+            complete = True
+        finally:
+            # 提前结束（取消、连接中断）时生成器被关闭，同样保存已收到的部分
+            self._save(lines=lines, complete=complete)
+
+    @property
+    def content(self):
+        started = time.perf_counter()
+        body = self.response.content
+        self._save(body=body.decode('utf-8', errors='replace'), body_delay=round(time.perf_counter() - started, 4),
+                   complete=True)
+        return body
+
+    @property
+    def text(self):
+        text = self.response.text
+        self._save(body=text, complete=True)
+        return text
+
+    def _save(self, **fields):
+        if self.saved:
+            return
+        self.saved = True
+        self.interaction.update(fields)
+        self.recorder.save(self.interaction)
+
+
+class CassetteRecorder:
+    """录制模式：请求照常通过真实连接发送，响应的每一行和到达间隔追加写入磁带文件（JSONL，每个请求一行）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def post(self, route, data, timeout, stream, api_key=None):
+        started = time.perf_counter()
+        response = route.send(data, timeout, stream, api_key)
+        return RecordingResponse(response, self, data, time.perf_counter() - started)
+
+    def save(self, interaction):
+        line = json.dumps(interaction, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.recorded += 1
+
+    def summary(self):
+        return f"已录制 {self.recorded} 个请求到 {self.path}"
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class CassettePlayer:
+    """回放模式：不发出网络请求，按请求找到录制的响应，以原始间隔乘以time_scale逐行返回（0为不等待）
+
+    同一请求录制了多次时按录制顺序依次回放，用完后重复最后一次；找不到匹配的录制时
+    按顺序轮流使用同类（流式/非流式）的全部录制并计入misses，以便在请求内容不同的场景
+    （如负载测试）中回放真实流量的数据块大小和节奏。
+    """
+
+    def __init__(self, path, time_scale=1.0):
+        self.path = path
+        self.time_scale = time_scale
+        self.interactions = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    self.interactions.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    print(f"磁带第{line_number}行解析失败: {e}")
+        if not self.interactions:
+            raise ValueError(f"磁带中没有录制的请求: {path}")
+
+        self.by_key = {}
+        for interaction in self.interactions:
+            self.by_key.setdefault(interaction.get("key"), deque()).append(interaction)
+        self.by_kind = {
+            True: [interaction for interaction in self.interactions if "lines" in interaction],
+            False: [interaction for interaction in self.interactions if "lines" not in interaction],
+        }
+        self.next_index = 0
+        self.served = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def pick(self, data):
+        """为请求选择一段录制"""
+        with self.lock:
+            self.served += 1
+            recorded = self.by_key.get(cassette_key(data))
+            if recorded:
+                return recorded.popleft() if len(recorded) > 1 else recorded[0]
+            self.misses += 1
+            candidates = self.by_kind[bool(data.get("stream"))] or self.interactions
+            interaction = candidates[self.next_index % len(candidates)]
+            self.next_index += 1
+            return interaction
+
+    def post(self, route, data, timeout, stream, api_key=None):
+        interaction = self.pick(data)
+        scale = self.time_scale
+        if scale > 0:
+            time.sleep(interaction.get("headers_delay", 0) * scale)
+        body = interaction.get("body")
+        body = body.encode('utf-8') if body is not None else None
+        lines = [text.encode('utf-8') for _, text in interaction.get("lines", [])]
+        delays = [delay * scale for delay, _ in interaction.get("lines", [])] if scale > 0 else None
+        return ReplayResponse(lines, interaction.get("status_code", 200), delays, body,
+                              interaction.get("body_delay", 0) * scale)
+
+    def summary(self):
+        text = f"从 {self.path} 回放 {self.served} 个请求"
+        if self.misses:
+            text += f"，其中 {self.misses} 个没有匹配的录制（按顺序使用其他录制）"
+        return text
+
+    def close(self):
+        pass
+
+
+# API日志分段设置：单个分段的最大字节数/最长时间，分段轮转后的压缩方式（""、"gzip"或"zstd"）
+API_LOG_SEGMENT_BYTES = 16 * 1024 * 1024
+API_LOG_SEGMENT_SECONDS = 3600
+API_LOG_COMPRESSION = "gzip"
+
+
+def new_run_id(tab_id):
+    """生成运行ID：时间 + 标签页 + 随机后缀，跨重启和跨实例唯一"""
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-t{tab_id}-{uuid.uuid4().hex[:6]}"
+
+
+def open_log_segment(path):
+    """以二进制方式打开日志分段（自动识别已压缩的 .gz/.zst 分段），找不到时返回None"""
+    if os.path.exists(path):
+        return open(path, 'rb')
+    if os.path.exists(path + ".gz"):
+        return gzip.open(path + ".gz", 'rb')
+    if os.path.exists(path + ".zst") and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(open(path + ".zst", 'rb'), closefd=True)
+    return None
+
+
+class LogIndex:
+    """API日志的SQLite索引
+
+    元数据存为列（运行ID、标签页、角色、轮次、模型、状态、token、延迟等），
+    请求/响应正文不重复存储，只记录所在JSONL分段及偏移量，需要时按偏移读取。
+    写入只在日志写入线程中进行；查询方法每次使用独立连接，可在任意线程调用。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL, run_id TEXT, tab_id INTEGER, role_name TEXT, role_index INTEGER,
+            iteration INTEGER, turn INTEGER, model TEXT, route TEXT, status_code INTEGER,
+            cancelled INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER,
+            reasoning_tokens INTEGER, first_token REAL, duration REAL,
+            segment TEXT, offset INTEGER, length INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_requests_run ON requests (run_id, turn);
+        CREATE INDEX IF NOT EXISTS idx_requests_role ON requests (role_name, ts);
+        CREATE INDEX IF NOT EXISTS idx_requests_ts ON requests (ts);
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY, ts REAL, tab_id INTEGER, roles TEXT, turns INTEGER,
+            run_tokens INTEGER, end_reason TEXT, duration REAL,
+            segment TEXT, offset INTEGER, length INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs (ts);
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY, size INTEGER, body BLOB
+        );
+    """
+
+    # 超过该长度的消息正文/系统提示/回复才放入内容寻址存储
+    BLOB_MIN_SIZE = 64
+    BLOB_REF_KEY = "content@"
+
+    def __init__(self, log_dir, filename="index.sqlite3"):
+        self.log_dir = log_dir
+        self.path = os.path.join(log_dir, filename)
+        self._writer_conn = None
+
+        # 内容寻址存储：写入线程中已知的hash和待写入的新内容
+        self._known_blobs = set()
+        self._pending_blobs = {}
+
+    def _blob_ref(self, content):
+        """返回正文的引用hash，新内容加入待写入列表"""
+        data = content.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        if digest not in self._known_blobs and digest not in self._pending_blobs:
+            self._pending_blobs[digest] = (len(data), zlib.compress(data))
+        return digest
+
+    def _dedup_content(self, item):
+        """把字典中较长的content替换为内容引用（返回新字典，不修改原对象）"""
+        content = item.get("content")
+        if isinstance(content, str) and len(content) >= self.BLOB_MIN_SIZE:
+            item = dict(item)
+            item[self.BLOB_REF_KEY] = self._blob_ref(item.pop("content"))
+        return item
+
+    def dedup_record(self, record):
+        """请求消息（含系统提示）和回复正文按内容去重存储，日志记录只保留hash引用
+
+        在日志写入线程中调用；长对话中重复发送的历史消息只会存储一次。
+        """
+        if record.get("kind") != "api":
+            return record
+        record = dict(record)
+        request = record.get("request")
+        if isinstance(request, dict) and isinstance(request.get("data"), dict):
+            data = dict(request["data"])
+            if isinstance(data.get("messages"), list):
+                data["messages"] = [self._dedup_content(message) if isinstance(message, dict) else message
+                                    for message in data["messages"]]
+            record["request"] = dict(request, data=data)
+        if isinstance(record.get("response"), dict):
+            record["response"] = self._dedup_content(record["response"])
+        return record
+
+    def store_blobs(self):
+        """提交待写入的内容（在写入引用它们的日志行之前调用）
+
+        失败时丢弃待写入内容并抛出异常，调用方应改为在日志中保留完整正文；
+        只有提交成功的hash才加入已知集合，之后的记录才会直接引用。
+        """
+        if not self._pending_blobs:
+            return
+        pending, self._pending_blobs = self._pending_blobs, {}
+        conn = self._writer()
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO blobs (hash, size, body) VALUES (?, ?, ?)",
+                             [(digest, size, body) for digest, (size, body) in pending.items()])
+        # 已知hash集合只用于减少重复插入，过大时清空即可
+        if len(self._known_blobs) > 200000:
+            self._known_blobs = set()
+        self._known_blobs.update(pending)
+
+    def _connect(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _writer(self):
+        if self._writer_conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._writer_conn = conn
+        return self._writer_conn
+
+    def add(self, entries):
+        """批量写入索引，entries为[(record, segment, offset, length)]"""
+        request_rows = []
+        run_rows = []
+        for record, segment, offset, length in entries:
+            kind = record.get("kind")
+            if kind == "api":
+                response = record.get("response") or {}
+                usage = response.get("usage") or {}
+                meter = response.get("token_meter") or {}
+                timing = response.get("timing") or {}
+                reasoning = response.get("reasoning") or {}
+                request_rows.append((
+                    record.get("ts"), record.get("run_id"), record.get("tab_id"), record.get("role_name"),
+                    record.get("role_index"), record.get("iteration"), record.get("turn"),
+                    ((record.get("request") or {}).get("data") or {}).get("model"), record.get("route"),
+                    response.get("status_code"), int(bool(response.get("cancelled"))),
+                    usage.get("prompt_tokens", meter.get("prompt_tokens_estimate")),
+                    usage.get("completion_tokens", meter.get("completion_tokens_estimate")),
+                    reasoning.get("reasoning_tokens"), timing.get("first_token"),
+                    timing.get("total", meter.get("duration")), segment, offset, length
+                ))
+            elif kind == "run":
+                run_rows.append((
+                    record.get("run_id"), record.get("ts"), record.get("tab_id"),
+                    json.dumps(record.get("roles", []), ensure_ascii=False), record.get("turns"),
+                    record.get("run_tokens"), record.get("end_reason"), record.get("duration"),
+                    segment, offset, length
+                ))
+
+        if not request_rows and not run_rows:
+            return
+        conn = self._writer()
+        with conn:
+            if request_rows:
+                conn.executemany(
+                    "INSERT INTO requests (ts, run_id, tab_id, role_name, role_index, iteration, turn, model,"
+                    " route, status_code, cancelled, prompt_tokens, completion_tokens, reasoning_tokens,"
+                    " first_token, duration, segment, offset, length)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", request_rows)
+            if run_rows:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO runs (run_id, ts, tab_id, roles, turns, run_tokens, end_reason,"
+                    " duration, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", run_rows)
+
+    def close(self):
+        if self._writer_conn is not None:
+            self._writer_conn.close()
+            self._writer_conn = None
+
+    def query(self, sql, params=()):
+        """执行只读查询，返回字典列表"""
+        if not os.path.exists(self.path):
+            return []
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def run_turns(self, run_id):
+        """某次运行的全部轮次（按轮次排序）"""
+        return self.query("SELECT * FROM requests WHERE run_id = ? ORDER BY turn, id", (run_id,))
+
+    def recent_runs(self, limit=50):
+        return self.query("SELECT * FROM runs ORDER BY ts DESC LIMIT ?", (limit,))
+
+    def latency_percentile(self, percentile=95, role_name=None, since=None, field="duration"):
+        """延迟分位数（秒），field可为duration或first_token，since为起始时间戳"""
+        if field not in ("duration", "first_token"):
+            raise ValueError(f"不支持的字段: {field}")
+        sql = f"SELECT {field} AS value FROM requests WHERE {field} IS NOT NULL"
+        params = []
+        if role_name:
+            sql += " AND role_name = ?"
+            params.append(role_name)
+        if since:
+            sql += " AND ts >= ?"
+            params.append(since)
+        values = sorted(row["value"] for row in self.query(sql, params))
+        if not values:
+            return None
+        rank = min(len(values) - 1, max(0, int(round(percentile / 100.0 * len(values))) - 1))
+        return values[rank]
+
+    def load_record(self, row, expand=True):
+        """按索引中的分段和偏移读取日志记录，expand为True时还原内容引用"""
+        handle = open_log_segment(os.path.join(self.log_dir, row["segment"]))
+        if handle is None:
+            return None
+        with handle:
+            handle.seek(row["offset"])
+            record = json.loads(handle.read(row["length"]).decode('utf-8'))
+        return self.expand_record(record) if expand else record
+
+    def load_blobs(self, digests):
+        """批量读取内容，返回{hash: 文本}"""
+        digests = list(set(digests))
+        if not digests or not os.path.exists(self.path):
+            return {}
+        result = {}
+        conn = self._connect()
+        try:
+            for start in range(0, len(digests), 500):
+                part = digests[start:start + 500]
+                sql = f"SELECT hash, body FROM blobs WHERE hash IN ({','.join('?' * len(part))})"
+                for row in conn.execute(sql, part):
+                    result[row["hash"]] = zlib.decompress(row["body"]).decode('utf-8')
+        finally:
+            conn.close()
+        return result
+
+    def expand_record(self, record):
+        """把记录中的内容引用还原为完整正文"""
+        refs = []
+        messages = (((record.get("request") or {}).get("data") or {}).get("messages")) or []
+        items = [m for m in messages if isinstance(m, dict)]
+        if isinstance(record.get("response"), dict):
+            items.append(record["response"])
+        for item in items:
+            if self.BLOB_REF_KEY in item:
+                refs.append(item[self.BLOB_REF_KEY])
+        if not refs:
+            return record
+
+        blobs = self.load_blobs(refs)
+        for item in items:
+            digest = item.pop(self.BLOB_REF_KEY, None)
+            if digest is not None:
+                item["content"] = blobs.get(digest, "")
+        return record
+
+
+class _LogControl:
+    """日志写入线程的控制指令（刷新/关闭）"""
+
+    def __init__(self, action):
+        self.action = action
+        self.done = threading.Event()
+
+
+class ApiLogWriter:
+    """异步批量API日志写入器
+
+    工作线程只需把日志记录放入有界队列；专门的写入线程批量取出记录，
+    以紧凑JSONL格式追加到 log_dir/<日期>/api_<时间>_<进程号>.jsonl 分段文件，
+    分段按大小/时间/日期轮转，轮转后的分段可选gzip/zstd压缩，
+    同时把每条记录的元数据和偏移写入SQLite索引（LogIndex）；
+    消息正文、系统提示和回复按内容hash只存储一次，记录中保留 content@ 引用。
+    队列满时丢弃记录并计数，保证不会阻塞请求线程。
+    """
+
+    def __init__(self, log_dir, max_queue=10000, batch_size=256,
+                 segment_bytes=None, segment_seconds=None, compression=None, index=True, dedup=True):
+        self.log_dir = log_dir
+        self.index = LogIndex(log_dir) if index else None
+        self.dedup = dedup and self.index is not None
+        self.batch_size = batch_size
+        self.segment_bytes = segment_bytes or API_LOG_SEGMENT_BYTES
+        self.segment_seconds = segment_seconds or API_LOG_SEGMENT_SECONDS
+        self.compression = API_LOG_COMPRESSION if compression is None else compression
+        if self.compression == "zstd" and zstandard is None:
+            print("未安装zstandard，API日志改用gzip压缩")
+            self.compression = "gzip"
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+
+        # 当前分段（仅由写入线程访问）
+        self.segment_file = None
+        self.segment_path = None
+        self.segment_date = None
+        self.segment_opened_at = 0.0
+        self.segment_size = 0
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="ApiLogWriter", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        """提交一条日志记录（非阻塞）"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        """等待此前提交的记录全部写入文件"""
+        self._send_control("flush", timeout)
+
+    def close(self, timeout=5.0):
+        """写完剩余记录、压缩当前分段并停止写入线程（用于程序退出时）"""
+        if self.closed:
+            return
+        self._send_control("close", timeout)
+        self.closed = True
+        self.thread.join(timeout)
+        if self.dropped:
+            print(f"API日志队列已满，共丢弃 {self.dropped} 条记录")
+
+    def _send_control(self, action, timeout):
+        if not self.thread.is_alive():
+            return
+        control = _LogControl(action)
+        self.queue.put(control)
+        control.done.wait(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                self._rotate_if_needed(force_check=True)
+                continue
+
+            # 批量取出，减少写文件次数
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = []
+            for item in batch:
+                if isinstance(item, _LogControl):
+                    self._write_records(records)
+                    records = []
+                    if item.action == "close":
+                        self._close_segment(compress=True)
+                        if self.index is not None:
+                            self.index.close()
+                        item.done.set()
+                        return
+                    item.done.set()
+                    continue
+                records.append(item)
+            self._write_records(records)
+
+    def _write_records(self, records):
+        """去重、序列化并写入一批记录
+
+        内容先提交到索引数据库，再写入引用它们的日志行；提交失败时本批记录保留完整正文，
+        保证日志中的 content@ 引用总能还原。
+        """
+        if not records:
+            return
+        if self.dedup:
+            deduped = []
+            for record in records:
+                try:
+                    deduped.append(self.index.dedup_record(record))
+                except (TypeError, ValueError):
+                    deduped.append(record)  # 无法去重时保留原记录，序列化时再报告
+            try:
+                self.index.store_blobs()
+                records = deduped
+            except Exception as e:
+                print(f"保存日志正文失败，本批记录保留完整正文: {e}")
+
+        lines = []
+        for record in records:
+            try:
+                lines.append((record, json.dumps(record, ensure_ascii=False, separators=(',', ':'))))
+            except (TypeError, ValueError) as e:
+                print(f"API日志序列化失败: {e}")
+        self._write_lines(lines)
+
+    def _write_lines(self, lines):
+        """写入[(record, json_line)]，并把每条记录在分段中的偏移写入索引"""
+        if not lines:
+            return
+        try:
+            self._rotate_if_needed()
+            segment = os.path.relpath(self.segment_path, self.log_dir)
+            chunks = []
+            index_entries = []
+            offset = self.segment_size
+            for record, line in lines:
+                data = line.encode('utf-8') + b"\n"
+                chunks.append(data)
+                index_entries.append((record, segment, offset, len(data) - 1))
+                offset += len(data)
+            self.segment_file.write(b"".join(chunks))
+            self.segment_file.flush()
+            self.segment_size = offset
+            self.written += len(lines)
+        except Exception as e:
+            print(f"保存API日志失败: {e}")
+            return
+
+        if self.index is not None:
+            try:
+                self.index.add(index_entries)
+            except Exception as e:
+                print(f"写入日志索引失败: {e}")
+
+    def _rotate_if_needed(self, force_check=False):
+        """按日期、大小、时间轮转分段"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self.segment_file is not None:
+            expired = (self.segment_date != today
+                       or self.segment_size >= self.segment_bytes
+                       or time.time() - self.segment_opened_at >= self.segment_seconds)
+            if not expired:
+                return
+            self._close_segment(compress=True)
+        if force_check:
+            # 空闲时只负责关闭过期分段，有新记录时再创建
+            return
+
+        date_log_dir = os.path.join(self.log_dir, today)
+        os.makedirs(date_log_dir, exist_ok=True)
+        base_name = f"api_{datetime.now().strftime('%H-%M-%S')}_{os.getpid()}"
+        path = os.path.join(date_log_dir, base_name + ".jsonl")
+        counter = 1
+        while any(os.path.exists(path + suffix) for suffix in ("", ".gz", ".zst")):
+            path = os.path.join(date_log_dir, f"{base_name}_{counter}.jsonl")
+            counter += 1
+
+        self.segment_file = open(path, 'ab')
+        self.segment_path = path
+        self.segment_date = today
+        self.segment_opened_at = time.time()
+        self.segment_size = 0
+
+    def _close_segment(self, compress=False):
+        if self.segment_file is None:
+            return
+        path = self.segment_path
+        try:
+            self.segment_file.close()
+        finally:
+            self.segment_file = None
+            self.segment_path = None
+        if compress and self.compression and self.segment_size > 0:
+            self._compress(path)
+
+    def _compress(self, path):
+        """压缩已完成的分段并删除原文件"""
+        try:
+            if self.compression == "zstd":
+                target = path + ".zst"
+                with open(path, 'rb') as src, open(target, 'wb') as dst:
+                    zstandard.ZstdCompressor().copy_stream(src, dst)
+            else:
+                target = path + ".gz"
+                with open(path, 'rb') as src, gzip.open(target, 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except Exception as e:
+            print(f"压缩API日志失败: {e}")
+
+
+# ---------------- 日志统计 ----------------
+
+LOG_STATS_DIMENSIONS = ("day", "role", "model", "tab", "route")
+LOG_STATS_COLUMNS = ("requests", "errors", "error_rate", "cancelled", "prompt_tokens", "completion_tokens",
+                     "reasoning_tokens", "total_tokens", "ttft_p50", "ttft_p95", "latency_avg",
+                     "latency_p50", "latency_p95")
+_DATE_DIR_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_HIST_BASE = 0.001  # 延迟直方图最小刻度（秒）
+_HIST_LOG_STEP = math.log(1.05)  # 相邻桶相差5%，分位数误差不超过约2.5%
+
+
+def _hist_bucket(seconds):
+    return int(math.log(max(seconds, _HIST_BASE) / _HIST_BASE) / _HIST_LOG_STEP)
+
+
+def _hist_percentile(hist, percentile):
+    """对数分桶直方图的分位数（取桶中点）"""
+    total = sum(hist.values())
+    if not total:
+        return None
+    rank = max(1, int(math.ceil(percentile / 100.0 * total)))
+    seen = 0
+    for bucket in sorted(hist):
+        seen += hist[bucket]
+        if seen >= rank:
+            return round(_HIST_BASE * math.exp((bucket + 0.5) * _HIST_LOG_STEP), 3)
+    return None
+
+
+class LogStats:
+    """按维度流式汇总API日志（用量、错误率、延迟分位数）
+
+    每个分组只保存计数和对数分桶直方图，内存与日志量无关，多个进程的结果可以直接合并。
+    """
+
+    def __init__(self, group_by=("day",)):
+        for dimension in group_by:
+            if dimension not in LOG_STATS_DIMENSIONS:
+                raise ValueError(f"不支持的分组维度: {dimension}（可选: {', '.join(LOG_STATS_DIMENSIONS)}）")
+        self.group_by = tuple(group_by)
+        self.groups = {}
+        self.records = 0
+        self.bad_records = 0
+        self._day_cache = {}  # 小时 -> 日期字符串，减少逐条时间格式化
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_day_cache"] = {}
+        return state
+
+    def day_of(self, ts):
+        hour = int(ts // 3600)
+        day = self._day_cache.get(hour)
+        if day is None:
+            day = self._day_cache[hour] = datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+        return day
+
+    def add(self, day, role, model, tab, route, status_code, cancelled,
+            prompt_tokens, completion_tokens, reasoning_tokens, first_token, duration):
+        values = {"day": day, "role": role, "model": model, "tab": tab, "route": route}
+        key = tuple(values[dimension] or "-" for dimension in self.group_by)
+        group = self.groups.get(key)
+        if group is None:
+            # [请求数, 错误数, 取消数, 输入token, 输出token, 思考token, 总耗时, 耗时样本数, 首token直方图, 耗时直方图]
+            group = self.groups[key] = [0, 0, 0, 0, 0, 0, 0.0, 0, {}, {}]
+        group[0] += 1
+        if status_code != 200:
+            group[1] += 1
+        if cancelled:
+            group[2] += 1
+        group[3] += prompt_tokens or 0
+        group[4] += completion_tokens or 0
+        group[5] += reasoning_tokens or 0
+        if first_token is not None:
+            bucket = _hist_bucket(first_token)
+            group[8][bucket] = group[8].get(bucket, 0) + 1
+        if duration is not None:
+            group[6] += duration
+            group[7] += 1
+            bucket = _hist_bucket(duration)
+            group[9][bucket] = group[9].get(bucket, 0) + 1
+        self.records += 1
+
+    def add_record(self, record, day_hint=None):
+        """汇总一条日志记录（兼容旧版单文件JSON和JSONL记录）"""
+        if record.get("kind", "api") != "api":
+            return
+        response = record.get("response") or {}
+        if not isinstance(response, dict):
+            response = {}
+        usage = response.get("usage") or {}
+        meter = response.get("token_meter") or {}
+        timing = response.get("timing") or {}
+        reasoning = response.get("reasoning") or {}
+        details = usage.get("completion_tokens_details") or {}
+
+        ts = record.get("ts")
+        if ts:
+            day = self.day_of(ts)
+        else:
+            # 旧版多角色日志的timestamp格式有误，此时使用日期目录名
+            timestamp = str(record.get("timestamp", ""))[:10]
+            day = timestamp if _DATE_DIR_PATTERN.match(timestamp) else day_hint
+
+        model = ((record.get("request") or {}).get("data") or {}).get("model")
+        tab = record.get("tab_id")
+        status_code = response.get("status_code")
+        if "error" in response:
+            status_code = status_code if status_code not in (None, 200) else -1
+        self.add(day, record.get("role_name"), model, str(tab) if tab is not None else None, record.get("route"),
+                 status_code, response.get("cancelled"),
+                 usage.get("prompt_tokens", meter.get("prompt_tokens_estimate")),
+                 usage.get("completion_tokens", meter.get("completion_tokens_estimate")),
+                 reasoning.get("reasoning_tokens", details.get("reasoning_tokens")),
+                 timing.get("first_token"), timing.get("total", meter.get("duration")))
+
+    def merge(self, other):
+        self.records += other.records
+        self.bad_records += other.bad_records
+        for key, theirs in other.groups.items():
+            group = self.groups.get(key)
+            if group is None:
+                self.groups[key] = theirs
+                continue
+            for i in range(8):
+                group[i] += theirs[i]
+            for i in (8, 9):
+                for bucket, count in theirs[i].items():
+                    group[i][bucket] = group[i].get(bucket, 0) + count
+        return self
+
+    def rows(self):
+        """按分组键排序的汇总行"""
+        rows = []
+        for key in sorted(self.groups):
+            requests_, errors, cancelled, prompt, completion, reasoning, duration_sum, duration_n, ttft, durations = \
+                self.groups[key]
+            row = dict(zip(self.group_by, key))
+            row.update({
+                "requests": requests_,
+                "errors": errors,
+                "error_rate": round(errors / requests_, 4) if requests_ else 0.0,
+                "cancelled": cancelled,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "reasoning_tokens": reasoning,
+                "total_tokens": prompt + completion,
+                "ttft_p50": _hist_percentile(ttft, 50),
+                "ttft_p95": _hist_percentile(ttft, 95),
+                "latency_avg": round(duration_sum / duration_n, 3) if duration_n else None,
+                "latency_p50": _hist_percentile(durations, 50),
+                "latency_p95": _hist_percentile(durations, 95)
+            })
+            rows.append(row)
+        return rows
+
+
+def _iter_log_file(path):
+    """逐条读取日志文件：旧版为每个文件一个JSON对象，新版为JSONL分段（可压缩）"""
+    if path.endswith(".json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield json.load(f)
+        return
+    handle = open_log_segment(_segment_key(path))
+    if handle is None:
+        return
+    if path.endswith(".zst"):
+        handle = io.BufferedReader(handle)  # zstd解压流不支持按行读取
+    with handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _scan_log_files(paths, group_by):
+    """进程池任务：汇总一批日志文件，返回LogStats（日期过滤已按目录完成）"""
+    stats = LogStats(group_by)
+    for path in paths:
+        day_hint = os.path.basename(os.path.dirname(path))
+        try:
+            for record in _iter_log_file(path):
+                stats.add_record(record, day_hint)
+        except (OSError, ValueError, EOFError) as e:
+            # 崩溃留下的不完整分段或损坏文件：保留已读取的部分
+            stats.bad_records += 1
+            print(f"读取日志失败 {path}: {e}", file=sys.stderr)
+    return stats
+
+
+def _segment_key(relative_path):
+    """分段在索引中的名称（压缩后的文件名去掉.gz/.zst）"""
+    for suffix in (".gz", ".zst"):
+        if relative_path.endswith(suffix):
+            return relative_path[:-len(suffix)]
+    return relative_path
+
+
+def _day_bounds(since, until):
+    start = datetime.strptime(since, "%Y-%m-%d").timestamp() if since else None
+    end = (datetime.strptime(until, "%Y-%m-%d").timestamp() + 86400) if until else None
+    return start, end
+
+
+def analyze_logs(log_dir="api_logs", group_by=("day",), since=None, until=None, workers=None, use_index=True):
+    """统计api_logs目录下的全部日志
+
+    since/until为包含边界的日期（YYYY-MM-DD），按日期目录跳过范围外的文件。
+    已写入SQLite索引的分段直接从索引汇总，其余文件（旧版JSON、索引建立前的分段）用进程池并行解析。
+    """
+    stats = LogStats(group_by)
+    if not os.path.isdir(log_dir):
+        return stats
+
+    index = LogIndex(log_dir)
+    indexed_segments = set()
+    if use_index and os.path.exists(index.path):
+        indexed_segments = {row["segment"] for row in index.query("SELECT DISTINCT segment FROM requests")}
+
+    # 收集需要解析的文件（按日期目录过滤）
+    files = []
+    for day in sorted(os.listdir(log_dir)):
+        day_dir = os.path.join(log_dir, day)
+        if not _DATE_DIR_PATTERN.match(day) or not os.path.isdir(day_dir):
+            continue
+        if (since and day < since) or (until and day > until):
+            continue
+        for name in os.listdir(day_dir):
+            if not name.endswith((".json", ".jsonl", ".jsonl.gz", ".jsonl.zst")):
+                continue
+            if _segment_key(os.path.join(day, name)) in indexed_segments:
+                continue
+            path = os.path.join(day_dir, name)
+            files.append((os.path.getsize(path), path))
+
+    # 大分段单独成任务，旧版的小JSON文件每批约8MB
+    tasks = []
+    batch, batch_size = [], 0
+    for size, path in sorted(files, reverse=True):
+        if size >= 8 * 1024 * 1024:
+            tasks.append([path])
+            continue
+        batch.append(path)
+        batch_size += size
+        if batch_size >= 8 * 1024 * 1024 or len(batch) >= 2000:
+            tasks.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        tasks.append(batch)
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            futures = [pool.submit(_scan_log_files, task, group_by) for task in tasks]
+            # 索引中的记录在主进程中与解析并行汇总
+            if indexed_segments:
+                _add_index_rows(stats, index, since, until)
+            for future in as_completed(futures):
+                stats.merge(future.result())
+    else:
+        if indexed_segments:
+            _add_index_rows(stats, index, since, until)
+        for task in tasks:
+            stats.merge(_scan_log_files(task, group_by))
+    return stats
+
+
+def _add_index_rows(stats, index, since, until):
+    """从SQLite索引汇总已索引分段中的请求"""
+    start, end = _day_bounds(since, until)
+    sql = ("SELECT ts, role_name, model, tab_id, route, status_code, cancelled, prompt_tokens,"
+           " completion_tokens, reasoning_tokens, first_token, duration FROM requests WHERE 1 = 1")
+    params = []
+    if start is not None:
+        sql += " AND ts >= ?"
+        params.append(start)
+    if end is not None:
+        sql += " AND ts < ?"
+        params.append(end)
+    conn = index._connect()
+    conn.row_factory = None
+    try:
+        for (ts, role_name, model, tab_id, route, status_code, cancelled, prompt, completion,
+             reasoning, first_token, duration) in conn.execute(sql, params):
+            stats.add(stats.day_of(ts) if ts else None, role_name, model, str(tab_id) if tab_id is not None else None, route,
+                      status_code, cancelled, prompt, completion, reasoning, first_token, duration)
+    finally:
+        conn.close()
+
+
+def _display_width(text):
+    return sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+
+
+def format_log_stats(stats, fmt="table"):
+    """把统计结果格式化为table/csv/json文本"""
+    rows = stats.rows()
+    columns = list(stats.group_by) + list(LOG_STATS_COLUMNS)
+    if fmt == "json":
+        return json.dumps(rows, ensure_ascii=False, indent=2)
+    if fmt == "csv":
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+        return output.getvalue()
+
+    cells = [[("" if row[column] is None else str(row[column])) for column in columns] for row in rows]
+    widths = [max([_display_width(column)] + [_display_width(line[i]) for line in cells])
+              for i, column in enumerate(columns)]
+
+    def render(values):
+        return "  ".join(value + " " * (width - _display_width(value))
+                         for value, width in zip(values, widths)).rstrip()
+
+    lines = [render(columns), "  ".join("-" * width for width in widths)]
+    lines.extend(render(line) for line in cells)
+    lines.append(f"共 {stats.records} 条请求，{len(rows)} 个分组")
+    return "\n".join(lines)
+
+
+@contextmanager
+def atomic_open(path):
+    """原子写入文本文件：先写临时文件，成功结束后再重命名，写入中途崩溃或出错不会损坏原文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_text(path, text):
+    """原子写入文本文件：先写临时文件再重命名，写入中途崩溃不会损坏原文件"""
+    with atomic_open(path) as f:
+        f.write(text)
+
+
+class SessionStore:
+    """工作区会话存储
+
+    - workspace.json：标签页布局（类型、标题、角色/多角色配置、Token和消息数摘要）
+    - tab_<id>.jsonl：每个标签页一个追加写入的操作日志（append/clear/tokens/role/config/memory），
+      操作数超过阈值或程序退出时压缩为一条snapshot
+    所有写入都在后台线程完成，调用方只需入队。
+    """
+
+    def __init__(self, store_dir="sessions", compact_threshold=500):
+        self.store_dir = store_dir
+        self.layout_path = os.path.join(store_dir, "workspace.json")
+        self.compact_threshold = compact_threshold
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.queue = queue.Queue()
+        self.op_counts = {}  # 写入线程使用：tab_id -> 自上次压缩以来的操作数
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="SessionStore", daemon=True)
+        self.thread.start()
+
+    def journal_path(self, tab_id):
+        return os.path.join(self.store_dir, f"tab_{tab_id}.jsonl")
+
+    def append(self, tab_id, op):
+        """追加一条标签页操作"""
+        self.queue.put(("append", tab_id, op))
+
+    def reset_tab(self, tab_id):
+        """新建标签页时清除同ID的旧日志"""
+        self.queue.put(("reset", tab_id, None))
+
+    def remove_tab(self, tab_id):
+        """关闭标签页时删除其日志"""
+        self.queue.put(("remove", tab_id, None))
+
+    def save_layout(self, layout):
+        """保存工作区布局（连续多次保存只写最后一次）"""
+        self.queue.put(("layout", None, layout))
+
+    def flush(self, timeout=5.0):
+        self._send_control("flush", timeout)
+
+    def close(self, timeout=10.0):
+        """写完队列并压缩本次修改过的标签页日志"""
+        if self.closed:
+            return
+        self._send_control("close", timeout)
+        self.closed = True
+        self.thread.join(timeout)
+
+    def _send_control(self, action, timeout):
+        if not self.thread.is_alive():
+            return
+        control = _LogControl(action)
+        self.queue.put(("control", None, control))
+        control.done.wait(timeout)
+
+    def load_layout(self):
+        """读取工作区布局，不存在或损坏时返回None"""
+        if not os.path.exists(self.layout_path):
+            return None
+        try:
+            with open(self.layout_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"加载工作区失败: {e}")
+            return None
+
+    def load_tab(self, tab_id):
+        """重放标签页日志得到其状态"""
+        self.flush()
+        return self.replay(self.journal_path(tab_id))
+
+    @staticmethod
+    def replay(path):
+        """按顺序重放操作日志，返回 {history, prompt_tokens, completion_tokens, role_config, config, memory}"""
+        state = {"history": [], "prompt_tokens": 0, "completion_tokens": 0,
+                 "role_config": None, "config": None, "memory": None}
+        if not os.path.exists(path):
+            return state
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时可能留下不完整的最后一行
+                    continue
+                kind = op.get("op")
+                if kind == "snapshot":
+                    state.update(op.get("state", {}))
+                elif kind == "append":
+                    state["history"].append(op.get("entry"))
+                elif kind == "clear":
+                    state["history"] = []
+                    state["memory"] = None
+                elif kind == "tokens":
+                    state["prompt_tokens"] = op.get("prompt", 0)
+                    state["completion_tokens"] = op.get("completion", 0)
+                elif kind == "role":
+                    state["role_config"] = op.get("config")
+                elif kind == "config":
+                    state["config"] = op.get("config")
+                elif kind == "memory":
+                    state["memory"] = op.get("memory")
+        return state
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # 同一批中的布局保存只保留最后一次
+            last_layout = max((i for i, item in enumerate(batch) if item[0] == "layout"), default=-1)
+            for i, (action, tab_id, payload) in enumerate(batch):
+                try:
+                    if action == "append":
+                        self._append(tab_id, payload)
+                    elif action == "reset" or action == "remove":
+                        path = self.journal_path(tab_id)
+                        if os.path.exists(path):
+                            os.remove(path)
+                        self.op_counts.pop(tab_id, None)
+                    elif action == "layout" and i == last_layout:
+                        atomic_write_text(self.layout_path, json.dumps(payload, ensure_ascii=False))
+                    elif action == "control":
+                        if payload.action == "close":
+                            for touched_id in list(self.op_counts):
+                                self._compact(touched_id)
+                            payload.done.set()
+                            return
+                        payload.done.set()
+                except Exception as e:
+                    print(f"保存会话失败: {e}")
+
+    def _append(self, tab_id, op):
+        with open(self.journal_path(tab_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(op, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self.op_counts[tab_id] = self.op_counts.get(tab_id, 0) + 1
+        if self.op_counts[tab_id] >= self.compact_threshold:
+            self._compact(tab_id)
+
+    def _compact(self, tab_id):
+        """把标签页日志压缩为一条快照"""
+        path = self.journal_path(tab_id)
+        if not os.path.exists(path):
+            return
+        state = self.replay(path)
+        atomic_write_text(path, json.dumps({"op": "snapshot", "state": state},
+                                           ensure_ascii=False, separators=(',', ':')) + "\n")
+        self.op_counts[tab_id] = 0
+
+
+class DialogTurnStore:
+    """多角色对话记录（按轮次追加，内存占用有上限）
+
+    - 内存中只保留最近keep_recent轮，更早的轮次写入本次运行的临时文件，按偏移量随机读取
+    - 一轮的提问通常是上一轮的回复加连接词：存储时只保存回复之后的部分（message_suffix），
+      读取时再与上一轮回复拼接，同一段文本在内存、临时文件和会话日志中都只存一份
+    - 读写都加锁，工作线程追加的同时界面线程可以遍历或导出
+    支持len()、下标（含负数）和迭代，取出的都是带完整message的普通字典。
+    """
+
+    def __init__(self, keep_recent=20):
+        self.keep_recent = keep_recent
+        self.lock = threading.RLock()
+        self.recent = deque()  # 内存中的最近轮次（压缩形式）
+        self.offsets = []  # 已溢出到临时文件的轮次的偏移量
+        self.spill = None  # 第一次溢出时才创建临时文件
+        self.last_response = None  # 最后一轮的回复，用于压缩下一轮的提问
+
+    def __len__(self):
+        return len(self.offsets) + len(self.recent)
+
+    def append(self, entry):
+        """追加一轮对话，返回压缩后的记录（用于写入会话日志）"""
+        with self.lock:
+            entry = self.compact(entry, self.last_response)
+            self.last_response = entry.get("response")
+            self.recent.append(entry)
+            while len(self.recent) > self.keep_recent:
+                self._spill(self.recent.popleft())
+            return entry
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def clear(self):
+        with self.lock:
+            self.close()
+            self.recent.clear()
+            self.offsets = []
+            self.last_response = None
+
+    def close(self):
+        """关闭并删除临时文件"""
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    @staticmethod
+    def compact(entry, previous_response):
+        """提问以上一轮回复开头时只保留其后的部分"""
+        message = entry.get("message")
+        if previous_response and isinstance(message, str) and message.startswith(previous_response):
+            entry = dict(entry)
+            del entry["message"]
+            entry["message_suffix"] = message[len(previous_response):]
+        return entry
+
+    def _spill(self, entry):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix="dialog_run_", suffix=".jsonl")
+        self.spill.seek(0, os.SEEK_END)
+        self.offsets.append(self.spill.tell())
+        self.spill.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n")
+
+    def _raw(self, index):
+        """第index轮的压缩记录"""
+        spilled = len(self.offsets)
+        if index >= spilled:
+            return self.recent[index - spilled]
+        self.spill.seek(self.offsets[index])
+        return json.loads(self.spill.readline())
+
+    @staticmethod
+    def _expand(entry, previous_response):
+        if "message_suffix" not in entry:
+            return entry
+        entry = dict(entry)
+        entry["message"] = (previous_response or "") + entry.pop("message_suffix")
+        return entry
+
+    def __getitem__(self, index):
+        with self.lock:
+            count = len(self)
+            if index < 0:
+                index += count
+            if not 0 <= index < count:
+                raise IndexError("对话记录下标越界")
+            entry = self._raw(index)
+            previous = self._raw(index - 1).get("response") if "message_suffix" in entry and index > 0 else None
+            return self._expand(entry, previous)
+
+    def __iter__(self):
+        """按顺序逐轮读取（只遍历开始时已有的轮次，每次只把一轮载入内存）"""
+        previous = None
+        for index in range(len(self)):
+            with self.lock:
+                if index >= len(self):
+                    # 遍历过程中被清空
+                    return
+                entry = self._raw(index)
+            yield self._expand(entry, previous)
+            previous = entry.get("response")
+
+
+# 对话导出格式：扩展名 -> 说明
+DIALOG_EXPORT_FORMATS = {"md": "Markdown", "jsonl": "JSON Lines", "html": "HTML"}
+
+
+def export_dialog(turns, path, fmt=None, title="多角色协同对话"):
+    """把对话记录逐轮流式写入文件（md/jsonl/html，默认按扩展名判断），返回导出的轮数
+
+    turns可以是DialogTurnStore或任意按顺序产出对话字典的可迭代对象，导出过程中不会复制整段对话。
+    """
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in DIALOG_EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+
+    count = 0
+    last_iteration = None
+    with atomic_open(path) as f:
+        if fmt == "md":
+            f.write(f"# {title}\n\n")
+        elif fmt == "html":
+            f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+                    f"<title>{html.escape(title)}</title>\n<style>"
+                    "body{font-family:sans-serif;max-width:960px;margin:auto;padding:1em}"
+                    ".turn{border-left:3px solid #4a90d9;margin:1em 0;padding:0 1em}"
+                    ".text{white-space:pre-wrap}.message{color:#666}"
+                    "</style></head><body>\n"
+                    f"<h1>{html.escape(title)}</h1>\n")
+
+        for entry in turns:
+            count += 1
+            if fmt == "jsonl":
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                continue
+
+            iteration = entry.get("iteration")
+            role_name = entry.get("role_name", "")
+            timestamp = entry.get("timestamp", "")
+            message = entry.get("message", "")
+            response = entry.get("response", "")
+            if fmt == "md":
+                if iteration != last_iteration:
+                    f.write(f"## 第 {iteration} 轮\n\n")
+                f.write(f"### 【{role_name}】 {timestamp}\n\n")
+                if message:
+                    f.write("**提问：**\n\n" + "\n".join(f"> {line}" for line in message.split("\n")) + "\n\n")
+                f.write(f"{response}\n\n")
+            else:
+                if iteration != last_iteration:
+                    f.write(f"<h2>第 {html.escape(str(iteration))} 轮</h2>\n")
+                f.write(f"<div class=\"turn\"><h3>【{html.escape(role_name)}】 {html.escape(timestamp)}</h3>\n")
+                if message:
+                    f.write(f"<div class=\"text message\">{html.escape(message)}</div><hr>\n")
+                f.write(f"<div class=\"text\">{html.escape(response)}</div></div>\n")
+            last_iteration = iteration
+
+        if fmt == "html":
+            f.write("</body></html>\n")
+    return count
+
+
+def role_tags(role_config):
+    """角色的标签列表（配置中可以是列表或逗号分隔的字符串）"""
+    tags = role_config.get("tags") or []
+    if isinstance(tags, str):
+        tags = re.split(r'[,，]', tags)
+    return [tag.strip() for tag in tags if tag and tag.strip()]
+
+
+class RoleIndex:
+    """角色库搜索索引
+
+    - 名称按小写排序，前缀查询用二分查找
+    - 名称和"名称+标签+系统提示"分别拼接成一个大字符串，子串查询用str.find逐个命中跳转，
+      不需要逐个角色比较；拼接串在角色变化后的下一次查询时才重建
+    - 标签到角色名的映射用于按标签筛选
+    结果排序：名称前缀匹配 > 名称包含 > 提示词/标签包含。
+    """
+
+    SEPARATOR = "\x00"
+
+    def __init__(self):
+        self.entries = {}  # name -> (小写名称, 小写全文, 标签)
+        self.sorted_names = []  # [(小写名称, 名称)]
+        self.tag_map = {}  # tag -> {name}
+        self.haystacks = None  # (名称顺序, 起始偏移, 名称拼接串, 全文拼接串)
+
+    def clear(self):
+        self.entries = {}
+        self.sorted_names = []
+        self.tag_map = {}
+        self.haystacks = None
+
+    def rebuild(self, roles):
+        """一次性重建整个索引（加载角色文件时使用）"""
+        self.clear()
+        for name, role_config in roles.items():
+            self._add_entry(name, role_config)
+        self.sorted_names = sorted((entry[0], name) for name, entry in self.entries.items())
+
+    def _add_entry(self, name, role_config):
+        tags = role_tags(role_config)
+        name_lower = name.lower()
+        text = " ".join([name_lower] + tags + [role_config.get("system_prompt", "")]).lower()
+        self.entries[name] = (name_lower, text, tags)
+        for tag in tags:
+            self.tag_map.setdefault(tag, set()).add(name)
+        self.haystacks = None
+
+    def add(self, name, role_config):
+        if name in self.entries:
+            self.remove(name)
+        self._add_entry(name, role_config)
+        bisect.insort(self.sorted_names, (self.entries[name][0], name))
+
+    def remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        name_lower, _, tags = entry
+        i = bisect.bisect_left(self.sorted_names, (name_lower, name))
+        if i < len(self.sorted_names) and self.sorted_names[i] == (name_lower, name):
+            del self.sorted_names[i]
+        for tag in tags:
+            names = self.tag_map.get(tag)
+            if names:
+                names.discard(name)
+                if not names:
+                    del self.tag_map[tag]
+        self.haystacks = None
+
+    def tags(self):
+        return sorted(self.tag_map)
+
+    def _build(self):
+        order = [name for _, name in self.sorted_names]
+        starts = []
+        text_starts = []
+        offset = text_offset = 0
+        for name in order:
+            name_lower, text, _ = self.entries[name]
+            starts.append(offset)
+            text_starts.append(text_offset)
+            offset += len(name_lower) + 1
+            text_offset += len(text) + 1
+        names_hay = self.SEPARATOR.join(self.entries[name][0] for name in order)
+        text_hay = self.SEPARATOR.join(self.entries[name][1] for name in order)
+        self.haystacks = (order, starts, names_hay, text_starts, text_hay)
+
+    @staticmethod
+    def _find_all(hay, starts, order, query):
+        """在拼接串中查找query，每个角色最多返回一次"""
+        pos = hay.find(query)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            yield order[i]
+            if i + 1 >= len(starts):
+                break
+            pos = hay.find(query, starts[i + 1])
+
+    def search(self, query="", tag=None, limit=None):
+        """按名称前缀/子串、提示词子串和标签查找角色，返回排序后的角色名列表"""
+        query = (query or "").strip().lower()
+        allowed = self.tag_map.get(tag, set()) if tag else None
+
+        if not query:
+            names = [name for _, name in self.sorted_names if allowed is None or name in allowed]
+            return names[:limit] if limit else names
+
+        if self.haystacks is None:
+            self._build()
+        order, starts, names_hay, text_starts, text_hay = self.haystacks
+
+        results = []
+        seen = set()
+
+        def candidates():
+            i = bisect.bisect_left(self.sorted_names, (query,))
+            while i < len(self.sorted_names) and self.sorted_names[i][0].startswith(query):
+                yield self.sorted_names[i][1]
+                i += 1
+            yield from self._find_all(names_hay, starts, order, query)
+            yield from self._find_all(text_hay, text_starts, order, query)
+
+        for name in candidates():
+            if name in seen or (allowed is not None and name not in allowed):
+                continue
+            seen.add(name)
+            results.append(name)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+
+class RoleStore:
+    """全局角色库
+
+    - 读取接口与dict一致（get/keys/items/in/len），供各标签页直接使用
+    - 修改后由后台线程延迟合并写入，写入为临时文件+重命名，崩溃不会损坏文件
+    - 定期检查文件是否被其他实例修改，只合并有变化的角色
+    - 角色变化时通知订阅者（回调参数为变化的角色名集合），取代逐个标签页刷新
+    - 维护RoleIndex，供角色选择器按名称/提示词/标签快速筛选
+    所有修改和通知都应在主线程进行；写入线程只读取快照。
+    """
+
+    def __init__(self, path="global_roles.json", save_delay=0.5):
+        self.path = path
+        self.save_delay = save_delay
+        self.roles = {}
+        self.index = RoleIndex()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+        self.dirty = set()  # 本地修改且尚未写入的角色名
+        self.disk_roles = {}  # 最近一次读取或写入的文件内容，用于计算外部修改的差异
+        self.disk_stat = None  # 文件的(mtime_ns, size)
+        self.external_changes = {}  # 写入线程读到的外部修改（角色名 -> 配置，删除为None），等待主线程合并
+
+        self.save_event = threading.Event()
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, name="RoleStore", daemon=True)
+        self.thread.start()
+
+    # ---- dict读取接口 ----
+    def __getitem__(self, name):
+        return self.roles[name]
+
+    def __contains__(self, name):
+        return name in self.roles
+
+    def __iter__(self):
+        return iter(list(self.roles))
+
+    def __len__(self):
+        return len(self.roles)
+
+    def get(self, name, default=None):
+        return self.roles.get(name, default)
+
+    def keys(self):
+        return list(self.roles.keys())
+
+    def items(self):
+        return list(self.roles.items())
+
+    def values(self):
+        return list(self.roles.values())
+
+    def search(self, query="", tag=None, limit=None):
+        """按名称/提示词/标签查找角色名"""
+        with self.lock:
+            return self.index.search(query, tag, limit)
+
+    def tags(self):
+        with self.lock:
+            return self.index.tags()
+
+    # ---- 修改 ----
+    def set(self, name, role_config):
+        """添加或更新一个角色"""
+        self.update({name: role_config})
+
+    def update(self, roles):
+        """批量添加或更新角色，返回实际发生变化的角色名"""
+        with self.lock:
+            changed = {name for name, config in roles.items() if self.roles.get(name) != config}
+            for name in changed:
+                self.roles[name] = dict(roles[name])
+                self.index.add(name, self.roles[name])
+            self.dirty |= changed
+        if changed:
+            self.schedule_save()
+            self.notify(changed)
+        return changed
+
+    def remove(self, name):
+        """删除一个角色"""
+        with self.lock:
+            if name not in self.roles:
+                return
+            del self.roles[name]
+            self.index.remove(name)
+            self.dirty.add(name)
+        self.schedule_save()
+        self.notify({name})
+
+    # ---- 通知 ----
+    def subscribe(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, names):
+        for callback in list(self.listeners):
+            try:
+                callback(names)
+            except Exception as e:
+                print(f"角色变更通知失败: {e}")
+
+    # ---- 读写文件 ----
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _read_disk(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load(self):
+        """启动时读取角色文件（文件损坏时抛出异常）"""
+        if not os.path.exists(self.path):
+            return
+        stat = self._stat()
+        roles = self._read_disk()
+        with self.lock:
+            self.roles = dict(roles)
+            self.index.rebuild(self.roles)
+            self.disk_roles = dict(roles)
+            self.disk_stat = stat
+        self.notify(set(roles))
+
+    def _disk_changes(self, disk):
+        """文件中相对上次读取有变化、且本地未修改的角色（需持有锁，不修改角色库），
+        返回 {角色名: 配置}，被删除的角色为None"""
+        changes = {}
+        for name in set(disk) | set(self.disk_roles):
+            if disk.get(name) == self.disk_roles.get(name) or name in self.dirty:
+                continue
+            changes[name] = disk.get(name)
+        self.disk_roles = disk
+        return changes
+
+    def _apply_changes(self, roles, changes):
+        """把外部修改应用到roles字典（本地修改过的角色保留本地版本），返回实际应用的角色名"""
+        applied = set()
+        for name, config in changes.items():
+            if name in self.dirty:
+                continue
+            if config is not None:
+                roles[name] = config
+            else:
+                roles.pop(name, None)
+            applied.add(name)
+        return applied
+
+    def check_external_changes(self):
+        """检查角色文件是否被其他实例修改并增量合并（主线程定期调用）"""
+        stat = self._stat()
+        disk = None
+        if stat is not None and stat != self.disk_stat:
+            try:
+                disk = self._read_disk()
+            except Exception as e:
+                print(f"重新加载角色配置失败: {e}")
+
+        with self.lock:
+            changes = self.external_changes
+            self.external_changes = {}
+            if disk is not None:
+                changes.update(self._disk_changes(disk))
+                self.disk_stat = stat
+            changed = self._apply_changes(self.roles, changes)
+            for name in changed:
+                if name in self.roles:
+                    self.index.add(name, self.roles[name])
+                else:
+                    self.index.remove(name)
+
+        if changed:
+            self.notify(changed)
+        return changed
+
+    def schedule_save(self):
+        self.save_event.set()
+
+    def flush(self):
+        """立即写入未保存的修改（在调用线程中执行）"""
+        self._write()
+
+    def close(self, timeout=10.0):
+        """写入未保存的修改并停止写入线程"""
+        self.closing = True
+        self.save_event.set()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self.save_event.wait()
+            if not self.closing:
+                # 等待一小段时间，合并连续的多次修改
+                time.sleep(self.save_delay)
+            self.save_event.clear()
+            self._write()
+            if self.closing:
+                return
+
+    def _write(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            seen_stat = self.disk_stat
+
+        # 写入前先读取其他实例的修改并写进快照，避免覆盖对方新增的角色；
+        # 读文件在锁外进行，不阻塞主线程，角色库本身由主线程在check_external_changes中合并
+        disk = None
+        stat = self._stat()
+        if stat is not None and stat != seen_stat:
+            try:
+                disk = self._read_disk()
+            except Exception as e:
+                print(f"读取角色配置失败: {e}")
+
+        with self.lock:
+            if not self.dirty:
+                return  # 已被另一次写入保存
+            # 读取期间主线程已合并了更新的文件内容时，丢弃这次读到的旧内容
+            if disk is not None and self.disk_stat == seen_stat:
+                self.external_changes.update(self._disk_changes(disk))
+            snapshot = dict(self.roles)
+            self._apply_changes(snapshot, self.external_changes)
+            written = self.dirty
+            self.dirty = set()
+
+        text = json.dumps(snapshot, ensure_ascii=False, indent=2)
+        try:
+            atomic_write_text(self.path, text)
+        except Exception as e:
+            print(f"保存角色配置失败: {e}")
+            with self.lock:
+                self.dirty |= written
+            return
+
+        # 写入后立即取stat，再确认文件内容仍是刚写入的快照：其他实例恰好在这之间写入时
+        # 不记录stat，check_external_changes会重新读取并与快照比较，不会漏掉对方的修改
+        stat = self._stat()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                unchanged = f.read() == text
+        except OSError:
+            unchanged = False
+        with self.lock:
+            self.disk_roles = snapshot
+            if unchanged:
+                self.disk_stat = stat
+
+
+class VirtualListbox(ttk.Frame):
+    """只渲染可见行的列表框
+
+    数据保存在Python列表中，Listbox里始终只有一屏的行，滚动时替换这一屏的内容，
+    因此列表长度对打开和滚动速度没有影响。
+    """
+
+    def __init__(self, parent, height=8, font=None):
+        super().__init__(parent)
+        self.items = []
+        self.top = 0  # 第一行可见项在items中的位置
+        self.rows = height
+        self.selected = None  # 选中项在items中的位置
+
+        options = {"font": font} if font else {}
+        self.listbox = tk.Listbox(self, height=height, selectmode=tk.SINGLE, exportselection=False, **options)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.line_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        self.listbox.bind("<Configure>", self.on_configure)
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units") or "break")
+        self.listbox.bind("<Button-4>", lambda e: self.scroll(-1, "units") or "break")
+        self.listbox.bind("<Button-5>", lambda e: self.scroll(1, "units") or "break")
+        self.listbox.bind("<Up>", lambda e: self.move_selection(-1) or "break")
+        self.listbox.bind("<Down>", lambda e: self.move_selection(1) or "break")
+        self.listbox.bind("<Prior>", lambda e: self.move_selection(-self.rows) or "break")
+        self.listbox.bind("<Next>", lambda e: self.move_selection(self.rows) or "break")
+
+    def set_items(self, items):
+        """替换全部数据（保留仍然存在的选中项）"""
+        selected_item = self.get_selected()
+        self.items = items
+        self.selected = None
+        if selected_item is not None:
+            try:
+                self.selected = items.index(selected_item)
+            except ValueError:
+                pass
+        self.top = max(0, min(self.top, len(items) - self.rows))
+        self.render()
+
+    def get_selected(self):
+        if self.selected is None or self.selected >= len(self.items):
+            return None
+        return self.items[self.selected]
+
+    def bind_activate(self, callback):
+        """双击或回车时调用callback()"""
+        self.listbox.bind("<Double-1>", lambda e: callback())
+        self.listbox.bind("<Return>", lambda e: callback())
+
+    def render(self):
+        visible = self.items[self.top:self.top + self.rows]
+        self.listbox.delete(0, tk.END)
+        if visible:
+            self.listbox.insert(tk.END, *visible)
+        if self.selected is not None and self.top <= self.selected < self.top + len(visible):
+            self.listbox.selection_set(self.selected - self.top)
+        total = len(self.items)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll(self, amount, what="units"):
+        step = amount * self.rows if what == "pages" else amount
+        top = max(0, min(self.top + step, len(self.items) - self.rows))
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def on_scrollbar(self, action, amount, what=None):
+        if action == "moveto":
+            top = int(float(amount) * len(self.items))
+            self.top = max(0, min(top, len(self.items) - self.rows))
+            self.render()
+        else:
+            self.scroll(int(amount), what)
+
+    def on_configure(self, event):
+        rows = max(1, event.height // self.line_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.top = max(0, min(self.top, len(self.items) - self.rows))
+            self.render()
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+
+    def move_selection(self, amount):
+        if not self.items:
+            return
+        current = self.selected if self.selected is not None else self.top - 1
+        self.selected = max(0, min(current + amount, len(self.items) - 1))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.rows:
+            self.top = self.selected - self.rows + 1
+        self.render()
+
+
+class RolePicker(ttk.Frame):
+    """可输入筛选的角色选择器（结果来自角色库索引，列表只渲染可见行）"""
+
+    ALL_TAGS = "全部标签"
+
+    def __init__(self, parent, role_store, height=8, font=None, on_activate=None):
+        super().__init__(parent)
+        self.role_store = role_store
+        self.query = tk.StringVar()
+        self.tag = tk.StringVar(value=self.ALL_TAGS)
+        self.refresh_job = None
+
+        filter_frame = ttk.Frame(self)
+        filter_frame.pack(fill=tk.X, pady=(0, 3))
+        self.query_entry = ttk.Entry(filter_frame, textvariable=self.query, width=12)
+        self.query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.tag_combo = ttk.Combobox(filter_frame, textvariable=self.tag, state="readonly", width=8,
+                                      postcommand=self.update_tag_values)
+        self.tag_combo.pack(side=tk.LEFT, padx=(3, 0))
+
+        self.count_var = tk.StringVar()
+        ttk.Label(self, textvariable=self.count_var, foreground="gray").pack(side=tk.BOTTOM, anchor=tk.W)
+
+        self.list = VirtualListbox(self, height=height, font=font)
+        self.list.pack(fill=tk.BOTH, expand=True)
+        if on_activate:
+            self.list.bind_activate(on_activate)
+            self.query_entry.bind("<Return>", lambda e: on_activate())
+        self.query_entry.bind("<Down>", lambda e: (self.list.listbox.focus_set(), self.list.move_selection(1)))
+
+        self.query.trace_add("write", lambda *args: self.schedule_refresh())
+        self.tag.trace_add("write", lambda *args: self.schedule_refresh())
+        self.refresh()
+
+    def update_tag_values(self):
+        self.tag_combo['values'] = [self.ALL_TAGS] + self.role_store.tags()
+
+    def schedule_refresh(self, delay=50):
+        """合并短时间内的多次刷新（连续输入、角色库批量变化）"""
+        if self.refresh_job is not None:
+            self.after_cancel(self.refresh_job)
+        self.refresh_job = self.after(delay, self.refresh)
+
+    def refresh(self):
+        self.refresh_job = None
+        tag = self.tag.get()
+        names = self.role_store.search(self.query.get(), None if tag == self.ALL_TAGS else tag)
+        self.list.set_items(names)
+        self.count_var.set(f"共 {len(names)} 个角色" if len(names) == len(self.role_store)
+                           else f"匹配 {len(names)}/{len(self.role_store)} 个角色")
+
+    def get_selected(self):
+        """选中的角色名；未选中但只有一个匹配结果时返回该结果"""
+        selected = self.list.get_selected()
+        if selected is None and len(self.list.items) == 1:
+            return self.list.items[0]
+        return selected
+
+
+class TimingPanel(ttk.LabelFrame):
+    """最近几次请求的分阶段耗时"""
+
+    COLUMNS = (("time", "时间", 64), ("role", "角色", 80), ("connect", "建连", 52), ("headers", "响应头", 56),
+               ("first_token", "首token", 58), ("total", "总耗时", 58), ("chunks", "块数", 44),
+               ("bytes", "KB", 50), ("parse", "解析", 52), ("render", "渲染延迟", 64), ("max_gap", "最大间隔", 64))
+
+    def __init__(self, parent, rows=4):
+        super().__init__(parent, text="⏱ 请求计时", padding="5")
+        self.tree = ttk.Treeview(self, columns=[name for name, _, _ in self.COLUMNS], show="headings", height=rows)
+        for name, title, width in self.COLUMNS:
+            self.tree.heading(name, text=title)
+            self.tree.column(name, width=width, minwidth=30, anchor=tk.E if name not in ("time", "role") else tk.W)
+        self.tree.pack(fill=tk.X)
+        self.rows = rows
+
+    @staticmethod
+    def _ms(seconds):
+        return "-" if seconds is None else (f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s")
+
+    def show(self, timings):
+        """显示最近的请求（timings为按时间顺序的计时字典）"""
+        self.tree.delete(*self.tree.get_children())
+        for timing in list(timings)[-self.rows:][::-1]:
+            self.tree.insert("", tk.END, values=(
+                timing.get("time", ""), timing.get("role", ""),
+                self._ms(timing.get("connect")), self._ms(timing.get("headers")),
+                self._ms(timing.get("first_token")), self._ms(timing.get("total")),
+                timing.get("chunks", 0), f"{timing.get('bytes', 0) / 1024:.1f}",
+                self._ms(timing.get("parse")), self._ms(timing.get("render_delay_avg")),
+                self._ms((timing.get("gaps") or {}).get("max"))
+            ))
+
+
+class StackSampler:
+    """采样式CPU分析：后台线程定时采样所有线程的调用栈
+
+    cProfile只能分析调用enable()的线程（界面线程），采样覆盖请求、日志等工作线程；
+    结果为折叠栈格式（每行"线程;外层函数;...;内层函数 次数"），可直接交给flamegraph.pl或speedscope。
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="StackSampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(1.0)
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            if self.samples % 100 == 0:
+                names = {thread.ident: thread.name.replace(";", ",") for thread in threading.enumerate()}
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+class Diagnostics:
+    """运行时诊断（不需要重启）：CPU分析、内存快照和线程调用栈，结果写入output_dir
+
+    CPU分析的开始和停止需在同一个线程（界面线程）中调用。
+    """
+
+    def __init__(self, output_dir="diagnostics"):
+        self.output_dir = output_dir
+        self.profiler = None
+        self.sampler = None
+        self.profile_started = None
+        self.last_snapshot = None
+        self.signal_file = None
+
+    @property
+    def profiling(self):
+        return self.profiler is not None
+
+    def output_path(self, prefix, ext):
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}")
+
+    def start_profile(self):
+        """开始CPU分析：当前线程用cProfile，所有线程用调用栈采样"""
+        if self.profiling:
+            return
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.profile_started = time.time()
+        self.sampler.start()
+        self.profiler.enable()
+
+    def stop_profile(self):
+        """停止CPU分析并写出 .pstats（snakeviz等工具可打开）、.txt摘要和 .folded折叠栈，返回(文件列表, 摘要)"""
+        if not self.profiling:
+            return [], ""
+        profiler, sampler = self.profiler, self.sampler
+        profiler.disable()
+        sampler.stop()
+        self.profiler = self.sampler = None
+
+        pstats_path = self.output_path("profile", "pstats")
+        base = pstats_path[:-len(".pstats")]
+        profiler.dump_stats(pstats_path)
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(40)
+        summary = (f"分析时长 {time.time() - self.profile_started:.1f}s，"
+                   f"界面线程cProfile + 全部线程调用栈采样 {sampler.samples} 次\n{stream.getvalue()}")
+        atomic_write_text(base + ".txt", summary)
+        atomic_write_text(base + ".folded", sampler.folded())
+        return [pstats_path, base + ".txt", base + ".folded"], summary
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start_tracemalloc(self, frames=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.last_snapshot = None
+
+    def stop_tracemalloc(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.last_snapshot = None
+
+    def memory_snapshot(self, limit=15):
+        """内存快照：分配最多的代码行，以及与上次快照相比增长最多的代码行（未开始跟踪时先开始）"""
+        if not tracemalloc.is_tracing():
+            self.start_tracemalloc()
+            return "已开始内存跟踪，之后的分配才会被记录；稍后再次快照即可查看。\n"
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"已跟踪内存: 当前 {current / 1048576:.1f}MB，峰值 {peak / 1048576:.1f}MB", "",
+                 f"分配最多的代码行（前{limit}）:"]
+        for stat in snapshot.statistics("lineno")[:limit]:
+            lines.append(f"  {stat.size / 1024:10.1f}KB {stat.count:8}个  {stat.traceback[0]}")
+
+        if self.last_snapshot is not None:
+            lines += ["", f"与上次快照相比增长最多的代码行（前{limit}）:"]
+            for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:limit]:
+                lines.append(f"  {stat.size_diff / 1024:+10.1f}KB {stat.count_diff:+8}个  {stat.traceback[0]}")
+        self.last_snapshot = snapshot
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def thread_stacks():
+        """所有线程当前的调用栈"""
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        parts = []
+        for ident, frame in sys._current_frames().items():
+            thread = threads.get(ident)
+            name = thread.name if thread else "未知线程"
+            daemon = "，守护线程" if thread is not None and thread.daemon else ""
+            parts.append(f"线程 {name}（ident={ident}{daemon}）\n" + "".join(traceback.format_stack(frame)))
+        return "\n".join(parts)
+
+    def enable_signal_dump(self):
+        """收到SIGUSR1时把所有线程的调用栈追加到诊断目录（界面卡死时也能用 kill -USR1 <pid> 取得）"""
+        if not hasattr(signal, "SIGUSR1") or self.signal_file is not None:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, "stacks_signal.log")
+        self.signal_file = open(path, 'a', encoding='utf-8')
+        faulthandler.register(signal.SIGUSR1, file=self.signal_file, all_threads=True)
+        return path
+
+    def finish(self):
+        """退出前写出仍在进行的CPU分析和最后一次内存快照，返回写出的文件"""
+        paths = []
+        if self.profiling:
+            paths += self.stop_profile()[0]
+        if self.tracing:
+            path = self.output_path("memory", "txt")
+            atomic_write_text(path, self.memory_snapshot())
+            paths.append(path)
+        return paths
+
+
+# 主循环卡顿监视：心跳间隔、慢回调阈值（毫秒）
+LAG_HEARTBEAT_MS = 100
+SLOW_CALLBACK_MS = 50
+
+
+def callback_name(func):
+    """Tk回调的可读名称（after()注册的内部闭包显示实际调用的函数）"""
+    if getattr(func, "__qualname__", "").endswith("after.<locals>.callit") and getattr(func, "__closure__", None):
+        for cell in func.__closure__:
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue
+            if callable(value) and not isinstance(value, tk.Misc):
+                func = value
+                break
+    return getattr(func, "__qualname__", None) or getattr(func, "__name__", None) or repr(func)
+
+
+class TkLagMonitor:
+    """Tk主循环卡顿监视
+
+    - 心跳：每interval_ms用after调度一次，实际触发时间与预期时间之差即主循环延迟
+    - 回调计时：替换tkinter.CallWrapper.__call__（after、bind、command、变量trace等所有
+      Tcl到Python的回调都经过它），按回调名称统计次数和耗时
+    - 慢回调：后台线程发现某个回调运行超过阈值的一半时采样主线程调用栈，回调结束后
+      超过阈值则打印名称、耗时和调用栈，并写入API日志（kind为slow_callback）
+    回调中打开模态对话框等嵌套事件循环时（表现为心跳在回调执行期间触发），外层回调的耗时
+    包含等待时间，不计为慢回调；变量trace、validatecommand等同步触发的内层回调不影响外层计时。
+    """
+
+    active = None  # 当前生效的监视器
+    _original_call = None  # tkinter原始的CallWrapper.__call__
+    _installed = False
+
+    def __init__(self, root, interval_ms=LAG_HEARTBEAT_MS, threshold_ms=SLOW_CALLBACK_MS, log_writer=None):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.threshold = threshold_ms / 1000.0
+        self.log_writer = log_writer
+        self.lags = deque(maxlen=max(10, 60000 // interval_ms))  # 最近一分钟的 (时间, 延迟)
+        self.current_lag = 0.0
+        self.stats = {}  # 回调名称 -> [次数, 总耗时, 最大耗时]
+        self.slow_callbacks = deque(maxlen=50)
+        self.running = []  # 正在执行的回调栈：[函数, 开始时间, 是否进入了嵌套事件循环, 采样的调用栈]
+        self.expected = None
+        self.tk_thread_id = None
+        self.stop_event = threading.Event()
+        self.watcher = None
+
+    @classmethod
+    def install(cls):
+        """替换CallWrapper.__call__（对已注册的回调同样生效），stop时由uninstall恢复"""
+        if cls._installed:
+            return
+        if cls._original_call is None:
+            cls._original_call = tk.CallWrapper.__call__
+        original = cls._original_call
+
+        def timed_call(wrapper, *args):
+            monitor = cls.active
+            if monitor is None:
+                return original(wrapper, *args)
+            return monitor.run_callback(wrapper, args)
+
+        tk.CallWrapper.__call__ = timed_call
+        cls._installed = True
+
+    @classmethod
+    def uninstall(cls):
+        """恢复tkinter原始的CallWrapper.__call__"""
+        if cls._installed:
+            tk.CallWrapper.__call__ = cls._original_call
+            cls._installed = False
+
+    def start(self):
+        self.install()
+        TkLagMonitor.active = self
+        self.tk_thread_id = threading.get_ident()
+        self.stop_event.clear()
+        self.watcher = threading.Thread(target=self._watch, name="TkLagMonitor", daemon=True)
+        self.watcher.start()
+        self.expected = time.perf_counter() + self.interval_ms / 1000.0
+        self.root.after(self.interval_ms, self._beat)
+
+    def stop(self):
+        if TkLagMonitor.active is self:
+            TkLagMonitor.active = None
+            self.uninstall()
+        self.stop_event.set()
+
+    def reset(self):
+        """清空统计"""
+        self.stats = {}
+        self.slow_callbacks.clear()
+        self.lags.clear()
+
+    def _beat(self):
+        if TkLagMonitor.active is not self:
+            return
+        # 心跳在其他回调执行期间触发，说明这些回调进入了嵌套事件循环（模态对话框、wait_window等）
+        for entry in self.running[:-1]:
+            entry[2] = True
+        now = time.perf_counter()
+        self.current_lag = max(0.0, now - self.expected)
+        self.lags.append((now, self.current_lag))
+        self.expected = now + self.interval_ms / 1000.0
+        self.root.after(self.interval_ms, self._beat)
+
+    def max_lag(self, seconds=10):
+        """最近seconds秒内的最大延迟"""
+        since = time.perf_counter() - seconds
+        return max((lag for at, lag in self.lags if at >= since), default=0.0)
+
+    def run_callback(self, wrapper, args):
+        entry = [wrapper.func, time.perf_counter(), False, None]
+        self.running.append(entry)
+        try:
+            return TkLagMonitor._original_call(wrapper, *args)
+        finally:
+            self.running.pop()
+            self._record(entry, time.perf_counter() - entry[1])
+
+    def _record(self, entry, duration):
+        name = callback_name(entry[0])
+        if name.startswith(("TkLagMonitor.", "LagOverlay.")):
+            return
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        if entry[2]:
+            # 嵌套了事件循环，耗时包含等待用户操作的时间
+            return
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+
+        if duration >= self.threshold:
+            stack = entry[3] or "（回调结束前未采样到调用栈）\n"
+            self.slow_callbacks.append({"time": datetime.now().strftime("%H:%M:%S"), "name": name,
+                                        "duration": duration, "stack": stack})
+            print(f"慢回调: {name} 耗时 {duration * 1000:.0f}ms\n{stack}", file=sys.stderr)
+            if self.log_writer is not None:
+                self.log_writer.write({
+                    "kind": "slow_callback",
+                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "ts": time.time(),
+                    "name": name,
+                    "duration": round(duration, 4),
+                    "stack": stack
+                })
+
+    def _watch(self):
+        """后台采样：回调运行超过阈值一半时记录主线程当前的调用栈"""
+        period = self.threshold / 4
+        while not self.stop_event.wait(period):
+            try:
+                entry = self.running[-1]
+            except IndexError:
+                continue
+            if entry[3] is None and time.perf_counter() - entry[1] >= self.threshold / 2:
+                frame = sys._current_frames().get(self.tk_thread_id)
+                if frame is not None:
+                    entry[3] = "".join(traceback.format_stack(frame, limit=12))
+
+    def top_callbacks(self, limit=10):
+        """按总耗时排序的回调统计：[(名称, 次数, 总耗时, 最大耗时)]"""
+        rows = [(name, count, total, worst) for name, (count, total, worst) in list(self.stats.items())]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+
+class LagOverlay(tk.Toplevel):
+    """主循环延迟和最耗时回调的小窗口（置顶，每0.5秒刷新）"""
+
+    def __init__(self, parent, monitor):
+        super().__init__(parent)
+        self.monitor = monitor
+        self.title("主循环监视")
+        self.geometry("560x420")
+        self.attributes("-topmost", True)
+
+        self.lag_var = tk.StringVar()
+        ttk.Label(self, textvariable=self.lag_var, font=("Consolas", 10, "bold")).pack(fill=tk.X, padx=8, pady=(8, 4))
+
+        columns = (("name", "回调", 260), ("count", "次数", 60), ("avg", "平均", 70), ("max", "最大", 70),
+                   ("total", "总计", 70))
+        self.tree = ttk.Treeview(self, columns=[name for name, _, _ in columns], show="headings", height=8)
+        for name, title, width in columns:
+            self.tree.heading(name, text=title)
+            self.tree.column(name, width=width, anchor=tk.W if name == "name" else tk.E)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=8)
+
+        ttk.Label(self, text=f"最近的慢回调（>{monitor.threshold * 1000:.0f}ms）:").pack(anchor=tk.W, padx=8, pady=(6, 0))
+        self.slow_text = scrolledtext.ScrolledText(self, height=8, font=("Consolas", 9), wrap=tk.NONE)
+        self.slow_text.pack(fill=tk.BOTH, expand=True, padx=8)
+
+        ttk.Button(self, text="清零", command=self.monitor.reset, width=8).pack(anchor=tk.E, padx=8, pady=6)
+        self.shown_slow = None
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+        monitor = self.monitor
+        self.lag_var.set(f"主循环延迟: 当前 {monitor.current_lag * 1000:.0f}ms | "
+                         f"10秒内最大 {monitor.max_lag(10) * 1000:.0f}ms | "
+                         f"慢回调 {len(monitor.slow_callbacks)} 次")
+
+        self.tree.delete(*self.tree.get_children())
+        for name, count, total, worst in monitor.top_callbacks():
+            self.tree.insert("", tk.END, values=(name, count, f"{total / count * 1000:.1f}ms",
+                                                 f"{worst * 1000:.1f}ms", f"{total * 1000:.0f}ms"))
+
+        last_slow = monitor.slow_callbacks[-1] if monitor.slow_callbacks else None
+        if last_slow is not self.shown_slow:
+            self.shown_slow = last_slow
+            self.slow_text.delete("1.0", tk.END)
+            for slow in list(monitor.slow_callbacks)[-5:][::-1]:
+                self.slow_text.insert(tk.END, f"[{slow['time']}] {slow['name']} {slow['duration'] * 1000:.0f}ms\n"
+                                              f"{slow['stack']}\n")
+        self.after(500, self.refresh)
+
+
+class PendingTab:
+    """尚未加载的已恢复标签页占位
+
+    启动时只为每个标签页创建空的页面框架，真正的标签页在首次显示时才创建并加载历史。
+    """
+
+    def __init__(self, parent, meta):
+        self.parent = parent
+        self.meta = meta
+        self.tab_id = meta["tab_id"]
+
+    def get_token_counts(self):
+        return self.meta.get("prompt_tokens", 0), self.meta.get("completion_tokens", 0)
+
+    def get_role_config(self):
+        return self.meta.get("role_config")
+
+    def get_workspace_meta(self):
+        return self.meta
+
+
+def text_shingles(text, size=4):
+    """将文本切分为字符级shingle集合（对中英文均适用）"""
+    text = re.sub(r'\s+', ' ', text or "").strip().lower()
+    if not text:
+        return set()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard_similarity(shingles_a, shingles_b):
+    """两个shingle集合的Jaccard相似度"""
+    if not shingles_a or not shingles_b:
+        return 0.0
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+
+class ConvergencePolicy:
+    """多角色协同的提前停止策略
+
+    - 相似度：新回复与最近window轮回复的shingle Jaccard相似度超过阈值，
+      且连续patience轮如此时，认为角色间已经在互相重复
+    - 停止词：回复中出现指定的短语/正则
+    - Token预算：本次运行累计token超过上限
+    """
+
+    def __init__(self, similarity_threshold=0.0, window=2, patience=1,
+                 stop_pattern="", max_total_tokens=0):
+        self.similarity_threshold = similarity_threshold
+        self.window = max(1, window)
+        self.patience = max(1, patience)
+        self.max_total_tokens = max_total_tokens
+        self.stop_regex = None
+        if stop_pattern:
+            try:
+                self.stop_regex = re.compile(stop_pattern)
+            except re.error:
+                # 非法正则按普通短语处理
+                self.stop_regex = re.compile(re.escape(stop_pattern))
+
+        self.recent_shingles = []
+        self.similar_turns = 0
+        self.last_similarity = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.similarity_threshold > 0 or self.stop_regex or self.max_total_tokens > 0)
+
+    def check(self, response, total_tokens=0):
+        """检查本轮回复，需要停止时返回停止原因，否则返回None"""
+        if self.stop_regex:
+            match = self.stop_regex.search(response or "")
+            if match:
+                return f"检测到停止词「{match.group(0)}」"
+
+        if self.max_total_tokens > 0 and total_tokens >= self.max_total_tokens:
+            return f"累计Token {total_tokens} 已达到预算 {self.max_total_tokens}"
+
+        if self.similarity_threshold > 0:
+            shingles = text_shingles(response)
+            self.last_similarity = max((jaccard_similarity(shingles, previous)
+                                        for previous in self.recent_shingles), default=0.0)
+            self.recent_shingles.append(shingles)
+            self.recent_shingles = self.recent_shingles[-self.window:]
+
+            if self.last_similarity >= self.similarity_threshold:
+                self.similar_turns += 1
+            else:
+                self.similar_turns = 0
+
+            if self.similar_turns >= self.patience:
+                return (f"回复已趋于重复（相似度 {self.last_similarity:.2f} ≥ {self.similarity_threshold:.2f}，"
+                        f"连续{self.similar_turns}轮）")
+
+        return None
+
+
+# 默认的全局接口地址
+DEFAULT_BASE_URL = "https://api.deepseek.com/v1/chat/completions"
+
+
+class ApiSettings:
+    """发起请求时使用的全局接口设置（界面在主线程读取后传给引擎，命令行由参数构造）"""
+
+    def __init__(self, api_key="", base_url=DEFAULT_BASE_URL, timeout=60, stream=True):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.stream = stream
+
+
+def build_chat_request(role_config, messages, stream=True):
+    """按角色配置构建聊天请求体"""
+    data = {
+        "model": resolve_model(role_config),
+        "messages": messages,
+        "temperature": role_config.get("temperature", 0.7),
+        "max_tokens": role_config.get("max_tokens", 2000),
+        "stream": stream
+    }
+    if stream:
+        data["stream_options"] = STREAM_OPTIONS
+
+    # 添加深度思考参数
+    if role_config.get("deep_thought", False):
+        data["deep_thought"] = True
+        del data["max_tokens"]
+    return data
+
+
+def stream_chat(route, data, timeout, cancel_token, emit, on_progress=None):
+    """通过路由发送流式请求并逐块解析（整个流读取期间占用该路由的并发槽位，取消时立即中断读取）
+
+    正文和思考内容通过emit逐条产出，on_progress(meter)在需要刷新token统计时调用（已节流）。
+    返回结果字典：status_code、meter、timer，成功时另有content、reasoning_content、usage，失败时为error；
+    等待密钥额度时被停止（请求没有发出）时status_code为None、cancelled为True，调用方不应记录历史和日志。
+    """
+    timer = RequestTimer()
+    meter = StreamTokenMeter(data.get("messages"))
+    try:
+        key_state = route.acquire_key(data, cancel_token)
+    except RequestCancelled:
+        timer.finish()
+        return {"status_code": None, "cancelled": True, "meter": meter, "timer": timer}
+    with route.open_stream(data, timeout=timeout, cancel_token=cancel_token, key_state=key_state) as response:
+        timer.mark_headers(response)
+        if response.status_code != 200:
+            timer.finish()
+            return {"status_code": response.status_code, "error": response.text, "meter": meter, "timer": timer}
+
+        content_parts = []
+        reasoning_parts = []
+        for data_json in iter_sse_json(response, cancel_token.is_cancelled, timer):
+            choices = data_json.get('choices') or []
+            if choices:
+                delta = choices[0].get('delta') or {}
+                # 深度思考内容走独立通道，不计入对话上下文
+                reasoning = delta.get('reasoning_content')
+                if reasoning:
+                    timer.mark_first_token()
+                    reasoning_parts.append(reasoning)
+                    meter.feed_reasoning(reasoning)
+                    emit(("reasoning", reasoning))
+
+                content = delta.get('content')
+                if content:
+                    timer.mark_first_token()
+                    was_reasoning = meter.is_reasoning
+                    meter.feed(content)
+                    if was_reasoning:
+                        # 正文开始，结束并折叠思考区域
+                        emit(("reasoning_end", meter.reasoning_summary()))
+                    content_parts.append(content)
+                    # 带入队时间，用于统计显示延迟
+                    emit(timer.timed_text(content))
+
+            # usage在最后一个数据块中返回（此时choices为空）
+            if data_json.get('usage'):
+                meter.set_usage(data_json['usage'])
+
+            # 实时刷新估算的token和生成速度
+            if on_progress and meter.should_refresh():
+                on_progress(meter)
+        timer.finish()
+
+    route.record_latency(timer.first_token, timer.total)
+    route.record_usage(response, meter.prompt_tokens, meter.completion_tokens)
+
+    # 只有思考没有正文（如被中途停止）时也要结束思考区域
+    if meter.is_reasoning:
+        emit(("reasoning_end", meter.reasoning_summary()))
+
+    return {"status_code": 200, "content": "".join(content_parts), "reasoning_content": "".join(reasoning_parts),
+            "usage": meter.usage or {}, "meter": meter, "timer": timer}
+
+
+def complete_chat(route, data, timeout, cancel_token=None):
+    """通过路由发送非流式请求，返回结果字典：status_code、timer，成功时另有content、
+    reasoning_content、usage、reasoning_tokens，失败时为error；
+    等待密钥额度时被cancel_token停止（请求没有发出）时status_code为None、cancelled为True"""
+    # 以流方式读取正文，以便在连接归还连接池前取得建连耗时
+    timer = RequestTimer()
+    try:
+        key_state = route.acquire_key(data, cancel_token)
+    except RequestCancelled:
+        timer.finish()
+        return {"status_code": None, "cancelled": True, "timer": timer}
+    with route.slot():
+        response = route.post(data, timeout=timeout, stream=True, key_state=key_state)
+        timer.mark_headers(response)
+        try:
+            body = response.content
+        finally:
+            release_response(response)
+    timer.add_bytes(len(body))
+    timer.finish()
+    route.record_latency(None, timer.total)
+
+    if response.status_code != 200:
+        return {"status_code": response.status_code, "error": response.text, "timer": timer}
+
+    parse_started = time.perf_counter()
+    result = response.json()
+    timer.add_parse(time.perf_counter() - parse_started)
+    timer.on_chunk()
+
+    message = result["choices"][0]["message"]
+    usage = result.get("usage") or {}
+    route.record_usage(response, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    return {"status_code": 200, "content": message["content"],
+            "reasoning_content": message.get("reasoning_content") or "", "usage": usage,
+            "reasoning_tokens": (usage.get("completion_tokens_details") or {}).get("reasoning_tokens", 0),
+            "timer": timer}
+
+
+class ChatEngineBase:
+    """对话引擎公共部分：事件输出、Token统计和API日志，不依赖界面
+
+    emit(item)接收的事件与标签页响应队列的格式相同：
+    - 字符串：直接显示的提示文本
+    - ("text", (正文, timer, 入队时间))：模型输出的正文，显示后调用timer.on_render
+    - ("reasoning", 文本) / ("reasoning_end", 统计)：深度思考内容
+    - ("status", 文本)：生成过程中的token和速度
+    - ("log", 日志)：一次请求结束，显示完成后交给write_log写入
+    """
+
+    tab_type = None
+
+    def __init__(self, tab_id, api_router=None, log_sink=None, emit=None, on_token_update=None):
+        self.tab_id = tab_id
+        self.api_router = api_router or ApiRouter()
+        self.log_sink = log_sink  # 有write(record)方法的日志输出（如ApiLogWriter），为None时不记录
+        self.emit = emit or (lambda item: None)
+        self.on_token_update = on_token_update
+        self.run_id = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.token_lock = threading.Lock()  # 多个线程可能同时计数（并发请求、后台压缩）
+
+    def add_tokens(self, prompt_delta, completion_delta):
+        """计入token增量并通知（可在任意线程调用）"""
+        if not prompt_delta and not completion_delta:
+            return
+        with self.token_lock:
+            self.prompt_tokens += prompt_delta
+            self.completion_tokens += completion_delta
+        if self.on_token_update:
+            self.on_token_update(prompt_delta, completion_delta)
+
+    def apply_token_delta(self, meter):
+        """将计量器的token增量计入统计"""
+        self.add_tokens(*meter.take_delta())
+
+    def new_log_entry(self, route, data, **fields):
+        """一次请求的日志（响应和计时在请求结束后补全）"""
+        log_entry = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "ts": time.time(),
+            "run_id": self.run_id
+        }
+        log_entry.update(fields)
+        log_entry["route"] = route.name
+        log_entry["request"] = {
+            "url": route.base_url,
+            "headers": {"Authorization": route.masked_key()},
+            "data": data
+        }
+        return log_entry
+
+    def finish_log(self, log_entry, response, timer):
+        """补全响应并通过emit交给界面（界面显示完本次内容后再写日志，以便记录显示延迟）"""
+        log_entry["response"] = response
+        log_entry["timer"] = timer
+        self.emit(("log", log_entry))
+
+    def write_log(self, log_entry):
+        """补全计时后提交API日志，返回计时摘要"""
+        timer = log_entry.pop("timer", None)
+        timing = timer.summary() if timer is not None else None
+        if timing is not None:
+            log_entry["response"]["timing"] = timing
+        if self.log_sink is not None:
+            self.log_sink.write({
+                "kind": "api",
+                "timestamp": log_entry['timestamp'],
+                "ts": log_entry.get('ts'),
+                "run_id": log_entry.get('run_id'),
+                "tab_id": self.tab_id,
+                "tab_type": self.tab_type,
+                "turn": log_entry.get('turn'),
+                "role_name": log_entry['role_name'],
+                "role_index": log_entry.get('role_index', 0),
+                "iteration": log_entry.get('iteration', 0),
+                "route": log_entry.get('route'),
+                "request": log_entry['request'],
+                "response": log_entry.get('response', {})
+            })
+        return timing
+
+    @staticmethod
+    def stream_response_log(result, cancel_token):
+        """流式请求成功时写入日志的响应部分（被停止时记录已收到的部分内容和停止耗时）"""
+        meter = result["meter"]
+        response = {
+            "status_code": result["status_code"],
+            "content": result["content"],
+            "reasoning_content": result["reasoning_content"],
+            "usage": result["usage"],
+            "token_meter": meter.summary(),
+            "reasoning": meter.reasoning_summary(),
+            "cancelled": cancel_token.cancelled
+        }
+        if cancel_token.cancelled:
+            response["stop_latency"] = round(cancel_token.stop_latency(), 4)
+        return response
+
+
+def empty_memory():
+    """未压缩任何历史时的记忆：summary为摘要，covered为已摘要的历史条数，另记摘要消耗的token"""
+    return {"summary": "", "covered": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+
+class ChatSessionEngine(ChatEngineBase):
+    """单角色会话引擎：维护对话历史，构建上下文并调用API
+
+    角色启用记忆压缩（memory）时，未摘要的历史超过阈值后在后台线程把较早的一段合并进滚动摘要，
+    之后的请求以"系统提示 + 摘要"为固定前缀、只附带摘要之后的历史，输入长度保持有界。
+    """
+
+    tab_type = "session"
+    CONTEXT_MESSAGES = 10  # 随请求发送的最近历史消息数
+    MEMORY_TRIGGER_TOKENS = 3000  # 未摘要的历史估算超过该token数时开始压缩，也是随请求发送的历史的上限
+    MEMORY_TRIGGER_MESSAGES = 8  # 或未摘要的历史超过该条数时开始压缩（小于CONTEXT_MESSAGES，压缩期间不会截断）
+    MEMORY_KEEP_MESSAGES = 4  # 压缩时保留原文的最近消息数
+    MEMORY_MAX_TOKENS = 800  # 摘要的最大输出token数
+    MEMORY_PROMPT = ("你负责维护一段对话的记忆摘要。根据已有摘要和新增的对话，输出更新后的完整摘要："
+                     "保留用户的身份、偏好、约定、已确认的事实和结论以及未完成的事项，删去寒暄和重复内容，"
+                     "使用简洁的条目，只输出摘要本身。")
+    MEMORY_PREFIX = "以下是此前对话的摘要，请在回答时参考：\n"
+
+    def __init__(self, tab_id, api_router=None, log_sink=None, emit=None, on_token_update=None,
+                 on_history_entry=None, on_memory_update=None):
+        super().__init__(tab_id, api_router, log_sink, emit, on_token_update)
+        self.on_history_entry = on_history_entry  # 追加历史时调用（用于会话持久化）
+        self.on_memory_update = on_memory_update  # 摘要更新后调用on_memory_update(memory)（用于会话持久化）
+        self.history = []
+        self.memory = empty_memory()  # 每次更新整体替换，构建请求时无需加锁
+        self.memory_thread = None  # 正在进行的压缩
+        self.memory_cancel = CancelToken()  # 清空历史时停止正在等待密钥额度的压缩
+        self.run_id = new_run_id(tab_id)  # 会话ID，清空历史时重新生成
+
+    def clear(self):
+        """清空历史、记忆和Token统计，开始新的会话ID（进行中的压缩结果会被丢弃）"""
+        self.history = []
+        self.memory = empty_memory()
+        self.memory_cancel.cancel()
+        self.run_id = new_run_id(self.tab_id)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add_history_entry(self, entry):
+        self.history.append(entry)
+        if self.on_history_entry:
+            self.on_history_entry(entry)
+
+    def build_messages(self, role_config, user_input):
+        """构建消息列表：系统提示 + 最近的历史 + 当前输入"""
+        messages = []
+
+        # 添加系统提示
+        system_prompt = role_config.get("system_prompt")
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+
+        # 添加上下文历史（思考内容单独保存，不会发回）
+        if role_config.get("memory"):
+            # 摘要紧跟系统提示，两次压缩之间请求前缀保持不变；摘要之后的历史与未启用时一样最多
+            # CONTEXT_MESSAGES条，压缩进行中或失败时再按估算token截断（最近一轮始终保留）
+            memory = self.memory
+            if memory["summary"]:
+                messages.append({"role": "system", "content": self.MEMORY_PREFIX + memory["summary"]})
+            recent = self.history[memory["covered"]:][-self.CONTEXT_MESSAGES:]
+            while len(recent) > 2 and estimate_messages_tokens(recent) > self.MEMORY_TRIGGER_TOKENS:
+                recent = recent[2:]
+        else:
+            recent = self.history[-self.CONTEXT_MESSAGES:]
+        for entry in recent:
+            role = "user" if entry["role"] == "user" else "assistant"
+            messages.append({"role": role, "content": entry["content"]})
+
+        # 添加当前用户输入
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    def send(self, user_input, role_config, settings, cancel_token=None):
+        """发送一条用户消息并记录历史，返回模型回复，失败时返回None"""
+        cancel_token = cancel_token or CancelToken()
+        try:
+            messages = self.build_messages(role_config, user_input)
+            route = self.api_router.resolve(role_config, settings.base_url, settings.api_key)
+            data = build_chat_request(role_config, messages, stream=settings.stream)
+            log_entry = self.new_log_entry(route, data, turn=len(self.history) // 2 + 1,
+                                           role_name=role_config.get("name", ""))
+            if settings.stream:
+                content = self._send_stream(route, data, settings.timeout, cancel_token, user_input, log_entry)
+            else:
+                content = self._send_normal(route, data, settings.timeout, cancel_token, user_input, log_entry)
+        except Exception as e:
+            self.emit(f"API调用失败: {str(e)}\n\n")
+            return None
+        if content is not None and role_config.get("memory"):
+            self.start_compaction(role_config, settings)
+        return content
+
+    def needs_compaction(self):
+        """未摘要的历史（不含要保留原文的最近消息）是否超过阈值"""
+        pending = self.history[self.memory["covered"]:]
+        if len(pending) <= self.MEMORY_KEEP_MESSAGES:
+            return False
+        return (len(pending) > self.MEMORY_TRIGGER_MESSAGES
+                or estimate_messages_tokens(pending) > self.MEMORY_TRIGGER_TOKENS)
+
+    def start_compaction(self, role_config, settings):
+        """需要时在后台线程压缩较早的历史（同一时间只进行一次），返回是否启动"""
+        if (self.memory_thread is not None and self.memory_thread.is_alive()) or not self.needs_compaction():
+            return False
+        self.memory_cancel = CancelToken()
+        self.memory_thread = threading.Thread(target=self.compact_memory,
+                                              args=(role_config, settings, self.memory_cancel),
+                                              name=f"Memory-{self.tab_id}", daemon=True)
+        self.memory_thread.start()
+        return True
+
+    def wait_for_compaction(self, timeout=None):
+        """等待进行中的压缩结束（命令行退出前调用）"""
+        if self.memory_thread is not None:
+            self.memory_thread.join(timeout)
+
+    def memory_role_config(self, role_config):
+        """摘要使用的配置：与角色相同的接口，模型为memory_model（默认为非思考模型），较低温度"""
+        return {
+            "name": f"{role_config.get('name', '')}（记忆摘要）",
+            "model": (role_config.get("memory_model") or "").strip() or DEFAULT_CHAT_MODEL,
+            "temperature": 0.3,
+            "max_tokens": self.MEMORY_MAX_TOKENS,
+            "base_url": role_config.get("base_url", ""),
+            "api_profile": role_config.get("api_profile", "")
+        }
+
+    def compact_memory(self, role_config, settings, cancel_token=None):
+        """把已有摘要和较早的一段历史合并为新的摘要（后台线程），返回是否成功"""
+        run_id = self.run_id
+        memory = self.memory
+        end = len(self.history) - self.MEMORY_KEEP_MESSAGES
+        block = self.history[memory["covered"]:end]
+        if not block:
+            return False
+
+        lines = [f"{'用户' if entry['role'] == 'user' else 'AI'}: {entry['content']}" for entry in block]
+        request = (f"已有摘要：\n{memory['summary'] or '（无）'}\n\n新增的对话：\n" + "\n\n".join(lines)
+                   + "\n\n请输出更新后的摘要。")
+        messages = [{"role": "system", "content": self.MEMORY_PROMPT}, {"role": "user", "content": request}]
+        summary_config = self.memory_role_config(role_config)
+        try:
+            route = self.api_router.resolve(summary_config, settings.base_url, settings.api_key)
+            data = build_chat_request(summary_config, messages, stream=False)
+            log_entry = self.new_log_entry(route, data, role_name=summary_config["name"])
+            result = complete_chat(route, data, settings.timeout, cancel_token)
+        except Exception as e:
+            print(f"记忆压缩失败: {e}")
+            return False
+        if result.get("cancelled"):
+            return False  # 等待密钥额度时历史被清空，请求没有发出
+
+        if result["status_code"] != 200:
+            log_entry["response"] = {"status_code": result["status_code"], "error": result["error"]}
+        else:
+            log_entry["response"] = {"status_code": 200, "content": result["content"], "usage": result["usage"]}
+        log_entry["timer"] = result["timer"]
+        self.write_log(log_entry)
+        if result["status_code"] != 200:
+            print(f"记忆压缩失败: API错误 {result['status_code']}")
+            return False
+        if self.run_id != run_id:
+            return False  # 压缩期间历史已被清空
+
+        prompt_delta = result["usage"].get("prompt_tokens", 0)
+        completion_delta = result["usage"].get("completion_tokens", 0)
+        self.memory = {
+            "summary": result["content"].strip(),
+            "covered": end,
+            "prompt_tokens": memory["prompt_tokens"] + prompt_delta,
+            "completion_tokens": memory["completion_tokens"] + completion_delta
+        }
+        self.add_tokens(prompt_delta, completion_delta)
+        if self.on_memory_update:
+            self.on_memory_update(self.memory)
+        self.emit(("memory", self.memory))
+        return True
+
+    def _record_turn(self, user_input, content, **assistant_fields):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.add_history_entry({"role": "user", "content": user_input, "timestamp": timestamp})
+        self.add_history_entry(dict({"role": "assistant", "content": content, "timestamp": timestamp},
+                                    **assistant_fields))
+
+    def _on_stream_progress(self, meter):
+        self.apply_token_delta(meter)
+        self.emit(("status", meter.status_text()))
+
+    def _send_stream(self, route, data, timeout, cancel_token, user_input, log_entry):
+        self.emit("AI: ")
+        result = stream_chat(route, data, timeout, cancel_token, self.emit, self._on_stream_progress)
+        if result.get("cancelled"):
+            # 请求没有发出：不记录这一轮，也不写日志
+            self.emit("[已停止]\n\n")
+            return None
+        if result["status_code"] != 200:
+            self.emit(f"API错误: {result['status_code']}\n\n")
+            self.finish_log(log_entry, {"status_code": result["status_code"], "error": result["error"]},
+                            result["timer"])
+            return None
+
+        if cancel_token.cancelled:
+            self.emit("\n[已停止]")
+        self.emit("\n\n")
+
+        meter = result["meter"]
+        self._record_turn(user_input, result["content"], reasoning_content=result["reasoning_content"],
+                          **meter.reasoning_summary())
+        self.finish_log(log_entry, self.stream_response_log(result, cancel_token), result["timer"])
+
+        # 以真实usage校正估算值（usage未到达时保留估算值）
+        self.apply_token_delta(meter)
+        return result["content"]
+
+    def _send_normal(self, route, data, timeout, cancel_token, user_input, log_entry):
+        result = complete_chat(route, data, timeout, cancel_token)
+        if result.get("cancelled"):
+            # 请求没有发出：不记录这一轮，也不写日志
+            self.emit("[已停止]\n\n")
+            return None
+        if result["status_code"] != 200:
+            self.emit(f"API错误: {result['status_code']}\n\n")
+            self.finish_log(log_entry, {"status_code": result["status_code"], "error": result["error"]},
+                            result["timer"])
+            return None
+
+        # 显示AI响应（思考过程单独渲染为可折叠区域）
+        self.emit("AI: ")
+        if result["reasoning_content"]:
+            self.emit(("reasoning", result["reasoning_content"]))
+            self.emit(("reasoning_end", None))
+        self.emit(result["timer"].timed_text(f"{result['content']}\n\n"))
+
+        self._record_turn(user_input, result["content"], reasoning_content=result["reasoning_content"],
+                          reasoning_tokens=result["reasoning_tokens"])
+        self.finish_log(log_entry, {
+            "status_code": result["status_code"],
+            "content": result["content"],
+            "reasoning_content": result["reasoning_content"],
+            "usage": result["usage"],
+            "reasoning": {"reasoning_tokens": result["reasoning_tokens"]}
+        }, result["timer"])
+
+        self.add_tokens(result["usage"].get('prompt_tokens', 0), result["usage"].get('completion_tokens', 0))
+        return result["content"]
+
+
+class MultiRolePipelineEngine(ChatEngineBase):
+    """多角色协同引擎：各角色按顺序接力发言（上一个角色的回复 + 连接词作为提问），支持提前停止
+
+    config与多角色标签页"保存配置"的JSON相同：ordered_roles、connections、iteration_count、
+    initial_prompt、keep_mind、connect_end_to_start以及提前停止设置。
+    """
+
+    tab_type = "optimized_multi_role"
+    DEFAULT_INITIAL_PROMPT = "请开始你们的对话"
+    TURN_PAUSE = 1.0  # 两个角色发言之间的停顿秒数（回放磁带时随--cassette-time-scale缩放）
+
+    def __init__(self, tab_id, api_router=None, log_sink=None, emit=None, on_token_update=None,
+                 on_turn=None, on_progress=None):
+        super().__init__(tab_id, api_router, log_sink, emit, on_token_update)
+        self.on_turn = on_turn  # 每完成一轮调用on_turn(压缩后的记录)，用于会话持久化
+        self.on_progress = on_progress  # 进度变化时调用
+        self.config = {}
+        self.history = DialogTurnStore()  # 对话历史记录（较早的轮次溢出到临时文件）
+
+        # 运行状态
+        self.current_role_index = 0
+        self.current_iteration = 0
+        self.is_running = False
+        self.stop_requested = False
+        self.stop_reason = None  # 提前停止原因
+        self.cancel_token = CancelToken()  # 本次运行的取消令牌，停止时立即中断正在进行的请求
+        self.convergence_policy = None
+        self.run_start_tokens = 0  # 本次运行开始时的Token总数
+        self.run_started_at = None
+        self.last_turn_metrics = {}  # 最近一次调用的思考统计
+        self.used_routes = {}  # 使用过的路由，用于显示各路由延迟
+
+    @property
+    def ordered_roles(self):
+        return self.config.get("ordered_roles", [])
+
+    @property
+    def iteration_count(self):
+        return self.config.get("iteration_count", 3)
+
+    @property
+    def initial_prompt(self):
+        return (self.config.get("initial_prompt") or "").strip() or self.DEFAULT_INITIAL_PROMPT
+
+    def get_connector(self, from_id, to_id):
+        """获取两个角色之间的连接词"""
+        for conn in self.config.get("connections", []):
+            if conn["from"] == from_id and conn["to"] == to_id:
+                return conn["connector"]
+        return "，"  # 默认连接词
+
+    def prepare(self, config):
+        """开始新的运行：校验配置并重置运行状态和对话记录（在启动运行线程之前调用）"""
+        if len(config.get("ordered_roles", [])) < 2:
+            raise ValueError("请至少选择2个角色")
+
+        # 提前停止策略（相似度比较窗口覆盖一整轮角色，以发现角色间的互相重复）
+        convergence_policy = ConvergencePolicy(
+            similarity_threshold=config.get("similarity_threshold", 0.85) if config.get("early_stop") else 0.0,
+            window=len(config["ordered_roles"]),
+            stop_pattern=(config.get("stop_pattern") or "").strip(),
+            max_total_tokens=config.get("max_run_tokens", 0)
+        )
+
+        self.config = config
+        self.convergence_policy = convergence_policy
+        self.current_role_index = 0
+        self.current_iteration = 0
+        self.is_running = True
+        self.stop_requested = False
+        self.cancel_token = CancelToken()
+        self.stop_reason = None
+        self.run_id = new_run_id(self.tab_id)
+        self.run_start_tokens = self.prompt_tokens + self.completion_tokens
+        self.run_started_at = datetime.now()
+        self.history.clear()
+
+    def stop(self):
+        """请求停止并立即中断正在进行的请求"""
+        if self.is_running:
+            self.stop_requested = True
+            self.cancel_token.cancel()
+
+    def progress(self):
+        if self.on_progress:
+            self.on_progress()
+
+    def run(self, settings):
+        """运行对话循环（阻塞直到结束，流式输出通过emit产出），返回结束原因"""
+        try:
+            initial_prompt = self.initial_prompt
+
+            # 记录初始信息
+            self.emit("=" * 60 + "\n")
+            self.emit(f"多角色协同开始（优化版）\n")
+
+            # 显示角色顺序
+            role_names = [role_info["role"]["name"] for role_info in self.ordered_roles]
+            self.emit(f"角色顺序: {' → '.join(role_names)}\n")
+
+            self.emit(f"首尾相连: {'是' if self.config.get('connect_end_to_start') else '否'}\n")
+
+            self.emit(f"循环次数: {self.iteration_count}\n")
+            if self.convergence_policy and self.convergence_policy.enabled:
+                self.emit("提前停止: 已启用\n")
+            self.emit(f"初始提示: {initial_prompt}\n")
+            self.emit("=" * 60 + "\n\n")
+
+            # 开始对话循环
+            last_response = initial_prompt
+
+            for iteration in range(self.iteration_count):
+                if self.stop_requested:
+                    break
+
+                self.current_iteration = iteration + 1
+                self.progress()
+
+                # 记录迭代开始
+                self.emit(f"\n{'=' * 40}\n")
+                self.emit(f"第 {self.current_iteration} 轮对话\n")
+                self.emit(f"{'=' * 40}\n\n")
+
+                # 每个角色依次发言
+                for role_index, role_info in enumerate(self.ordered_roles):
+                    if self.stop_requested:
+                        break
+
+                    self.current_role_index = role_index
+                    self.progress()
+
+                    role_config = role_info["role"]
+                    role_id = role_info["id"]
+
+                    next_index = (role_index + 1) % len(self.ordered_roles)
+                    next_role_id = self.ordered_roles[next_index]["id"]
+
+                    # 显示当前角色
+                    self.emit(f"【{role_config['name']}】\n")
+
+                    # 构建消息（将上一个角色的回复+连接词作为提问）
+                    messages = self.build_messages_for_role(role_config, role_id, next_role_id,
+                                                            last_response, iteration, role_index)
+
+                    # 调用API（流式输出）
+                    self.last_turn_metrics = {}
+                    response = self.call_role(role_config, messages, settings)
+
+                    if response:
+                        # 更新最后响应（只传递正文，思考内容不进入后续上下文）
+                        last_response = response
+
+                        # 记录对话
+                        dialog_entry = {
+                            "iteration": self.current_iteration,
+                            "role_index": role_index,
+                            "role_name": role_config["name"],
+                            "message": messages[-1]["content"] if messages else "",
+                            "response": response,
+                            "timestamp": datetime.now().strftime("%H:%M:%S")
+                        }
+                        dialog_entry.update(self.last_turn_metrics)
+
+                        # 检查是否满足提前停止条件
+                        if self.convergence_policy and self.convergence_policy.enabled:
+                            run_tokens = self.prompt_tokens + self.completion_tokens - self.run_start_tokens
+                            self.stop_reason = self.convergence_policy.check(response, run_tokens)
+                            dialog_entry["similarity"] = round(self.convergence_policy.last_similarity, 3)
+
+                        # 会话日志中也只记录压缩后的提问
+                        stored_entry = self.history.append(dialog_entry)
+                        if self.on_turn:
+                            self.on_turn(stored_entry)
+
+                        # 添加换行
+                        self.emit("\n\n")
+
+                        if self.stop_reason:
+                            break
+
+                        # 短暂暂停，让对话更自然（停止时立即结束等待）
+                        if not self.stop_requested and self.TURN_PAUSE > 0:
+                            self.cancel_token.wait(self.TURN_PAUSE)
+                    elif self.stop_requested:
+                        # 停止时本轮还没有收到正文，不是调用失败
+                        break
+                    else:
+                        # API调用失败（运行日志和命令行不应记为完成）
+                        self.stop_reason = "API调用失败"
+                        self.emit("API调用失败\n\n")
+                        break
+
+                # 检查是否应该停止
+                if self.stop_requested or self.stop_reason:
+                    break
+
+            # 对话结束
+            self.emit("\n" + "=" * 60 + "\n")
+            self.emit(f"对话{'已停止' if self.stop_requested else '完成'}\n")
+            if self.stop_reason:
+                self.emit(f"提前结束原因: {self.stop_reason}\n")
+            reasoning_report = self.build_reasoning_report()
+            if reasoning_report:
+                self.emit(reasoning_report)
+            self.emit("=" * 60 + "\n")
+
+        except Exception as e:
+            self.stop_reason = self.stop_reason or f"发生错误: {e}"
+            self.emit(f"\n发生错误: {str(e)}\n")
+        finally:
+            end_reason = self.save_run_log()
+            self.is_running = False
+        return end_reason
+
+    def build_reasoning_report(self):
+        """按角色汇总深度思考统计（思考耗时、首个正文token耗时、思考token数）"""
+        stats = {}
+        for entry in self.history:
+            if not entry.get("reasoning_seconds"):
+                continue
+            role_stats = stats.setdefault(entry["role_name"], {"turns": 0, "seconds": 0.0,
+                                                               "ttfa": 0.0, "tokens": 0})
+            role_stats["turns"] += 1
+            role_stats["seconds"] += entry["reasoning_seconds"]
+            role_stats["ttfa"] += entry.get("time_to_first_answer") or 0.0
+            role_stats["tokens"] += entry.get("reasoning_tokens", 0)
+
+        if not stats:
+            return ""
+
+        lines = ["深度思考统计（平均每轮）:"]
+        for role_name, role_stats in stats.items():
+            turns = role_stats["turns"]
+            lines.append(f"  {role_name}: 思考 {role_stats['seconds'] / turns:.1f}s, "
+                         f"首个正文 {role_stats['ttfa'] / turns:.1f}s, "
+                         f"思考 {role_stats['tokens'] // turns} tokens（共{turns}轮）")
+        return "\n".join(lines) + "\n"
+
+    def build_messages_for_role(self, role_config, role_id, next_role_id, last_response, iteration, role_index):
+        """为角色构建消息列表（将上一个角色的回复+连接词作为提问）"""
+        messages = []
+
+        # 添加系统提示
+        messages.append({"role": "system", "content": role_config["system_prompt"]})
+
+        # 如果是第一轮第一个角色，使用初始提示
+        if iteration == 0 and role_index == 0:
+            messages.append({"role": "user", "content": self.initial_prompt})
+        else:
+            # 获取连接词
+            connector = self.get_connector(role_id, next_role_id)
+            # 构建提问：连接词 + 上一个角色的回复
+            prompt = f"{last_response}{connector}"
+            if self.config.get("keep_mind") and role_index == 0:
+                # 保持初衷，加入初始提示
+                prompt += f"\n别忘记我们的初衷是\n{self.initial_prompt}"
+            messages.append({"role": "user", "content": prompt})
+
+        return messages
+
+    def call_role(self, role_config, messages, settings):
+        """为角色调用API（流式输出），返回回复正文，失败时返回None"""
+        try:
+            if not self.api_router.has_key(role_config, settings.api_key):
+                return None
+
+            # 按角色配置选择路由（端点、API Key、连接池）
+            route = self.api_router.resolve(role_config, settings.base_url, settings.api_key)
+            self.used_routes[route.name] = route
+
+            data = build_chat_request(role_config, messages, stream=True)
+            log_entry = self.new_log_entry(route, data, turn=len(self.history) + 1,
+                                           role_name=role_config["name"], iteration=self.current_iteration,
+                                           role_index=self.current_role_index)
+
+            def on_progress(meter):
+                self.apply_token_delta(meter)
+                self.emit(("status", f"【{role_config['name']}】{meter.status_text()}"))
+
+            cancel_token = self.cancel_token
+            result = stream_chat(route, data, settings.timeout, cancel_token, self.emit, on_progress)
+            if result.get("cancelled"):
+                return None  # 请求没有发出，运行循环按停止处理
+            if result["status_code"] != 200:
+                self.finish_log(log_entry, {"status_code": result["status_code"], "error": result["error"]},
+                                result["timer"])
+                self.emit(f"API错误: {result['status_code']}\n")
+                return None
+
+            # 以真实usage校正估算值（usage未到达时保留估算值）
+            meter = result["meter"]
+            self.apply_token_delta(meter)
+
+            # 记录本轮的思考统计，供对话历史使用
+            self.last_turn_metrics = dict(meter.reasoning_summary(), reasoning_content=result["reasoning_content"])
+
+            self.finish_log(log_entry, self.stream_response_log(result, cancel_token), result["timer"])
+            return result["content"]
+
+        except Exception as e:
+            print(f"API调用失败: {e}")
+            self.emit(f"API调用失败: {str(e)}\n")
+            return None
+
+    def save_run_log(self):
+        """保存本次运行的汇总日志（含结束原因），返回结束原因"""
+        if self.stop_reason:
+            end_reason = self.stop_reason
+        elif self.stop_requested:
+            end_reason = "用户停止"
+        else:
+            end_reason = "完成全部循环"
+
+        try:
+            started_at = self.run_started_at or datetime.now()
+            if self.log_sink is not None:
+                self.log_sink.write({
+                    "kind": "run",
+                    "timestamp": started_at.strftime("%Y-%m-%d %H:%M:%S"),
+                    "ts": started_at.timestamp(),
+                    "run_id": self.run_id,
+                    "tab_id": self.tab_id,
+                    "roles": [role_info["role"]["name"] for role_info in self.ordered_roles],
+                    "iteration_count": self.iteration_count,
+                    "completed_iterations": self.current_iteration,
+                    "turns": len(self.history),
+                    "run_tokens": self.prompt_tokens + self.completion_tokens - self.run_start_tokens,
+                    "end_reason": end_reason,
+                    "duration": round((datetime.now() - started_at).total_seconds(), 3)
+                })
+        except Exception as e:
+            print(f"保存运行日志失败: {e}")
+        return end_reason
+
+
+class RateLimiter:
+    """令牌桶限流：平均每分钟最多rate_per_minute个令牌，允许短时突发；rate为0时不限制
+
+    一次取用的数量超过桶容量时允许透支，之后的取用需等到补足。
+    """
+
+    def __init__(self, rate_per_minute=0, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """按经过的时间补充令牌（需持有锁）"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """当前可用的令牌数（不限制时为无穷大）"""
+        if self.rate <= 0:
+            return math.inf
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def consume(self, amount):
+        """不等待地扣除令牌（可透支），用于事后才知道数量的消耗"""
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+    def refund(self, amount):
+        """退还取得后没有使用的令牌"""
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def acquire(self, amount=1, cancel_token=None):
+        """取得amount个令牌，不足时等待；等待中被取消时返回False"""
+        if self.rate <= 0:
+            return True
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return True
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            if cancel_token is not None:
+                if cancel_token.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+
+# 批量推理：未指定字段时依次查找的输入字段、重试的HTTP状态码和最长退避秒数
+BULK_INPUT_FIELDS = ("input", "text", "prompt", "content")
+BULK_RETRY_STATUS = {429, 500, 502, 503, 504}
+BULK_MAX_BACKOFF = 30.0
+
+
+def read_bulk_inputs(path, field=None):
+    """逐条读取批量输入，产出(序号, 记录ID, 输入文本)，格式错误时抛出ValueError
+
+    - JSONL：每行一个对象（输入取field字段，默认依次查找input/text/prompt/content，id字段作为记录ID）或一个字符串
+    - CSV：第一行为表头，输入取field列，默认依次查找同名列，都没有时取第一列
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            columns = reader.fieldnames or []
+            column = field or next((name for name in BULK_INPUT_FIELDS if name in columns), None)
+            column = column or (columns[0] if columns else None)
+            if column not in columns:
+                raise ValueError(f"CSV中没有列 '{column}'")
+            for index, row in enumerate(reader):
+                yield index, row.get("id") or index, row.get(column) or ""
+        return
+
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        index = 0
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"第{line_number}行不是有效的JSON: {e}")
+            if isinstance(record, dict):
+                name = field or next((name for name in BULK_INPUT_FIELDS if name in record), None)
+                text = record.get(name) if name else None
+                record_id = record.get("id", index)
+            else:
+                text = record
+                record_id = index
+            yield index, record_id, "" if text is None else str(text)
+            index += 1
+
+
+def load_bulk_completed(output_path):
+    """读取已有输出文件中成功完成的输入序号（用于续跑）"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中断时可能写了半行
+            if isinstance(result, dict) and result.get("status") == "ok" and "index" in result:
+                completed.add(result["index"])
+    return completed
+
+
+class BulkInferenceEngine(ChatEngineBase):
+    """批量推理引擎：每条输入独立请求（系统提示 + 输入，不带历史），可重试的失败按指数退避重试"""
+
+    tab_type = "bulk"
+
+    def infer(self, text, role_config, settings, rate_limiter, max_retries, cancel_token, **log_fields):
+        """处理一条输入，返回结果字典：status为ok（另有output、usage等）、error或cancelled"""
+        messages = []
+        if role_config.get("system_prompt"):
+            messages.append({"role": "system", "content": role_config["system_prompt"]})
+        messages.append({"role": "user", "content": text})
+        route = self.api_router.resolve(role_config, settings.base_url, settings.api_key)
+        data = build_chat_request(role_config, messages, stream=False)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if not rate_limiter.acquire(cancel_token=cancel_token):
+                return {"status": "cancelled"}
+
+            log_entry = self.new_log_entry(route, data, role_name=role_config["name"], **log_fields)
+            try:
+                result = complete_chat(route, data, settings.timeout, cancel_token)
+            except requests.RequestException as e:
+                result = {"status_code": None, "error": str(e)}
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # 200响应的正文不完整或格式不对（如代理截断），按网络错误记录并重试
+                result = {"status_code": None, "error": f"响应解析失败: {e!r}"}
+            if result.get("cancelled"):
+                return {"status": "cancelled"}  # 等待密钥额度时被停止，请求没有发出
+            if result["status_code"] == 200:
+                response = {"status_code": 200, "content": result["content"],
+                            "reasoning_content": result["reasoning_content"], "usage": result["usage"],
+                            "attempt": attempt}
+            else:
+                response = {"status_code": result["status_code"], "error": result["error"], "attempt": attempt}
+            log_entry["response"] = response
+            log_entry["timer"] = result.get("timer")
+            self.write_log(log_entry)
+
+            if result["status_code"] == 200:
+                usage = result["usage"]
+                self.add_tokens(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+                output = {"status": "ok", "output": result["content"], "usage": usage, "attempts": attempt}
+                if result["reasoning_content"]:
+                    output["reasoning_content"] = result["reasoning_content"]
+                return output
+
+            retryable = result["status_code"] is None or result["status_code"] in BULK_RETRY_STATUS
+            if not retryable or attempt > max_retries:
+                error = result["error"] if result["status_code"] is None else f"{result['status_code']}: {result['error']}"
+                return {"status": "error", "error": error[:1000], "attempts": attempt}
+
+            # 指数退避（带随机抖动，避免并发的请求同时重试）
+            delay = min(BULK_MAX_BACKOFF, 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            if cancel_token.wait(delay):
+                return {"status": "cancelled"}
+
+
+class BulkInferenceJob:
+    """批量推理：用一个角色处理输入文件的每一条，结果逐条追加到输出JSONL
+
+    - 固定数量的工作线程；输入按需读取，已读取但未写出的条数不超过并发数的4倍
+    - 每次请求（含重试）前经过限流器；429、5xx、网络错误和无法解析的响应按指数退避重试
+    - ordered为True时按输入顺序写出，否则按完成顺序写出
+    - 续跑：输出文件中已成功的条目被跳过，失败和未完成的重新处理（新结果追加在文件末尾）
+    输出每行：index、id、input、status（ok/error）、output或error、usage、attempts、duration。
+    """
+
+    def __init__(self, input_path, output_path, role_config, settings, api_router=None, log_sink=None,
+                 concurrency=4, rpm=0, max_retries=3, ordered=False, field=None, on_token_update=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.role_config = role_config
+        self.settings = settings
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = RateLimiter(rpm)
+        self.max_retries = max_retries
+        self.ordered = ordered
+        self.field = field
+        self.engine = BulkInferenceEngine(0, api_router, log_sink, on_token_update=on_token_update)
+        self.engine.run_id = new_run_id("bulk")
+        self.cancel_token = CancelToken()
+        self.lock = threading.Lock()
+
+        # 进度
+        self.total = 0
+        self.skipped = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.started_at = None
+        self.finished_at = None
+
+        # 写出
+        self.output_file = None
+        self.window = threading.BoundedSemaphore(self.concurrency * 4)
+        self.submitted = deque()  # 按输入顺序排队等待写出的序号（ordered时使用）
+        self.finished = {}  # 已完成但还未轮到写出的结果
+
+    @property
+    def done(self):
+        return self.succeeded + self.failed
+
+    @property
+    def running(self):
+        return self.started_at is not None and self.finished_at is None
+
+    def stop(self):
+        """停止：不再开始新的条目，正在等待限流或重试的条目立即放弃（续跑时重新处理）"""
+        self.cancel_token.cancel()
+
+    def run(self):
+        """处理全部输入（阻塞），返回是否没有失败的条目；输入文件格式错误时抛出ValueError"""
+        completed = load_bulk_completed(self.output_path)
+        self.total = 0
+        self.skipped = 0
+        for index, _, _ in read_bulk_inputs(self.input_path, self.field):
+            self.total += 1
+            if index in completed:
+                self.skipped += 1
+
+        self.started_at = time.perf_counter()
+        work = queue.Queue(maxsize=self.concurrency * 2)
+        workers = [threading.Thread(target=self._worker, args=(work,), name=f"Bulk-{number}", daemon=True)
+                   for number in range(self.concurrency)]
+        self.output_file = open(self.output_path, 'a', encoding='utf-8')
+        try:
+            for worker in workers:
+                worker.start()
+            for item in read_bulk_inputs(self.input_path, self.field):
+                if item[0] in completed:
+                    continue
+                # 限制已读取未写出的条数（按顺序写出时慢的条目会让后面的结果暂存在内存中）
+                while not self.window.acquire(timeout=0.2):
+                    if self.cancel_token.cancelled:
+                        break
+                else:
+                    with self.lock:
+                        self.submitted.append(item[0])
+                    work.put(item)
+                    continue
+                break
+        finally:
+            for _ in workers:
+                work.put(None)
+            for worker in workers:
+                worker.join()
+            with self.lock:
+                # 被停止时顺序中断，已完成的结果仍全部写出
+                for index in sorted(self.finished):
+                    self._write(self.finished[index])
+                self.finished.clear()
+                self.output_file.close()
+                self.output_file = None
+            self.finished_at = time.perf_counter()
+        return self.failed == 0
+
+    def _worker(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            index, record_id, text = item
+            started = time.perf_counter()
+            if self.cancel_token.cancelled:
+                result = {"status": "cancelled"}
+            else:
+                try:
+                    result = self.engine.infer(text, self.role_config, self.settings, self.rate_limiter,
+                                               self.max_retries, self.cancel_token, turn=index + 1)
+                except Exception as e:
+                    result = {"status": "error", "error": str(e), "attempts": 1}
+            line = None
+            if result["status"] != "cancelled":
+                line = dict({"index": index, "id": record_id, "input": text}, **result)
+                line["duration"] = round(time.perf_counter() - started, 3)
+            self._finish(index, line)
+
+    def _finish(self, index, line):
+        with self.lock:
+            if line is not None:
+                if line["status"] == "ok":
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+                self.retried += line.get("attempts", 1) - 1
+            if not self.ordered:
+                self._write(line)
+                self.submitted.remove(index)
+                self.window.release()
+                return
+            self.finished[index] = line
+            while self.submitted and self.submitted[0] in self.finished:
+                self._write(self.finished.pop(self.submitted.popleft()))
+                self.window.release()
+
+    def _write(self, line):
+        """写出一条结果（调用方持有lock）；被停止而未处理的条目不写出"""
+        if line is None:
+            return
+        try:
+            self.output_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.output_file.flush()
+        except OSError as e:
+            print(f"写入批量结果失败: {e}")
+
+    def progress(self):
+        """进度：(已处理含跳过, 总数, 每秒条数, 预计剩余秒数或None)"""
+        elapsed = ((self.finished_at or time.perf_counter()) - self.started_at) if self.started_at else 0.0
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.skipped - self.done
+        eta = remaining / rate if rate > 0 else None
+        return self.skipped + self.done, self.total, rate, eta
+
+    def progress_text(self):
+        processed, total, rate, eta = self.progress()
+        text = (f"{processed}/{total}（成功 {self.succeeded}，失败 {self.failed}，跳过 {self.skipped}，"
+                f"重试 {self.retried}）{rate:.2f}条/秒 Tokens: {self.engine.prompt_tokens}/{self.engine.completion_tokens}")
+        if eta is not None and self.running:
+            text += f" 预计剩余 {int(eta // 3600)}:{int(eta % 3600 // 60):02d}:{int(eta % 60):02d}"
+        return text
+
+
+def default_bulk_output(input_path):
+    return os.path.splitext(input_path)[0] + ".out.jsonl"
+
+
+class ComparisonEngine(ChatEngineBase):
+    """A/B对比引擎：把同一条输入并发发给K个角色变体（各自独立请求：系统提示 + 输入，不带历史），可重复多轮
+
+    emit产出(变体序号, 事件)，事件同ChatEngineBase，另有：
+    - (None, ("trial", 轮次))：一轮开始
+    - (变体序号, ("result", 结果))：该变体本轮结束，结果同时追加到results
+    """
+
+    tab_type = "compare"
+
+    def __init__(self, tab_id, api_router=None, log_sink=None, emit=None, on_token_update=None):
+        super().__init__(tab_id, api_router, log_sink, emit, on_token_update)
+        self.run_id = new_run_id(tab_id)
+        self.results = []  # 每个变体每轮一条：variant、trial、status、first_token、total、tokens、chars、content
+
+    def clear(self):
+        self.results = []
+        self.run_id = new_run_id(self.tab_id)
+
+    def run(self, user_input, variants, settings, trials=1, cancel_token=None):
+        """运行trials轮，每轮所有变体同时发出请求，全部结束后开始下一轮"""
+        cancel_token = cancel_token or CancelToken()
+        for trial in range(1, trials + 1):
+            if cancel_token.cancelled:
+                break
+            self.emit((None, ("trial", trial)))
+            threads = [threading.Thread(target=self.run_variant,
+                                        args=(index, role_config, user_input, settings, trial, cancel_token),
+                                        name=f"Compare-{self.tab_id}-{index}", daemon=True)
+                       for index, role_config in enumerate(variants)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    def run_variant(self, index, role_config, user_input, settings, trial, cancel_token):
+        """发出一个变体的一次请求（工作线程）"""
+        def emit(item):
+            self.emit((index, item))
+
+        def on_progress(meter):
+            self.apply_token_delta(meter)
+            emit(("status", meter.status_text()))
+
+        result = {"variant": index, "trial": trial, "role_name": role_config.get("name", ""),
+                  "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "status": "error",
+                  "first_token": None, "total": None, "prompt_tokens": 0, "completion_tokens": 0,
+                  "chars": 0, "content": ""}
+        try:
+            messages = []
+            if role_config.get("system_prompt"):
+                messages.append({"role": "system", "content": role_config["system_prompt"]})
+            messages.append({"role": "user", "content": user_input})
+            route = self.api_router.resolve(role_config, settings.base_url, settings.api_key)
+            data = build_chat_request(role_config, messages, stream=settings.stream)
+            log_entry = self.new_log_entry(route, data, turn=trial, role_name=result["role_name"],
+                                           role_index=index)
+
+            if settings.stream:
+                response = stream_chat(route, data, settings.timeout, cancel_token, emit, on_progress)
+                if response["status_code"] == 200:
+                    meter = response["meter"]
+                    self.apply_token_delta(meter)
+                    log_entry["response"] = self.stream_response_log(response, cancel_token)
+                    result.update(prompt_tokens=meter.prompt_tokens, completion_tokens=meter.completion_tokens)
+            else:
+                response = complete_chat(route, data, settings.timeout, cancel_token)
+                if response["status_code"] == 200:
+                    emit(response["timer"].timed_text(response["content"]))
+                    usage = response["usage"]
+                    self.add_tokens(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+                    log_entry["response"] = {"status_code": 200, "content": response["content"],
+                                             "reasoning_content": response["reasoning_content"], "usage": usage}
+                    result.update(prompt_tokens=usage.get("prompt_tokens", 0),
+                                  completion_tokens=usage.get("completion_tokens", 0))
+
+            timer = response["timer"]
+            if response.get("cancelled"):
+                # 等待密钥额度时被停止，请求没有发出：不写日志
+                result["status"] = "cancelled"
+            else:
+                if response["status_code"] == 200:
+                    # 非流式请求整个回复一起到达，首token即总耗时
+                    first_token = timer.first_token if settings.stream else timer.total
+                    result.update(status="cancelled" if cancel_token.cancelled else "ok",
+                                  content=response["content"], chars=len(response["content"]),
+                                  first_token=first_token, total=timer.total)
+                else:
+                    log_entry["response"] = {"status_code": response["status_code"], "error": response["error"]}
+                    result["error"] = f"API错误: {response['status_code']}"
+                    emit(f"{result['error']}\n")
+                log_entry["timer"] = timer
+                emit(("log", log_entry))
+        except Exception as e:
+            result["error"] = f"API调用失败: {str(e)}"
+            emit(f"{result['error']}\n")
+        self.results.append(result)
+        emit(("result", result))
+
+
+def summarize_comparison(results, variant_count):
+    """按变体汇总对比结果：成功次数、首token和总耗时的分布、输出长度的分布（秒/token/字）"""
+    summaries = []
+    for index in range(variant_count):
+        runs = [result for result in results if result["variant"] == index]
+        succeeded = [result for result in runs if result["status"] == "ok"]
+        first_tokens = [result["first_token"] for result in succeeded if result["first_token"] is not None]
+        totals = [result["total"] for result in succeeded if result["total"] is not None]
+        tokens = [result["completion_tokens"] for result in succeeded]
+        chars = [result["chars"] for result in succeeded]
+        summaries.append({
+            "runs": len(runs),
+            "succeeded": len(succeeded),
+            "first_token_p50": _percentile(first_tokens, 50),
+            "first_token_p95": _percentile(first_tokens, 95),
+            "total_mean": statistics.fmean(totals) if totals else None,
+            "total_stdev": statistics.stdev(totals) if len(totals) > 1 else None,
+            "tokens_mean": statistics.fmean(tokens) if tokens else None,
+            "tokens_min": min(tokens) if tokens else None,
+            "tokens_max": max(tokens) if tokens else None,
+            "chars_mean": statistics.fmean(chars) if chars else None,
+        })
+    return summaries
+
+
+def show_text_diff(parent, title_a, text_a, title_b, text_b):
+    """逐字比较两段回复：删除的部分（只在A中）标红并划线，新增的部分（只在B中）标绿"""
+    window = tk.Toplevel(parent)
+    window.title(f"差异: {title_a} → {title_b}")
+    window.geometry("800x600")
+
+    matcher = difflib.SequenceMatcher(None, text_a, text_b, autojunk=False)
+    ttk.Label(window, text=f"相似度 {matcher.ratio():.1%}    红色删除线: 只在 {title_a} 中    绿色: 只在 {title_b} 中",
+              padding="5").pack(fill=tk.X)
+    text = scrolledtext.ScrolledText(window, font=("微软雅黑", 10), wrap=tk.WORD)
+    text.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
+    text.tag_configure("delete", foreground="#c62828", background="#ffebee", overstrike=True)
+    text.tag_configure("insert", foreground="#2e7d32", background="#e8f5e9")
+    for tag, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+        if tag == "equal":
+            text.insert(tk.END, text_a[a_start:a_end])
+            continue
+        if tag in ("delete", "replace"):
+            text.insert(tk.END, text_a[a_start:a_end], "delete")
+        if tag in ("insert", "replace"):
+            text.insert(tk.END, text_b[b_start:b_end], "insert")
+    text.config(state='disabled')
+    ttk.Button(window, text="关闭", command=window.destroy).pack(pady=(0, 5))
+    return window
+
+
+class BulkInferenceDialog(tk.Toplevel):
+    """批量处理窗口：选择输入文件和角色，在后台运行BulkInferenceJob并显示进度"""
+
+    def __init__(self, app):
+        super().__init__(app.root)
+        self.app = app
+        self.job = None
+        self.title("批量处理")
+        self.geometry("720x320")
+        self.transient(app.root)
+
+        self.input_var = tk.StringVar()
+        self.output_var = tk.StringVar()
+        self.role_var = tk.StringVar()
+        self.field_var = tk.StringVar()
+        self.concurrency_var = tk.IntVar(value=4)
+        self.rpm_var = tk.IntVar(value=0)
+        self.retries_var = tk.IntVar(value=3)
+        self.ordered_var = tk.BooleanVar(value=False)
+        self.status_var = tk.StringVar(value="选择输入文件（JSONL或CSV）和角色后开始；中断后用相同输出文件再次开始即可续跑")
+
+        form = ttk.Frame(self, padding="10")
+        form.pack(fill=tk.X)
+        form.columnconfigure(1, weight=1)
+
+        ttk.Label(form, text="输入文件:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        ttk.Entry(form, textvariable=self.input_var).grid(row=0, column=1, sticky=tk.EW, padx=5)
+        ttk.Button(form, text="浏览", command=self.choose_input, width=8).grid(row=0, column=2)
+
+        ttk.Label(form, text="输出文件:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        ttk.Entry(form, textvariable=self.output_var).grid(row=1, column=1, sticky=tk.EW, padx=5)
+        ttk.Button(form, text="浏览", command=self.choose_output, width=8).grid(row=1, column=2)
+
+        ttk.Label(form, text="角色:").grid(row=2, column=0, sticky=tk.W, pady=2)
+        role_names = self.app.global_roles.keys()
+        ttk.Combobox(form, textvariable=self.role_var, values=role_names,
+                     state="readonly").grid(row=2, column=1, sticky=tk.W, padx=5)
+        if role_names:
+            self.role_var.set(role_names[0])
+
+        options = ttk.Frame(self, padding=(10, 0))
+        options.pack(fill=tk.X)
+        ttk.Label(options, text="输入字段:").pack(side=tk.LEFT)
+        ttk.Entry(options, textvariable=self.field_var, width=10).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(options, text="并发:").pack(side=tk.LEFT)
+        ttk.Spinbox(options, from_=1, to=64, textvariable=self.concurrency_var, width=5).pack(side=tk.LEFT,
+                                                                                              padx=(5, 10))
+        ttk.Label(options, text="每分钟请求(0不限):").pack(side=tk.LEFT)
+        ttk.Spinbox(options, from_=0, to=10000, textvariable=self.rpm_var, width=7).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(options, text="重试:").pack(side=tk.LEFT)
+        ttk.Spinbox(options, from_=0, to=10, textvariable=self.retries_var, width=4).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Checkbutton(options, text="按输入顺序输出", variable=self.ordered_var).pack(side=tk.LEFT)
+
+        progress_frame = ttk.Frame(self, padding="10")
+        progress_frame.pack(fill=tk.X)
+        self.progress_bar = ttk.Progressbar(progress_frame, mode="determinate")
+        self.progress_bar.pack(fill=tk.X)
+        ttk.Label(progress_frame, textvariable=self.status_var, wraplength=680).pack(fill=tk.X, pady=(5, 0))
+
+        button_frame = ttk.Frame(self, padding="10")
+        button_frame.pack(fill=tk.X)
+        self.start_button = ttk.Button(button_frame, text="▶️ 开始", command=self.start, width=10)
+        self.start_button.pack(side=tk.LEFT, padx=(0, 10))
+        self.stop_button = ttk.Button(button_frame, text="⏹️ 停止", command=self.stop, width=10, state='disabled')
+        self.stop_button.pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="关闭", command=self.on_close, width=10).pack(side=tk.RIGHT)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def choose_input(self):
+        path = filedialog.askopenfilename(parent=self, title="选择输入文件",
+                                          filetypes=[("JSONL/CSV", "*.jsonl *.csv"), ("所有文件", "*.*")])
+        if path:
+            self.input_var.set(path)
+            if not self.output_var.get():
+                self.output_var.set(default_bulk_output(path))
+
+    def choose_output(self):
+        path = filedialog.asksaveasfilename(parent=self, title="选择输出文件", defaultextension=".jsonl",
+                                            filetypes=[("JSONL", "*.jsonl"), ("所有文件", "*.*")])
+        if path:
+            self.output_var.set(path)
+
+    def start(self):
+        input_path = self.input_var.get().strip()
+        role_name = self.role_var.get()
+        if not input_path or not os.path.exists(input_path):
+            messagebox.showwarning("警告", "请选择输入文件", parent=self)
+            return
+        if role_name not in self.app.global_roles:
+            messagebox.showwarning("警告", "请选择角色", parent=self)
+            return
+        role_config = dict(self.app.global_roles[role_name], name=role_name)
+        api_key = self.app.api_key.get().strip()
+        if not self.app.api_router.has_key(role_config, api_key):
+            messagebox.showerror("错误", "请输入API Key", parent=self)
+            return
+        output_path = self.output_var.get().strip() or default_bulk_output(input_path)
+        self.output_var.set(output_path)
+
+        try:
+            settings = ApiSettings(api_key, self.app.base_url.get().strip(), self.app.timeout.get(), stream=False)
+            self.job = BulkInferenceJob(input_path, output_path, role_config, settings,
+                                        api_router=self.app.api_router, log_sink=self.app.log_writer,
+                                        concurrency=self.concurrency_var.get(), rpm=self.rpm_var.get(),
+                                        max_retries=self.retries_var.get(), ordered=self.ordered_var.get(),
+                                        field=self.field_var.get().strip() or None,
+                                        on_token_update=self.app.on_tab_token_update)
+        except tk.TclError as e:
+            messagebox.showerror("错误", f"参数无效: {str(e)}", parent=self)
+            return
+        self.app.bulk_engines.append(self.job.engine)
+
+        self.start_button.config(state='disabled')
+        self.stop_button.config(state='normal')
+        self.status_var.set("正在读取输入...")
+        thread = threading.Thread(target=self.run_job, args=(self.job,), daemon=True)
+        thread.start()
+        self.update_progress()
+
+    def run_job(self, job):
+        """运行批量任务（工作线程）"""
+        try:
+            job.run()
+            error = None
+        except (OSError, ValueError) as e:
+            error = str(e)
+        self.after(0, self.finish, job, error)
+
+    def update_progress(self):
+        job = self.job
+        if job is None or not self.winfo_exists():
+            return
+        processed, total, _, _ = job.progress()
+        if total:
+            self.progress_bar.config(maximum=total, value=processed)
+            self.status_var.set(job.progress_text())
+        if job.finished_at is None:
+            self.after(500, self.update_progress)
+
+    def finish(self, job, error):
+        self.start_button.config(state='normal')
+        self.stop_button.config(state='disabled')
+        if error:
+            self.status_var.set(f"批量处理失败: {error}")
+            return
+        self.update_progress()
+        state = "已停止（再次开始可续跑）" if job.cancel_token.cancelled else "完成"
+        self.status_var.set(f"{state}：{job.progress_text()}\n结果: {job.output_path}")
+
+    def stop(self):
+        if self.job is not None:
+            self.job.stop()
+            self.status_var.set("正在停止，等待进行中的请求完成...")
+
+    def on_close(self):
+        if self.job is not None and self.job.running:
+            if not messagebox.askyesno("确认", "批量处理正在进行，停止并关闭吗？", parent=self):
+                return
+            self.job.stop()
+        self.destroy()
 
 
 class DeepSeekAPIMultiTabTool:
     """多标签页DeepSeek API工具主类"""
 
-    def __init__(self, root):
+    def __init__(self, root, diagnostics=None):
         self.root = root
+        self.diagnostics = diagnostics or Diagnostics()  # CPU/内存/线程诊断
         self.root.title("DeepSeek API 调用工具 - 多角色协同版 v0.5.012109")
         self.root.geometry("1400x950")
 
@@ -36,7 +4997,7 @@ class DeepSeekAPIMultiTabTool:
 
         # 全局API配置（在所有标签页间共享）
         self.api_key = tk.StringVar()
-        self.base_url = tk.StringVar(value="https://api.deepseek.com/v1/chat/completions")
+        self.base_url = tk.StringVar(value=DEFAULT_BASE_URL)
         self.timeout = tk.IntVar(value=60)
         self.stream_response = tk.BooleanVar(value=True)
 
@@ -46,17 +5007,30 @@ class DeepSeekAPIMultiTabTool:
         self.next_tab_id = 1  # 下一个标签页ID
 
         # 全局角色配置管理
-        self.global_roles = {}  # 全局角色配置池
         self.role_file = "global_roles.json"
+        self.global_roles = RoleStore(self.role_file)  # 全局角色配置池（后台保存，变化时通知各标签页）
+
+        # API路由（接口配置、每个端点独立的连接池）
+        self.api_router = ApiRouter()
 
         # 状态变量
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
+        self.bulk_engines = []  # 批量处理窗口的引擎，其Token计入全局统计（不属于任何标签页）
 
         # API日志文件
         self.api_log_dir = "api_logs"
         if not os.path.exists(self.api_log_dir):
             os.makedirs(self.api_log_dir)
+        self.log_writer = ApiLogWriter(self.api_log_dir)
+
+        # 主循环卡顿监视（回调计时和慢回调记录常开，浮窗按需打开）
+        self.lag_monitor = TkLagMonitor(self.root, log_writer=self.log_writer)
+        self.lag_monitor.start()
+        self.lag_overlay = None
+
+        # 工作区会话存储（标签页布局和每个标签页的对话日志）
+        self.session_store = SessionStore("sessions")
 
         # 创建界面
         self.create_widgets()
@@ -65,6 +5039,9 @@ class DeepSeekAPIMultiTabTool:
         # 添加一个默认角色到全局角色池
         self.add_default_roles()
 
+        # 恢复上次的工作区
+        self.restore_workspace()
+
     def setup_styles(self):
         """设置样式"""
         style = ttk.Style()
@@ -150,10 +5127,12 @@ class DeepSeekAPIMultiTabTool:
                 }
             }
             self.global_roles.update(default_roles)
-            self.save_all_roles()
 
     def create_widgets(self):
         """创建主界面组件"""
+        # 菜单栏
+        self.create_menu()
+
         # 创建主容器
         main_container = ttk.Frame(self.root, padding="10")
         main_container.pack(fill=tk.BOTH, expand=True)
@@ -165,6 +5144,105 @@ class DeepSeekAPIMultiTabTool:
         tab_frame = self.create_tab_region(main_container)
         tab_frame.pack(fill=tk.BOTH, expand=True)
 
+    def create_menu(self):
+        """创建菜单栏（诊断菜单）"""
+        menubar = tk.Menu(self.root)
+        self.diagnostics_menu = tk.Menu(menubar, tearoff=0)
+        self.diagnostics_menu.add_command(label="开始CPU分析", command=self.toggle_profiling)
+        self.diagnostics_menu.add_separator()
+        self.diagnostics_menu.add_command(label="内存快照", command=self.show_memory_snapshot)
+        self.diagnostics_menu.add_command(label="停止内存跟踪", command=self.diagnostics.stop_tracemalloc)
+        self.diagnostics_menu.add_separator()
+        self.diagnostics_menu.add_command(label="线程调用栈", command=self.show_thread_stacks)
+        self.diagnostics_menu.add_command(label="卡顿监视", command=self.toggle_lag_overlay)
+        menubar.add_cascade(label="诊断", menu=self.diagnostics_menu)
+        self.root.config(menu=menubar)
+        self.update_profiling_menu()
+
+    def update_profiling_menu(self):
+        label = "停止CPU分析并保存" if self.diagnostics.profiling else "开始CPU分析"
+        self.diagnostics_menu.entryconfig(0, label=label)
+
+    def toggle_profiling(self):
+        """开始/停止CPU分析"""
+        if self.diagnostics.profiling:
+            self.stop_profiling()
+        else:
+            self.diagnostics.start_profile()
+            self.update_profiling_menu()
+
+    def stop_profiling(self):
+        """停止CPU分析，保存结果并显示摘要"""
+        if not self.diagnostics.profiling:
+            return
+        try:
+            paths, summary = self.diagnostics.stop_profile()
+        except Exception as e:
+            messagebox.showerror("错误", f"保存CPU分析结果失败: {str(e)}")
+            return
+        finally:
+            self.update_profiling_menu()
+        self.show_text_window("CPU分析", "已保存:\n" + "\n".join(paths) + "\n\n" + summary)
+
+    def show_memory_snapshot(self):
+        """显示内存快照和各标签页的内存占用"""
+        text = self.diagnostics.memory_snapshot() + "\n各标签页:\n" + self.tab_memory_report()
+        path = self.diagnostics.output_path("memory", "txt")
+        try:
+            atomic_write_text(path, text)
+        except Exception as e:
+            print(f"保存内存快照失败: {e}")
+        self.show_text_window("内存快照", f"已保存: {path}\n\n{text}")
+
+    def tab_memory_report(self):
+        """各标签页的对话记录、界面组件数和待显示队列长度"""
+        def count_widgets(widget):
+            return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+
+        lines = []
+        for tab_id, tab in self.tabs.items():
+            if isinstance(tab, PendingTab):
+                lines.append(f"  标签页 {tab_id}: 未加载（{tab.meta.get('message_count', 0)} 条记录在磁盘上）")
+                continue
+
+            if hasattr(tab, 'get_dialog_history'):
+                store = tab.get_dialog_history()
+                history = (f"{len(store)} 轮（内存中 {len(store.recent)} 轮，"
+                           f"{sum(len(entry.get('response', '')) for entry in store.recent)} 字）")
+                text_widget = tab.dialog_text
+            elif isinstance(tab, ComparisonTab):
+                entries = tab.get_conversation_history()
+                history = f"{len(entries)} 次结果（{sum(entry['chars'] for entry in entries)} 字）"
+                text_widget = tab.columns[0].output_text
+            else:
+                entries = tab.get_conversation_history()
+                history = f"{len(entries)} 条（{sum(len(entry.get('content', '')) for entry in entries)} 字）"
+                text_widget = tab.history_text
+
+            lines.append(f"  标签页 {tab_id}: 对话 {history}，显示区 {len(text_widget.get('1.0', 'end-1c'))} 字，"
+                         f"组件 {count_widgets(tab)} 个，待显示队列 {tab.response_queue.qsize()}")
+        return "\n".join(lines) + "\n"
+
+    def show_thread_stacks(self):
+        """显示所有线程的调用栈"""
+        text = self.diagnostics.thread_stacks()
+        path = self.diagnostics.output_path("stacks", "txt")
+        try:
+            atomic_write_text(path, text)
+        except Exception as e:
+            print(f"保存线程调用栈失败: {e}")
+        self.show_text_window("线程调用栈", f"已保存: {path}\n\n{text}")
+
+    def show_text_window(self, title, text):
+        """在新窗口中显示诊断文本"""
+        window = tk.Toplevel(self.root)
+        window.title(title)
+        window.geometry("900x600")
+        text_widget = scrolledtext.ScrolledText(window, font=("Consolas", 9), wrap=tk.NONE)
+        text_widget.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        text_widget.insert("1.0", text)
+        text_widget.config(state='disabled')
+
     def create_multi_line_toolbar(self, parent):
         """创建多行工具栏（调整布局）"""
         # 第一行：API配置、Token统计和角色管理
@@ -233,6 +5311,10 @@ class DeepSeekAPIMultiTabTool:
                    width=10).pack(side=tk.LEFT, padx=2)
         ttk.Button(role_buttons, text="导出角色", command=self.export_global_roles,
                    width=10).pack(side=tk.LEFT, padx=2)
+        ttk.Button(role_buttons, text="接口配置", command=self.manage_api_profiles,
+                   width=10).pack(side=tk.LEFT, padx=2)
+        ttk.Button(role_buttons, text="密钥池", command=self.manage_key_pool,
+                   width=10).pack(side=tk.LEFT, padx=2)
 
         # 第二行：标签页控制按钮
         toolbar_row2 = ttk.Frame(parent)
@@ -255,6 +5337,10 @@ class DeepSeekAPIMultiTabTool:
                    command=self.add_optimized_multi_role_tab, width=15, style="Primary.TButton").pack(side=tk.LEFT,
                                                                                                       padx=(0, 10))
 
+        # A/B对比按钮
+        ttk.Button(button_frame, text="⚖️ A/B对比",
+                   command=self.add_comparison_tab, width=12).pack(side=tk.LEFT, padx=(0, 10))
+
         # 关闭当前标签页按钮
         ttk.Button(button_frame, text="🗑️ 关闭当前",
                    command=self.close_current_tab, width=12).pack(side=tk.LEFT, padx=(0, 10))
@@ -263,10 +5349,30 @@ class DeepSeekAPIMultiTabTool:
         ttk.Button(button_frame, text="🔍 搜索标签页",
                    command=self.search_tabs, width=12).pack(side=tk.LEFT, padx=(0, 10))
 
+        # 批量处理
+        ttk.Button(button_frame, text="📦 批量处理",
+                   command=self.open_bulk_dialog, width=12).pack(side=tk.LEFT, padx=(0, 10))
+
+        # 主循环卡顿监视浮窗
+        ttk.Button(button_frame, text="⏱️ 卡顿监视",
+                   command=self.toggle_lag_overlay, width=12).pack(side=tk.LEFT, padx=(0, 10))
+
         # 标签页状态
         self.tab_status_label = ttk.Label(button_frame, text="共 0 个标签页")
         self.tab_status_label.pack(side=tk.LEFT, padx=(20, 0))
 
+    def open_bulk_dialog(self):
+        """打开批量处理窗口"""
+        BulkInferenceDialog(self)
+
+    def toggle_lag_overlay(self):
+        """打开/关闭主循环监视浮窗"""
+        if self.lag_overlay is not None and self.lag_overlay.winfo_exists():
+            self.lag_overlay.destroy()
+            self.lag_overlay = None
+        else:
+            self.lag_overlay = LagOverlay(self.root, self.lag_monitor)
+
     def create_tab_region(self, parent):
         """创建标签页区域"""
         tab_frame = ttk.Frame(parent)
@@ -292,6 +5398,7 @@ class DeepSeekAPIMultiTabTool:
             # 更新标签页名称
             new_title = f"标签页 {tab_id}: {role_name}"
             self.notebook.tab(tab.parent, text=new_title)
+            self.save_workspace_layout()
 
     def create_new_role_tab(self):
         """创建新的角色标签页（修复版）"""
@@ -299,43 +5406,24 @@ class DeepSeekAPIMultiTabTool:
         if not self.global_roles:
             self.add_default_roles()
 
-        # 显示角色选择对话框
-        role_names = list(self.global_roles.keys())
-
-        if not role_names:
+        if not self.global_roles:
             messagebox.showerror("错误", "没有可用的角色")
             return
 
         # 创建选择对话框
         dialog = tk.Toplevel(self.root)
         dialog.title("选择角色")
-        dialog.geometry("400x300")
+        dialog.geometry("400x340")
         dialog.transient(self.root)
         dialog.grab_set()
 
-        # 角色列表
-        listbox_frame = ttk.Frame(dialog, padding="10")
-        listbox_frame.pack(fill=tk.BOTH, expand=True)
-
-        listbox = tk.Listbox(listbox_frame, font=("微软雅黑", 11))
-        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        scrollbar = ttk.Scrollbar(listbox_frame, orient=tk.VERTICAL, command=listbox.yview)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        listbox.config(yscrollcommand=scrollbar.set)
-
-        # 填充角色列表
-        for role_name in role_names:
-            listbox.insert(tk.END, role_name)
-
         # 按钮区域
         button_frame = ttk.Frame(dialog, padding="10")
-        button_frame.pack(fill=tk.X)
+        button_frame.pack(side=tk.BOTTOM, fill=tk.X)
 
         def on_select():
-            selection = listbox.curselection()
-            if selection:
-                role_name = listbox.get(selection[0])
+            role_name = picker.get_selected()
+            if role_name:
                 role_config = self.global_roles.get(role_name)
                 if role_config:
                     self.create_new_tab(role_name, role_config)
@@ -346,18 +5434,18 @@ class DeepSeekAPIMultiTabTool:
         def on_cancel():
             dialog.destroy()
 
+        # 角色列表（输入名称、提示词或按标签筛选）
+        picker = RolePicker(dialog, self.global_roles, height=10, font=("微软雅黑", 11), on_activate=on_select)
+        picker.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 0))
+        picker.query_entry.focus_set()
+
         ttk.Button(button_frame, text="选择", command=on_select, width=10).pack(side=tk.LEFT, padx=(0, 10))
         ttk.Button(button_frame, text="取消", command=on_cancel, width=10).pack(side=tk.LEFT)
 
-    def create_new_tab(self, role_name="新助手", role_config=None):
-        """创建新的会话标签页"""
-        tab_id = self.next_tab_id
-        self.next_tab_id += 1
-
-        tab_frame = ttk.Frame(self.notebook)
-
-        # 创建会话标签页
-        session_tab = SessionTab(
+    def build_tab(self, tab_type, tab_id, tab_frame):
+        """创建标签页对象（新建和恢复工作区共用）"""
+        tab_class = {"session": SessionTab, "compare": ComparisonTab}.get(tab_type, OptimizedMultiRoleTab)
+        return tab_class(
             parent=tab_frame,
             tab_id=tab_id,
             global_api_key=self.api_key,
@@ -369,9 +5457,23 @@ class DeepSeekAPIMultiTabTool:
             on_save_role=self.save_role_to_global,
             on_load_role=self.load_role_from_global,
             on_update_tab_title=lambda rn: self.update_tab_title(tab_id, rn),
-            log_dir=self.api_log_dir
+            log_dir=self.api_log_dir,
+            api_router=self.api_router,
+            log_writer=self.log_writer,
+            session_store=self.session_store
         )
 
+    def create_new_tab(self, role_name="新助手", role_config=None):
+        """创建新的会话标签页"""
+        tab_id = self.next_tab_id
+        self.next_tab_id += 1
+
+        tab_frame = ttk.Frame(self.notebook)
+
+        # 创建会话标签页（清除同ID的旧会话日志）
+        self.session_store.reset_tab(tab_id)
+        session_tab = self.build_tab("session", tab_id, tab_frame)
+
         # 设置初始角色
         if role_config:
             session_tab.set_role_config(role_config)
@@ -412,21 +5514,9 @@ class DeepSeekAPIMultiTabTool:
 
         tab_frame = ttk.Frame(self.notebook)
 
-        # 创建优化版多角色协同标签页
-        optimized_multi_role_tab = OptimizedMultiRoleTab(
-            parent=tab_frame,
-            tab_id=tab_id,
-            global_api_key=self.api_key,
-            global_base_url=self.base_url,
-            global_timeout=self.timeout,
-            global_stream_response=self.stream_response,
-            global_roles=self.global_roles,
-            on_token_update=self.on_tab_token_update,
-            on_save_role=self.save_role_to_global,
-            on_load_role=self.load_role_from_global,
-            on_update_tab_title=lambda rn: self.update_tab_title(tab_id, rn),
-            log_dir=self.api_log_dir
-        )
+        # 创建优化版多角色协同标签页（清除同ID的旧会话日志）
+        self.session_store.reset_tab(tab_id)
+        optimized_multi_role_tab = self.build_tab("multi_role", tab_id, tab_frame)
 
         optimized_multi_role_tab.pack(fill=tk.BOTH, expand=True)
 
@@ -442,8 +5532,31 @@ class DeepSeekAPIMultiTabTool:
         # 切换到新标签页
         self.notebook.select(tab_frame)
         self.current_tab_id = tab_id
-
-        # 更新状态
+
+        # 更新状态
+        self.update_tab_status()
+
+    def add_comparison_tab(self):
+        """添加A/B对比标签页"""
+        if not self.global_roles:
+            self.add_default_roles()
+
+        tab_id = self.next_tab_id
+        self.next_tab_id += 1
+
+        tab_frame = ttk.Frame(self.notebook)
+        self.session_store.reset_tab(tab_id)
+        comparison_tab = self.build_tab("compare", tab_id, tab_frame)
+        comparison_tab.pack(fill=tk.BOTH, expand=True)
+
+        self.notebook.add(tab_frame, text=f"A/B对比 {tab_id}")
+        self.tabs[tab_id] = comparison_tab
+
+        if self.empty_tab_label.winfo_ismapped():
+            self.empty_tab_label.pack_forget()
+
+        self.notebook.select(tab_frame)
+        self.current_tab_id = tab_id
         self.update_tab_status()
 
     def close_current_tab(self):
@@ -464,9 +5577,14 @@ class DeepSeekAPIMultiTabTool:
         # 查找对应的tab_id
         for tab_id, session_tab in self.tabs.items():
             if session_tab.parent == tab_frame:
-                # 移除标签页
+                # 移除标签页及其会话日志
                 self.notebook.forget(current_tab)
                 del self.tabs[tab_id]
+                self.session_store.remove_tab(tab_id)
+                if hasattr(session_tab, 'on_roles_changed'):
+                    self.global_roles.unsubscribe(session_tab.on_roles_changed)
+                if isinstance(getattr(session_tab, 'dialog_history', None), DialogTurnStore):
+                    session_tab.dialog_history.close()
 
                 # 保存角色配置（如果需要）
                 try:
@@ -499,16 +5617,17 @@ class DeepSeekAPIMultiTabTool:
         for tab_id, session_tab in self.tabs.items():
             if session_tab.parent == tab_frame:
                 self.current_tab_id = tab_id
+                # 已恢复但尚未加载的标签页，在首次显示时加载
+                if isinstance(session_tab, PendingTab):
+                    self.materialize_tab(tab_id)
                 # 更新全局Token显示
                 self.update_global_token_display()
                 break
 
     def on_tab_token_update(self, prompt_tokens, completion_tokens):
-        """标签页Token更新回调"""
-        # 累加全局Token
-        self.total_prompt_tokens += prompt_tokens
-        self.total_completion_tokens += completion_tokens
-        self.update_global_token_display()
+        """标签页Token更新回调（可能来自工作线程）"""
+        # 各标签页的计数是唯一来源，这里只需在主线程重新汇总，避免重复累加
+        self.root.after(0, self.update_global_token_display)
 
     def update_global_token_display(self):
         """更新全局Token显示"""
@@ -521,6 +5640,9 @@ class DeepSeekAPIMultiTabTool:
                 prompt, completion = tab.get_token_counts()
                 total_prompt += prompt
                 total_completion += completion
+        for engine in self.bulk_engines:
+            total_prompt += engine.prompt_tokens
+            total_completion += engine.completion_tokens
 
         self.total_prompt_tokens = total_prompt
         self.total_completion_tokens = total_completion
@@ -529,9 +5651,66 @@ class DeepSeekAPIMultiTabTool:
         self.total_completion_label.config(text=str(total_completion))
 
     def update_tab_status(self):
-        """更新标签页状态"""
+        """更新标签页状态（标签页增减时同时保存工作区布局）"""
         tab_count = len(self.tabs)
         self.tab_status_label.config(text=f"共 {tab_count} 个标签页")
+        self.save_workspace_layout()
+
+    def get_workspace_layout(self):
+        """当前工作区布局（按标签页创建顺序）"""
+        return {
+            "next_tab_id": self.next_tab_id,
+            "current_tab_id": self.current_tab_id,
+            "tabs": [tab.get_workspace_meta() for tab in self.tabs.values()
+                     if hasattr(tab, 'get_workspace_meta')]
+        }
+
+    def save_workspace_layout(self):
+        """保存工作区布局"""
+        try:
+            self.session_store.save_layout(self.get_workspace_layout())
+        except Exception as e:
+            print(f"保存工作区失败: {e}")
+
+    def restore_workspace(self):
+        """恢复上次的工作区：只创建标签页占位，历史在首次显示时加载"""
+        layout = self.session_store.load_layout()
+        if not layout or not layout.get("tabs"):
+            return
+
+        current_frame = None
+        for meta in layout["tabs"]:
+            tab_id = meta.get("tab_id")
+            if tab_id is None:
+                continue
+            tab_frame = ttk.Frame(self.notebook)
+            self.notebook.add(tab_frame, text=meta.get("title", f"标签页 {tab_id}"))
+            self.tabs[tab_id] = PendingTab(tab_frame, meta)
+            if tab_id == layout.get("current_tab_id"):
+                current_frame = tab_frame
+
+        self.next_tab_id = max([layout.get("next_tab_id", 1)] + [tab_id + 1 for tab_id in self.tabs])
+
+        if self.tabs:
+            if self.empty_tab_label.winfo_ismapped():
+                self.empty_tab_label.pack_forget()
+            # 选中标签页会触发on_tab_changed，从而加载该标签页
+            self.notebook.select(current_frame or list(self.tabs.values())[0].parent)
+            self.tab_status_label.config(text=f"共 {len(self.tabs)} 个标签页")
+            self.update_global_token_display()
+
+    def materialize_tab(self, tab_id):
+        """首次显示时创建已恢复的标签页并加载其历史"""
+        pending = self.tabs.get(tab_id)
+        if not isinstance(pending, PendingTab):
+            return pending
+
+        meta = pending.meta
+        tab = self.build_tab(meta.get("type", "session"), tab_id, pending.parent)
+        tab.restore_state(self.session_store.load_tab(tab_id), meta)
+        tab.pack(fill=tk.BOTH, expand=True)
+        self.tabs[tab_id] = tab
+        return tab
 
     def search_tabs(self):
         """搜索标签页"""
@@ -586,7 +5765,11 @@ class DeepSeekAPIMultiTabTool:
                 history = []
                 last_time = "无记录"
 
-                if hasattr(tab, 'role_name'):
+                if isinstance(tab, PendingTab):
+                    role_name = tab.meta.get("role_name", "")
+                    history = [None] * tab.meta.get("message_count", 0)
+                    last_time = tab.meta.get("last_time") or "无记录"
+                elif hasattr(tab, 'role_name'):
                     role_name = tab.role_name.get()
                     if hasattr(tab, 'get_conversation_history'):
                         history = tab.get_conversation_history()
@@ -595,9 +5778,12 @@ class DeepSeekAPIMultiTabTool:
                         history = tab.get_dialog_history()
                         if tab.tab_type == "optimized_multi_role":
                             role_name = "多角色协同(优化)"
+                    elif tab.tab_type == "compare":
+                        role_name = "A/B对比"
+                        history = tab.get_conversation_history()
 
-                if history:
-                    last_time = history[-1].get("timestamp", "无记录") if history else "无记录"
+                if history and history[-1] is not None:
+                    last_time = history[-1].get("timestamp", "无记录")
 
                 if not search_text or search_text in role_name.lower():
                     tree.insert("", "end", values=(f"标签页 {tab_id}", role_name, len(history), last_time),
@@ -634,39 +5820,31 @@ class DeepSeekAPIMultiTabTool:
                    command=search_dialog.destroy).pack(side=tk.RIGHT)
 
     def load_global_roles(self):
-        """从文件加载全局角色配置"""
-        if os.path.exists(self.role_file):
-            try:
-                with open(self.role_file, 'r', encoding='utf-8') as f:
-                    self.global_roles = json.load(f)
-            except Exception as e:
-                messagebox.showerror("错误", f"加载角色配置失败: {str(e)}")
-                self.global_roles = {}
+        """从文件加载全局角色配置，并定期检查其他实例的修改"""
+        try:
+            self.global_roles.load()
+        except Exception as e:
+            messagebox.showerror("错误", f"加载角色配置失败: {str(e)}")
+        self.poll_role_file()
+
+    def poll_role_file(self):
+        """定期合并角色文件的外部修改（变化的角色会通知到各标签页）"""
+        self.global_roles.check_external_changes()
+        self.root.after(2000, self.poll_role_file)
 
     def save_all_roles(self):
-        """保存所有角色配置到文件"""
+        """写入尚未保存的角色配置并停止后台写入（程序退出时调用）
+
+        只保存用户明确保存过的角色，不再用各标签页的当前编辑覆盖角色库。
+        """
         try:
-            # 收集所有标签页的角色配置
-            for tab_id, tab in self.tabs.items():
-                if hasattr(tab, 'get_role_config'):
-                    role_config = tab.get_role_config()
-                    role_name = role_config.get("name", f"标签页_{tab_id}")
-                    self.global_roles[role_name] = role_config
-
-            # 保存到文件
-            with open(self.role_file, 'w', encoding='utf-8') as f:
-                json.dump(self.global_roles, f, ensure_ascii=False, indent=2)
+            self.global_roles.close()
         except Exception as e:
             print(f"保存角色配置失败: {e}")
 
     def save_role_to_global(self, role_name, role_config):
-        """保存角色到全局配置"""
-        self.global_roles[role_name] = role_config
-        try:
-            with open(self.role_file, 'w', encoding='utf-8') as f:
-                json.dump(self.global_roles, f, ensure_ascii=False, indent=2)
-        except:
-            pass
+        """保存角色到全局配置（后台写入，订阅的标签页会收到变化通知）"""
+        self.global_roles.set(role_name, role_config)
 
     def load_role_from_global(self, role_name):
         """从全局配置加载角色"""
@@ -684,18 +5862,269 @@ class DeepSeekAPIMultiTabTool:
                 with open(file_path, 'r', encoding='utf-8') as f:
                     imported_roles = json.load(f)
 
-                # 合并角色配置
-                self.global_roles.update(imported_roles)
+                if not isinstance(imported_roles, dict):
+                    raise ValueError("角色配置文件格式应为 {角色名: 配置}")
 
-                # 更新所有标签页的角色列表
-                for tab in self.tabs.values():
-                    if hasattr(tab, 'update_role_combobox'):
-                        tab.update_role_combobox()
+                # 与现有角色同名但内容不同的，询问是否覆盖
+                conflicts = [name for name, config in imported_roles.items()
+                             if name in self.global_roles and self.global_roles.get(name) != config]
+                if conflicts and not messagebox.askyesno(
+                        "覆盖角色", f"有 {len(conflicts)} 个角色与现有角色同名但内容不同"
+                                    f"（如 '{conflicts[0]}'），是否覆盖？\n选择“否”将只导入新角色。"):
+                    imported_roles = {name: config for name, config in imported_roles.items()
+                                      if name not in self.global_roles}
 
-                messagebox.showinfo("成功", f"已从 {file_path} 导入 {len(imported_roles)} 个角色配置")
+                # 合并角色配置（各标签页通过变化通知更新角色列表）
+                changed = self.global_roles.update(imported_roles)
+
+                messagebox.showinfo("成功", f"已从 {file_path} 导入 {len(changed)} 个角色配置"
+                                          f"（{len(imported_roles) - len(changed)} 个与现有角色相同）")
             except Exception as e:
                 messagebox.showerror("错误", f"导入配置文件失败: {str(e)}")
 
+    def manage_api_profiles(self):
+        """接口配置管理对话框（每个接口配置拥有独立的端点、API Key和连接池）"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("接口配置")
+        dialog.geometry("700x420")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        # 配置列表
+        list_frame = ttk.Frame(dialog, padding="10")
+        list_frame.pack(fill=tk.BOTH, expand=True)
+
+        tree = ttk.Treeview(list_frame, columns=("名称", "地址", "API Key", "连接数", "并发"), show="headings")
+        for column, width in (("名称", 100), ("地址", 280), ("API Key", 100), ("连接数", 60), ("并发", 60)):
+            tree.heading(column, text=column)
+            tree.column(column, width=width)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        vsb = ttk.Scrollbar(list_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # 编辑区域
+        form = ttk.Frame(dialog, padding="10")
+        form.pack(fill=tk.X)
+
+        name_var = tk.StringVar()
+        url_var = tk.StringVar()
+        key_var = tk.StringVar()
+        key_env_var = tk.StringVar()
+        connections_var = tk.IntVar(value=10)
+        concurrency_var = tk.IntVar(value=8)
+
+        fields = (("名称:", name_var, 15), ("地址:", url_var, 45), ("API Key:", key_var, 25),
+                  ("Key环境变量:", key_env_var, 15))
+        for row, (label, var, width) in enumerate(fields):
+            ttk.Label(form, text=label).grid(row=row // 2, column=(row % 2) * 2, sticky=tk.W, pady=2)
+            ttk.Entry(form, textvariable=var, width=width,
+                      show="*" if var is key_var else "").grid(row=row // 2, column=(row % 2) * 2 + 1,
+                                                                sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text="连接池大小:").grid(row=2, column=0, sticky=tk.W, pady=2)
+        ttk.Spinbox(form, from_=1, to=100, textvariable=connections_var, width=8).grid(row=2, column=1, sticky=tk.W,
+                                                                                       padx=(5, 10))
+        ttk.Label(form, text="最大并发:").grid(row=2, column=2, sticky=tk.W, pady=2)
+        ttk.Spinbox(form, from_=1, to=100, textvariable=concurrency_var, width=8).grid(row=2, column=3, sticky=tk.W,
+                                                                                       padx=(5, 10))
+
+        def refresh():
+            tree.delete(*tree.get_children())
+            for name, profile in self.api_router.profiles.items():
+                tree.insert("", "end", iid=name, values=(
+                    name, profile.get("base_url", ""),
+                    mask_api_key(profile.get("api_key", "")) or profile.get("api_key_env", ""),
+                    profile.get("max_connections", 10), profile.get("max_concurrency", 8)))
+
+        def on_select(event):
+            selection = tree.selection()
+            if not selection:
+                return
+            profile = self.api_router.profiles.get(selection[0], {})
+            name_var.set(selection[0])
+            url_var.set(profile.get("base_url", ""))
+            key_var.set(profile.get("api_key", ""))
+            key_env_var.set(profile.get("api_key_env", ""))
+            connections_var.set(profile.get("max_connections", 10))
+            concurrency_var.set(profile.get("max_concurrency", 8))
+
+        def on_save():
+            name = name_var.get().strip()
+            if not name:
+                messagebox.showwarning("警告", "请输入配置名称", parent=dialog)
+                return
+            try:
+                # 保留密钥池中配置的密钥
+                self.api_router.profiles[name] = dict(self.api_router.profiles.get(name, {}), **{
+                    "base_url": url_var.get().strip(),
+                    "api_key": key_var.get().strip(),
+                    "api_key_env": key_env_var.get().strip(),
+                    "max_connections": connections_var.get(),
+                    "max_concurrency": concurrency_var.get()
+                })
+                self.api_router.save_profiles()
+            except Exception as e:
+                messagebox.showerror("错误", f"保存接口配置失败: {str(e)}", parent=dialog)
+                return
+            refresh()
+
+        def on_delete():
+            selection = tree.selection()
+            if selection and messagebox.askyesno("确认删除", f"确定要删除接口配置 '{selection[0]}' 吗？",
+                                                 parent=dialog):
+                self.api_router.profiles.pop(selection[0], None)
+                self.api_router.save_profiles()
+                refresh()
+
+        tree.bind("<<TreeviewSelect>>", on_select)
+        refresh()
+
+        button_frame = ttk.Frame(dialog, padding="10")
+        button_frame.pack(fill=tk.X)
+        ttk.Button(button_frame, text="保存", command=on_save, width=10).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="删除", command=on_delete, width=10).pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="关闭", command=dialog.destroy, width=10).pack(side=tk.RIGHT)
+
+    def manage_key_pool(self):
+        """密钥池对话框：为接口配置添加多个API Key（权重、每分钟请求数/token数限制），实时显示每个密钥的状态和计数"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("密钥池")
+        dialog.geometry("980x460")
+        dialog.transient(self.root)
+
+        columns = (("profile", "接口配置", 90), ("key", "API Key", 110), ("weight", "权重", 45), ("rpm", "RPM限制", 65),
+                   ("tpm", "TPM限制", 70), ("status", "状态", 80), ("in_flight", "进行中", 55),
+                   ("per_minute", "请求/分", 60), ("tokens_per_minute", "Tokens/分", 75), ("requests", "请求", 55),
+                   ("errors", "错误", 50), ("tokens", "Tokens(输入/输出)", 120), ("last_error", "最近错误", 80))
+        list_frame = ttk.Frame(dialog, padding="10")
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        tree = ttk.Treeview(list_frame, columns=[name for name, _, _ in columns], show="headings")
+        for name, title, width in columns:
+            tree.heading(name, text=title)
+            tree.column(name, width=width, minwidth=40, anchor=tk.W if name in ("profile", "key", "status") else tk.E)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        vsb = ttk.Scrollbar(list_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+
+        form = ttk.Frame(dialog, padding="10")
+        form.pack(fill=tk.X)
+        profile_var = tk.StringVar(value=ApiRouter.DEFAULT_PROFILE)
+        key_var = tk.StringVar()
+        key_env_var = tk.StringVar()
+        weight_var = tk.DoubleVar(value=1.0)
+        rpm_var = tk.IntVar(value=0)
+        tpm_var = tk.IntVar(value=0)
+        ttk.Label(form, text="接口配置:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        profile_combo = ttk.Combobox(form, textvariable=profile_var, width=12)
+        profile_combo.grid(row=0, column=1, sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text="API Key:").grid(row=0, column=2, sticky=tk.W)
+        ttk.Entry(form, textvariable=key_var, width=30, show="*").grid(row=0, column=3, sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text="Key环境变量:").grid(row=0, column=4, sticky=tk.W)
+        ttk.Entry(form, textvariable=key_env_var, width=15).grid(row=0, column=5, sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text="权重:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        ttk.Spinbox(form, from_=0.1, to=100, increment=0.5, textvariable=weight_var, width=8).grid(
+            row=1, column=1, sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text="每分钟请求(0不限):").grid(row=1, column=2, sticky=tk.W)
+        ttk.Spinbox(form, from_=0, to=100000, textvariable=rpm_var, width=10).grid(row=1, column=3, sticky=tk.W,
+                                                                                  padx=(5, 10))
+        ttk.Label(form, text="每分钟tokens(0不限):").grid(row=1, column=4, sticky=tk.W)
+        ttk.Spinbox(form, from_=0, to=100000000, increment=1000, textvariable=tpm_var, width=12).grid(
+            row=1, column=5, sticky=tk.W, padx=(5, 10))
+        ttk.Label(form, text=f"\"{ApiRouter.DEFAULT_PROFILE}\"中的密钥与全局API Key一起用于未指定接口配置的角色；"
+                             "修改后计数重新开始", foreground="gray").grid(row=2, column=0, columnspan=6, sticky=tk.W)
+
+        def configured_keys():
+            """(接口配置名, 序号, 条目)，以及全局API Key"""
+            rows = []
+            for name, profile in self.api_router.profiles.items():
+                for index, entry in enumerate(profile.get("api_keys") or []):
+                    rows.append((name, index, entry))
+            return rows
+
+        def refresh():
+            if not dialog.winfo_exists():
+                return
+            profile_combo['values'] = [ApiRouter.DEFAULT_PROFILE] + [
+                name for name in self.api_router.profile_names() if name != ApiRouter.DEFAULT_PROFILE]
+            stats = self.api_router.key_stats()
+            global_key = self.api_key.get().strip()
+            rows = [("全局", "global", {"api_key": global_key})] if global_key else []
+            rows += [(name, f"{name}\t{index}", entry) for name, index, entry in configured_keys()]
+            # 密钥不变时原地更新计数，不打断选中和编辑
+            if [iid for _, iid, _ in rows] != list(tree.get_children()):
+                tree.delete(*tree.get_children())
+                for _, iid, _ in rows:
+                    tree.insert("", tk.END, iid=iid)
+            for profile_name, iid, entry in rows:
+                api_key = entry.get("api_key") or os.environ.get(entry.get("api_key_env") or "", "")
+                row = stats.get(api_key, {})
+                tree.item(iid, values=(
+                    profile_name, mask_api_key(api_key)[7:] or f"${entry.get('api_key_env', '')}",
+                    entry.get("weight", 1), entry.get("rpm", 0) or "-", entry.get("tpm", 0) or "-",
+                    row.get("status", "未使用"), row.get("in_flight", 0), row.get("requests_per_minute", 0),
+                    row.get("tokens_per_minute", 0), row.get("requests", 0), row.get("errors", 0),
+                    f"{row.get('prompt_tokens', 0)}/{row.get('completion_tokens', 0)}", row.get("last_error", "")))
+            dialog.after(1000, refresh)
+
+        def on_select(event):
+            selection = tree.selection()
+            if not selection or selection[0] == "global":
+                return
+            name, index = selection[0].split("\t")
+            entry = self.api_router.profiles[name]["api_keys"][int(index)]
+            profile_var.set(name)
+            key_var.set(entry.get("api_key", ""))
+            key_env_var.set(entry.get("api_key_env", ""))
+            weight_var.set(entry.get("weight", 1))
+            rpm_var.set(entry.get("rpm", 0))
+            tpm_var.set(entry.get("tpm", 0))
+
+        def on_save():
+            name = profile_var.get().strip()
+            if not name:
+                messagebox.showwarning("警告", "请选择接口配置", parent=dialog)
+                return
+            if not key_var.get().strip() and not key_env_var.get().strip():
+                messagebox.showwarning("警告", "请输入API Key或Key环境变量", parent=dialog)
+                return
+            try:
+                entry = {"api_key": key_var.get().strip(), "api_key_env": key_env_var.get().strip(),
+                         "weight": weight_var.get(), "rpm": rpm_var.get(), "tpm": tpm_var.get()}
+                profile = self.api_router.profiles.setdefault(name, {})
+                keys = profile.setdefault("api_keys", [])
+                # 选中的是本接口配置中的条目时更新，否则添加
+                selection = tree.selection()
+                if selection and selection[0] != "global" and selection[0].split("\t")[0] == name:
+                    keys[int(selection[0].split("\t")[1])] = entry
+                else:
+                    keys.append(entry)
+                self.api_router.save_profiles()
+            except Exception as e:
+                messagebox.showerror("错误", f"保存密钥失败: {str(e)}", parent=dialog)
+                return
+            tree.selection_set(())
+
+        def on_delete():
+            selection = tree.selection()
+            if not selection or selection[0] == "global":
+                return
+            name, index = selection[0].split("\t")
+            if messagebox.askyesno("确认删除", "确定要从密钥池删除选中的密钥吗？", parent=dialog):
+                self.api_router.profiles[name]["api_keys"].pop(int(index))
+                self.api_router.save_profiles()
+                tree.selection_set(())
+
+        tree.bind("<<TreeviewSelect>>", on_select)
+        refresh()
+
+        button_frame = ttk.Frame(dialog, padding="10")
+        button_frame.pack(fill=tk.X)
+        ttk.Button(button_frame, text="添加/更新", command=on_save, width=10).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(button_frame, text="删除", command=on_delete, width=10).pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="关闭", command=dialog.destroy, width=10).pack(side=tk.RIGHT)
+
     def export_global_roles(self):
         """导出全局角色配置到文件"""
         file_path = filedialog.asksaveasfilename(
@@ -706,8 +6135,7 @@ class DeepSeekAPIMultiTabTool:
 
         if file_path:
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.global_roles, f, ensure_ascii=False, indent=2)
+                atomic_write_text(file_path, json.dumps(dict(self.global_roles.items()), ensure_ascii=False, indent=2))
                 messagebox.showinfo("成功", f"角色配置已保存到 {file_path}")
             except Exception as e:
                 messagebox.showerror("错误", f"保存配置文件失败: {str(e)}")
@@ -719,13 +6147,16 @@ class OptimizedMultiRoleTab(ttk.Frame):
     def __init__(self, parent, tab_id, global_api_key, global_base_url,
                  global_timeout, global_stream_response, global_roles,
                  on_token_update=None, on_save_role=None, on_load_role=None,
-                 on_update_tab_title=None, log_dir="api_logs"):
+                 on_update_tab_title=None, log_dir="api_logs", api_router=None,
+                 log_writer=None, session_store=None):
         super().__init__(parent)
 
         self.tab_id = tab_id
         self.parent = parent
         self.on_update_tab_title = on_update_tab_title
         self.log_dir = log_dir
+        self.log_writer = log_writer or ApiLogWriter(log_dir)  # 异步日志写入器
+        self.session_store = session_store  # 会话持久化（为None时不保存）
         self.tab_type = "optimized_multi_role"
 
         # 全局配置引用
@@ -734,6 +6165,9 @@ class OptimizedMultiRoleTab(ttk.Frame):
         self.global_timeout = global_timeout
         self.global_stream_response = global_stream_response
 
+        # API路由（按角色选择端点、API Key和连接池）
+        self.api_router = api_router or ApiRouter()
+
         # 回调函数
         self.on_token_update = on_token_update
         self.on_save_role = on_save_role
@@ -750,17 +6184,20 @@ class OptimizedMultiRoleTab(ttk.Frame):
         self.iteration_count = tk.IntVar(value=3)  # 循环次数
         self.initial_prompt = tk.StringVar(value="请开始你们的对话")  # 初始提示
 
-        # 对话状态
-        self.current_role_index = 0  # 当前角色索引
-        self.current_iteration = 0  # 当前循环次数
-        self.dialog_history = []  # 对话历史记录
-        self.is_running = False  # 是否正在运行
-        self.stop_requested = False  # 是否请求停止
-        self.response_queue = queue.Queue()  # 用于流式输出的队列
-
-        # Token统计
-        self.total_prompt_tokens = 0
-        self.total_completion_tokens = 0
+        # 提前停止策略
+        self.early_stop = tk.BooleanVar(value=False)  # 是否启用相似度收敛检测
+        self.similarity_threshold = tk.DoubleVar(value=0.85)  # 相似度阈值
+        self.stop_pattern = tk.StringVar(value="")  # 停止词/正则
+        self.max_run_tokens = tk.IntVar(value=0)  # 单次运行Token预算，0为不限
+
+        # 对话引擎（请求、流式解析、Token统计和日志），标签页只负责配置和显示
+        self.response_queue = queue.Queue()  # 引擎产出的流式输出，由界面线程显示
+        self.engine = MultiRolePipelineEngine(tab_id, self.api_router, self.log_writer,
+                                              emit=self.response_queue.put, on_token_update=on_token_update,
+                                              on_turn=self.on_engine_turn,
+                                              on_progress=self.update_progress_display)
+        self.dialog_history = self.engine.history  # 对话历史记录（较早的轮次溢出到临时文件）
+        self.request_timings = deque(maxlen=REQUEST_TIMING_HISTORY)  # 最近请求的分阶段计时
 
         # 角色ID计数器
         self.role_id_counter = 0
@@ -774,6 +6211,9 @@ class OptimizedMultiRoleTab(ttk.Frame):
         # 加载配置（如果有）
         self.load_config()
 
+        # 角色库变化时刷新可选角色列表
+        self.global_roles.subscribe(self.on_roles_changed)
+
         # 开始队列处理
         self.process_response_queue()
 
@@ -827,16 +6267,10 @@ class OptimizedMultiRoleTab(ttk.Frame):
         available_frame = ttk.LabelFrame(management_frame, text="可用角色", padding="5")
         available_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 5))
 
-        # 可用角色列表
-        self.available_listbox = tk.Listbox(available_frame, selectmode=tk.SINGLE, height=8)
-        self.available_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        scrollbar1 = ttk.Scrollbar(available_frame, orient=tk.VERTICAL, command=self.available_listbox.yview)
-        scrollbar1.pack(side=tk.RIGHT, fill=tk.Y)
-        self.available_listbox.config(yscrollcommand=scrollbar1.set)
-
-        # 填充可用角色
-        self.update_available_roles()
+        # 可用角色列表（可输入筛选，双击添加）
+        self.role_picker = RolePicker(available_frame, self.global_roles, height=8,
+                                      on_activate=self.add_selected_role)
+        self.role_picker.pack(fill=tk.BOTH, expand=True)
 
         # 中间：控制按钮
         button_frame = ttk.Frame(management_frame)
@@ -904,6 +6338,25 @@ class OptimizedMultiRoleTab(ttk.Frame):
                                         textvariable=self.iteration_count, width=10)
         iteration_spinbox.pack(side=tk.LEFT, padx=(5, 0))
 
+        # 提前停止
+        stop_frame = ttk.LabelFrame(conn_frame, text="提前停止", padding="5")
+        stop_frame.pack(fill=tk.X, pady=(10, 0))
+
+        similarity_frame = ttk.Frame(stop_frame)
+        similarity_frame.pack(fill=tk.X)
+        ttk.Checkbutton(similarity_frame, text="回复趋于重复时停止，相似度阈值:",
+                        variable=self.early_stop).pack(side=tk.LEFT)
+        ttk.Spinbox(similarity_frame, from_=0.5, to=1.0, increment=0.05,
+                    textvariable=self.similarity_threshold, width=6).pack(side=tk.LEFT, padx=(5, 0))
+
+        pattern_frame = ttk.Frame(stop_frame)
+        pattern_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(pattern_frame, text="停止词/正则:").pack(side=tk.LEFT)
+        ttk.Entry(pattern_frame, textvariable=self.stop_pattern, width=20).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(pattern_frame, text="Token预算:").pack(side=tk.LEFT)
+        ttk.Spinbox(pattern_frame, from_=0, to=10000000, increment=10000,
+                    textvariable=self.max_run_tokens, width=10).pack(side=tk.LEFT, padx=(5, 0))
+
     def create_initial_prompt_section(self, parent):
         """创建初始提示区域（带滚动条）"""
         prompt_frame = ttk.LabelFrame(parent, text="初始提示", padding="5")
@@ -943,6 +6396,9 @@ class OptimizedMultiRoleTab(ttk.Frame):
         ttk.Button(button_frame, text="🧹 清空历史",
                    command=self.clear_dialog_history, width=12).pack(side=tk.LEFT, padx=(0, 10))
 
+        ttk.Button(button_frame, text="💾 导出对话",
+                   command=self.export_dialog_history, width=12).pack(side=tk.LEFT, padx=(0, 10))
+
         ttk.Button(button_frame, text="📋 复制配置",
                    command=self.copy_config, width=12).pack(side=tk.LEFT)
 
@@ -963,20 +6419,22 @@ class OptimizedMultiRoleTab(ttk.Frame):
         dialog_frame = ttk.LabelFrame(parent, text="💬 多角色协同", padding="10")
         dialog_frame.pack(fill=tk.BOTH, expand=True)
 
+        # 最近请求的计时
+        self.timing_panel = TimingPanel(dialog_frame)
+        self.timing_panel.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
+
         # 对话显示
         self.dialog_text = scrolledtext.ScrolledText(dialog_frame, height=20,
                                                      font=("微软雅黑", 10), wrap=tk.WORD,
                                                      state='disabled')
         self.dialog_text.pack(fill=tk.BOTH, expand=True)
 
-    def update_available_roles(self):
-        """更新可用角色列表"""
-        self.available_listbox.delete(0, tk.END)
-        role_names = list(self.global_roles.keys())
+        # 思考过程区域
+        self.reasoning_view = CollapsibleReasoningView(self.dialog_text)
 
-        # 始终显示所有可用角色，允许重复添加
-        for role_name in role_names:
-            self.available_listbox.insert(tk.END, role_name)
+    def update_available_roles(self):
+        """更新可用角色列表（始终显示所有可用角色，允许重复添加）"""
+        self.role_picker.schedule_refresh()
 
     def update_ordered_roles_display(self):
         """更新已排序角色显示，为重复角色添加编号"""
@@ -1014,6 +6472,10 @@ class OptimizedMultiRoleTab(ttk.Frame):
 
             self.ordered_listbox.insert(tk.END, display_name)
 
+    def on_roles_changed(self, names):
+        """角色库变化通知"""
+        self.update_available_roles()
+
     def refresh_role_lists(self):
         """刷新角色列表"""
         self.update_available_roles()
@@ -1022,12 +6484,11 @@ class OptimizedMultiRoleTab(ttk.Frame):
 
     def add_selected_role(self):
         """添加选中的角色到顺序列表"""
-        selected = self.available_listbox.curselection()
-        if not selected:
+        role_name = self.role_picker.get_selected()
+        if not role_name:
             messagebox.showwarning("警告", "请先选择一个角色")
             return
 
-        role_name = self.available_listbox.get(selected[0])
         role_config = self.global_roles.get(role_name)
 
         if role_config:
@@ -1042,7 +6503,6 @@ class OptimizedMultiRoleTab(ttk.Frame):
             })
 
             # 更新显示
-            self.update_available_roles()
             self.update_ordered_roles_display()
             self.update_connector_display()
 
@@ -1066,7 +6526,6 @@ class OptimizedMultiRoleTab(ttk.Frame):
                             if conn["from"] != role_id and conn["to"] != role_id]
 
         # 更新显示
-        self.update_available_roles()
         self.update_ordered_roles_display()
         self.update_connector_display()
 
@@ -1198,16 +6657,49 @@ class OptimizedMultiRoleTab(ttk.Frame):
                 return conn["connector"]
         return "，"  # 默认连接词
 
+    def get_config(self):
+        """当前多角色协同配置"""
+        return {
+            "ordered_roles": self.ordered_roles,
+            "connections": self.connections,
+            "connect_end_to_start": self.connect_end_to_start.get(),
+            "keep_mind": self.keep_mind.get(),
+            "iteration_count": self.iteration_count.get(),
+            "initial_prompt": self.initial_prompt.get(),
+            "early_stop": self.early_stop.get(),
+            "similarity_threshold": self.similarity_threshold.get(),
+            "stop_pattern": self.stop_pattern.get(),
+            "max_run_tokens": self.max_run_tokens.get()
+        }
+
+    def apply_config(self, config):
+        """应用多角色协同配置并刷新界面"""
+        self.ordered_roles = config.get("ordered_roles", [])
+        self.connections = config.get("connections", [])
+        self.connect_end_to_start.set(config.get("connect_end_to_start", False))
+        self.keep_mind.set(config.get("keep_mind", False))
+        self.iteration_count.set(config.get("iteration_count", 3))
+        self.initial_prompt.set(config.get("initial_prompt", "请开始你们的对话"))
+        self.early_stop.set(config.get("early_stop", False))
+        self.similarity_threshold.set(config.get("similarity_threshold", 0.85))
+        self.stop_pattern.set(config.get("stop_pattern", ""))
+        self.max_run_tokens.set(config.get("max_run_tokens", 0))
+        # 角色ID计数器需大于已有ID，避免新增角色ID冲突
+        self.role_id_counter = max([self.role_id_counter] + [info.get("id", 0) + 1 for info in self.ordered_roles])
+
+        # 更新显示
+        self.update_available_roles()
+        self.update_ordered_roles_display()
+        self.update_connector_display()
+
+        # 更新初始提示文本框
+        self.initial_prompt_text.delete("1.0", tk.END)
+        self.initial_prompt_text.insert("1.0", self.initial_prompt.get())
+
     def save_config(self):
         """保存配置到文件"""
         try:
-            config = {
-                "ordered_roles": self.ordered_roles,
-                "connections": self.connections,
-                "connect_end_to_start": self.connect_end_to_start.get(),
-                "iteration_count": self.iteration_count.get(),
-                "initial_prompt": self.initial_prompt.get()
-            }
+            config = self.get_config()
 
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
@@ -1223,21 +6715,7 @@ class OptimizedMultiRoleTab(ttk.Frame):
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     config = json.load(f)
 
-                # 加载配置
-                self.ordered_roles = config.get("ordered_roles", [])
-                self.connections = config.get("connections", [])
-                self.connect_end_to_start.set(config.get("connect_end_to_start", False))
-                self.iteration_count.set(config.get("iteration_count", 3))
-                self.initial_prompt.set(config.get("initial_prompt", "请开始你们的对话"))
-
-                # 更新显示
-                self.update_available_roles()
-                self.update_ordered_roles_display()
-                self.update_connector_display()
-
-                # 更新初始提示文本框
-                self.initial_prompt_text.delete("1.0", tk.END)
-                self.initial_prompt_text.insert("1.0", self.initial_prompt.get())
+                self.apply_config(config)
 
             except Exception as e:
                 print(f"加载配置失败: {e}")
@@ -1254,21 +6732,7 @@ class OptimizedMultiRoleTab(ttk.Frame):
                 with open(file_path, 'r', encoding='utf-8') as f:
                     config = json.load(f)
 
-                # 加载配置
-                self.ordered_roles = config.get("ordered_roles", [])
-                self.connections = config.get("connections", [])
-                self.connect_end_to_start.set(config.get("connect_end_to_start", False))
-                self.iteration_count.set(config.get("iteration_count", 3))
-                self.initial_prompt.set(config.get("initial_prompt", "请开始你们的对话"))
-
-                # 更新显示
-                self.update_available_roles()
-                self.update_ordered_roles_display()
-                self.update_connector_display()
-
-                # 更新初始提示文本框
-                self.initial_prompt_text.delete("1.0", tk.END)
-                self.initial_prompt_text.insert("1.0", self.initial_prompt.get())
+                self.apply_config(config)
 
                 messagebox.showinfo("成功", "配置已加载")
             except Exception as e:
@@ -1277,367 +6741,133 @@ class OptimizedMultiRoleTab(ttk.Frame):
     def copy_config(self):
         """复制配置到剪贴板"""
         try:
-            config = {
-                "ordered_roles": self.ordered_roles,
-                "connections": self.connections,
-                "connect_end_to_start": self.connect_end_to_start.get(),
-                "iteration_count": self.iteration_count.get(),
-                "initial_prompt": self.initial_prompt.get()
-            }
+            config = self.get_config()
 
             config_json = json.dumps(config, ensure_ascii=False, indent=2)
             self.clipboard_clear()
             self.clipboard_append(config_json)
             messagebox.showinfo("成功", "配置已复制到剪贴板")
-        except Exception as e:
-            messagebox.showerror("错误", f"复制配置失败: {str(e)}")
-
-    def process_response_queue(self):
-        """处理响应队列，实现流式输出"""
-        try:
-            while True:
-                try:
-                    text = self.response_queue.get_nowait()
-                    if text is None:
-                        break
-                    self.append_to_dialog(text)
-                except queue.Empty:
-                    break
-        except:
-            pass
-        finally:
-            # 继续调度
-            if self.is_running:
-                self.after(100, self.process_response_queue)
-
-    def start_dialog(self):
-        """开始多角色协同"""
-        # 检查API Key
-        api_key = self.global_api_key.get().strip()
-        if not api_key:
-            messagebox.showerror("错误", "请输入API Key")
-            return
-
-        # 检查角色数量
-        if len(self.ordered_roles) < 2:
-            messagebox.showwarning("警告", "请至少选择2个角色")
-            return
-
-        # 重置状态
-        self.current_role_index = 0
-        self.current_iteration = 0
-        self.is_running = True
-        self.stop_requested = False
-
-        # 清空对话历史
-        self.dialog_text.config(state='normal')
-        self.dialog_text.delete("1.0", tk.END)
-        self.dialog_text.config(state='disabled')
-
-        # 清空响应队列
-        while not self.response_queue.empty():
-            try:
-                self.response_queue.get_nowait()
-            except:
-                pass
-
-        # 禁用开始按钮，启用停止按钮
-        self.start_button.config(state='disabled')
-        self.stop_button.config(state='normal')
-
-        # 清空历史记录
-        self.dialog_history = []
-
-        # 更新状态
-        self.status_var.set("对话开始...")
-        self.update_progress_display()
-
-        # 启动队列处理器
-        self.process_response_queue()
-
-        # 在新线程中开始对话
-        thread = threading.Thread(target=self.run_dialog_cycle)
-        thread.daemon = True
-        thread.start()
-
-    def stop_dialog(self):
-        """停止多角色协同"""
-        if self.is_running:
-            self.stop_requested = True
-            self.status_var.set("正在停止...")
-
-    def run_dialog_cycle(self):
-        """运行对话循环（支持流式输出）"""
-        try:
-            # 获取初始提示
-            initial_prompt = self.initial_prompt.get().strip() or "请开始你们的对话"
-
-            # 记录初始信息
-            self.response_queue.put("=" * 60 + "\n")
-            self.response_queue.put(f"多角色协同开始（优化版）\n")
-
-            # 显示角色顺序
-            role_names = [role_info["role"]["name"] for role_info in self.ordered_roles]
-            self.response_queue.put(f"角色顺序: {' → '.join(role_names)}\n")
-
-            self.response_queue.put(f"首尾相连: {'是' if self.connect_end_to_start.get() else '否'}\n")
-
-            self.response_queue.put(f"循环次数: {self.iteration_count.get()}\n")
-            self.response_queue.put(f"初始提示: {initial_prompt}\n")
-            self.response_queue.put("=" * 60 + "\n\n")
-
-            # 开始对话循环
-            last_response = initial_prompt
-            total_iterations = self.iteration_count.get()
-
-            for iteration in range(total_iterations):
-                if self.stop_requested:
-                    break
-
-                self.current_iteration = iteration + 1
-                self.update_progress_display()
-
-                # 记录迭代开始
-                self.response_queue.put(f"\n{'=' * 40}\n")
-                self.response_queue.put(f"第 {self.current_iteration} 轮对话\n")
-                self.response_queue.put(f"{'=' * 40}\n\n")
-
-                # 每个角色依次发言
-                for role_index, role_info in enumerate(self.ordered_roles):
-                    if self.stop_requested:
-                        break
-
-                    self.current_role_index = role_index
-                    self.update_progress_display()
-
-                    role_config = role_info["role"]
-                    role_id = role_info["id"]
-
-                    next_index = (role_index + 1) % len(self.ordered_roles)
-                    next_role_id = self.ordered_roles[next_index]["id"]
-
-                    # 显示当前角色
-                    self.response_queue.put(f"【{role_config['name']}】\n")
-
-                    # 构建消息（将上一个角色的回复+连接词作为提问）
-                    messages = self.build_messages_for_role(role_config, role_id, next_role_id,
-                                                            last_response, iteration, role_index)
-
-                    # 调用API（流式输出）
-                    response = self.call_api_for_role(role_config, messages)
-
-                    if response:
-                        # 更新最后响应
-                        last_response = response
-
-                        # 记录对话
-                        dialog_entry = {
-                            "iteration": self.current_iteration,
-                            "role_index": role_index,
-                            "role_name": role_config["name"],
-                            "message": messages[-1]["content"] if messages else "",
-                            "response": response,
-                            "timestamp": datetime.now().strftime("%H:%M:%S")
-                        }
-                        self.dialog_history.append(dialog_entry)
-
-                        # 添加换行
-                        self.response_queue.put("\n\n")
-
-                        # 短暂暂停，让对话更自然
-                        if not self.stop_requested:
-                            time.sleep(1)
-                    else:
-                        # API调用失败
-                        self.response_queue.put("API调用失败\n\n")
-                        break
-
-                # 检查是否应该停止
-                if self.stop_requested:
-                    break
-
-            # 对话结束
-            self.response_queue.put("\n" + "=" * 60 + "\n")
-            self.response_queue.put(f"对话{'已停止' if self.stop_requested else '完成'}\n")
-            self.response_queue.put("=" * 60 + "\n")
-
-        except Exception as e:
-            self.response_queue.put(f"\n发生错误: {str(e)}\n")
-        finally:
-            self.response_queue.put(None)  # 发送结束信号
-            self.finish_dialog()
-
-    def build_messages_for_role(self, role_config, role_id, next_role_id, last_response, iteration, role_index):
-        """为角色构建消息列表（将上一个角色的回复+连接词作为提问）"""
-        messages = []
-
-        # 添加系统提示
-        messages.append({"role": "system", "content": role_config["system_prompt"]})
-
-        # 如果是第一轮第一个角色，使用初始提示
-        if iteration == 0 and role_index == 0:
-            messages.append({"role": "user", "content": self.initial_prompt.get().strip()})
-        else:
-            # 获取连接词
-            connector = self.get_connector(role_id, next_role_id)
-            # 构建提问：连接词 + 上一个角色的回复
-            prompt = f"{last_response}{connector}"
-            if self.keep_mind.get() and role_index == 0:
-                # 保持初衷，加入初始提示
-                prompt += f"\n别忘记我们的初衷是\n{self.initial_prompt.get().strip()}"
-            messages.append({"role": "user", "content": prompt})
-
-        return messages
+        except Exception as e:
+            messagebox.showerror("错误", f"复制配置失败: {str(e)}")
 
-    def call_api_for_role(self, role_config, messages):
-        """为角色调用API（支持流式输出）"""
+    def process_response_queue(self):
+        """处理响应队列，实现流式输出"""
         try:
-            api_key = self.global_api_key.get().strip()
-            if not api_key:
-                return None
+            while True:
+                try:
+                    text = self.response_queue.get_nowait()
+                    if text is None:
+                        break
+                    if isinstance(text, tuple):
+                        kind, payload = text
+                        if kind == "text":
+                            content, timer, enqueued_at = payload
+                            self.append_to_dialog(content)
+                            timer.on_render(enqueued_at)
+                        elif kind == "log":
+                            self.save_timed_log(payload)
+                        elif kind == "status":
+                            self.status_var.set(payload)
+                        elif kind == "reasoning":
+                            self.reasoning_view.append(payload)
+                        elif kind == "reasoning_end":
+                            self.reasoning_view.close(payload)
+                        continue
+                    self.append_to_dialog(text)
+                except queue.Empty:
+                    break
+        except:
+            pass
+        finally:
+            # 继续调度（对话结束后仍需处理完队列中剩余的内容和日志）
+            if self.engine.is_running or not self.response_queue.empty():
+                self.after(100, self.process_response_queue)
 
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
+    def start_dialog(self):
+        """开始多角色协同"""
+        # 检查角色数量
+        if len(self.ordered_roles) < 2:
+            messagebox.showwarning("警告", "请至少选择2个角色")
+            return
 
-            data = {
-                "model": "deepseek-chat",
-                "messages": messages,
-                "temperature": role_config.get("temperature", 0.7),
-                "max_tokens": role_config.get("max_tokens", 2000),
-                "stream": True  # 启用流式输出
-            }
+        # 检查API Key（使用自定义接口配置的角色可以不依赖全局API Key）
+        settings = self.get_api_settings()
+        for role_info in self.ordered_roles:
+            if not self.api_router.has_key(role_info["role"], settings.api_key):
+                messagebox.showerror("错误", "请输入API Key")
+                return
 
-            # 添加深度思考参数
-            if role_config.get("deep_thought", False):
-                data["deep_thought"] = True
-                data["model"] = "deepseek-reasoner"
-                del data["max_tokens"]
-
-            # 获取配置
-            base_url = self.global_base_url.get().strip()
-            timeout = self.global_timeout.get()
-
-            # 记录API请求
-            log_entry = {
-                "timestamp": datetime.now().strftime("%Y-%m-d %H:%M:%S"),
-                "role_name": role_config["name"],
-                "iteration": self.current_iteration,
-                "role_index": self.current_role_index,
-                "request": {
-                    "url": base_url,
-                    "headers": {"Authorization": "Bearer ***" + api_key[-4:] if api_key else ""},
-                    "data": data
-                }
-            }
+        # 读取配置并重置引擎的运行状态
+        try:
+            config = self.get_config()
+            self.engine.prepare(config)
+        except (tk.TclError, ValueError) as e:
+            messagebox.showerror("错误", f"提前停止配置无效: {str(e)}")
+            return
 
-            # 发送流式请求
-            response = requests.post(base_url, headers=headers, json=data, timeout=timeout, stream=True)
+        # 清空对话历史
+        self.dialog_text.config(state='normal')
+        self.dialog_text.delete("1.0", tk.END)
+        self.dialog_text.config(state='disabled')
+        self.reasoning_view.reset()
 
-            if response.status_code == 200:
-                collected_chunks = []
-                collected_content = ""
+        # 清空响应队列
+        while not self.response_queue.empty():
+            try:
+                self.response_queue.get_nowait()
+            except:
+                pass
 
-                # 处理流式响应
-                for line in response.iter_lines():
-                    if self.stop_requested:
-                        break
+        # 禁用开始按钮，启用停止按钮
+        self.start_button.config(state='disabled')
+        self.stop_button.config(state='normal')
 
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_str = line[6:]
-
-                            if data_str == '[DONE]':
-                                break
-
-                            try:
-                                data_json = json.loads(data_str)
-                                if 'choices' in data_json and data_json['choices']:
-                                    choice = data_json['choices'][0]
-                                    if 'delta' in choice and 'content' in choice['delta']:
-                                        content = choice['delta']['content']
-                                        if content:
-                                            collected_content += content
-                                            # 将内容放入队列
-                                            self.response_queue.put(content)
-
-                                    # 检查是否有token使用信息
-                                    if 'usage' in data_json:
-                                        usage = data_json.get('usage', {})
-                                        prompt_tokens = usage.get('prompt_tokens', 0)
-                                        completion_tokens = usage.get('completion_tokens', 0)
-
-                                        # 更新token统计
-                                        self.total_prompt_tokens += prompt_tokens
-                                        self.total_completion_tokens += completion_tokens
-
-                                        # 回调通知全局token更新
-                                        if self.on_token_update:
-                                            self.on_token_update(prompt_tokens, completion_tokens)
-                            except json.JSONDecodeError as e:
-                                print(f"JSON解析错误: {e}")
-                                continue
-
-                # 记录API响应
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "content": collected_content
-                }
-                self.save_api_log(log_entry)
+        # 引擎已清空历史记录
+        self.persist("clear")
+        self.persist("config", config=config)
 
-                return collected_content
-            else:
-                error_msg = f"API错误: {response.status_code}\n{response.text}"
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "error": response.text
-                }
-                self.save_api_log(log_entry)
-                self.response_queue.put(f"API错误: {response.status_code}\n")
-                return None
+        # 更新状态
+        self.status_var.set("对话开始...")
+        self.update_progress_display()
 
-        except Exception as e:
-            print(f"API调用失败: {e}")
-            self.response_queue.put(f"API调用失败: {str(e)}\n")
-            return None
+        # 启动队列处理器
+        self.process_response_queue()
 
-    def save_api_log(self, log_entry):
-        """保存API调用日志到文件，按日期目录+JSON格式"""
-        try:
-            # 获取当前日期，用于创建子目录
-            current_date = datetime.now().strftime("%Y-%m-%d")
+        # 在新线程中开始对话
+        thread = threading.Thread(target=self.run_dialog_cycle, args=(settings,))
+        thread.daemon = True
+        thread.start()
 
-            # 创建日期子目录
-            date_log_dir = os.path.join(self.log_dir, current_date)
-            if not os.path.exists(date_log_dir):
-                os.makedirs(date_log_dir)
+    def stop_dialog(self):
+        """停止多角色协同"""
+        if self.engine.is_running:
+            self.engine.stop()
+            self.status_var.set("正在停止...")
 
-            # 构建文件名：{角色名}{编号}_iter{循环次数}.json
-            role_name = log_entry['role_name']
-            role_index = log_entry.get('role_index', 0)
-            iteration = log_entry.get('iteration', 0)
+    def get_api_settings(self):
+        """读取全局接口设置（在界面线程调用）"""
+        return ApiSettings(self.global_api_key.get().strip(), self.global_base_url.get().strip(),
+                           self.global_timeout.get(), stream=True)
 
-            # 生成文件名
-            log_filename = f"{role_name}{role_index + 1}_iter{iteration}.json"
-            log_path = os.path.join(date_log_dir, log_filename)
+    def run_dialog_cycle(self, settings):
+        """运行对话循环（工作线程）"""
+        try:
+            self.engine.run(settings)
+        finally:
+            self.response_queue.put(None)  # 发送结束信号
+            self.finish_dialog()
 
-            # 准备JSON格式的日志数据
-            json_log = {
-                "timestamp": log_entry['timestamp'],
-                "role_name": log_entry['role_name'],
-                "role_index": log_entry.get('role_index', 0),
-                "iteration": log_entry.get('iteration', 0),
-                "request": log_entry['request'],
-                "response": log_entry.get('response', {})
-            }
+    def on_engine_turn(self, stored_entry):
+        """引擎完成一轮：写入会话日志"""
+        self.persist("append", entry=stored_entry)
+        self.persist("tokens", prompt=self.engine.prompt_tokens, completion=self.engine.completion_tokens)
 
-            # 写入JSON文件
-            with open(log_path, 'w', encoding='utf-8') as f:
-                json.dump(json_log, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存API日志失败: {e}")
+    def save_timed_log(self, log_entry):
+        """界面已显示本次请求的全部内容：补全计时（含显示延迟）后写日志并刷新计时面板"""
+        timing = self.engine.write_log(log_entry)
+        self.request_timings.append(dict(timing, role=log_entry.get("role_name"),
+                                         time=datetime.fromtimestamp(log_entry["ts"]).strftime("%H:%M:%S")))
+        self.timing_panel.show(self.request_timings)
 
     def append_to_dialog(self, text):
         """追加文本到对话显示"""
@@ -1648,31 +6878,38 @@ class OptimizedMultiRoleTab(ttk.Frame):
 
     def update_progress_display(self):
         """更新进度显示"""
+        engine = self.engine
         total_roles = len(self.ordered_roles)
         total_iterations = self.iteration_count.get()
 
-        if self.is_running:
-            current_step = (self.current_iteration - 1) * total_roles + self.current_role_index + 1
+        if engine.is_running:
+            current_step = (engine.current_iteration - 1) * total_roles + engine.current_role_index + 1
             total_steps = total_iterations * total_roles
-            self.progress_var.set(
-                f"进度: {current_step}/{total_steps} (第{self.current_iteration}轮, 角色{self.current_role_index + 1}/{total_roles})")
+            progress = (f"进度: {current_step}/{total_steps} "
+                        f"(第{engine.current_iteration}轮, 角色{engine.current_role_index + 1}/{total_roles})")
         else:
-            self.progress_var.set(f"进度: 0/{total_iterations * total_roles}")
+            progress = f"进度: 0/{total_iterations * total_roles}"
+
+        # 各路由的平均延迟
+        if engine.used_routes:
+            progress += "\n路由延迟: " + " | ".join(route.latency_text() for route in engine.used_routes.values())
+        self.progress_var.set(progress)
 
     def finish_dialog(self):
         """完成对话"""
-        self.is_running = False
         self.start_button.config(state='normal')
         self.stop_button.config(state='disabled')
 
-        if self.stop_requested:
+        if self.engine.stop_requested:
             self.status_var.set("对话已停止")
+        elif self.engine.stop_reason:
+            self.status_var.set(f"对话提前结束: {self.engine.stop_reason}")
         else:
             self.status_var.set("对话完成")
 
     def clear_dialog_history(self):
         """清空对话历史"""
-        if self.is_running:
+        if self.engine.is_running:
             messagebox.showwarning("警告", "请先停止对话")
             return
 
@@ -1680,21 +6917,94 @@ class OptimizedMultiRoleTab(ttk.Frame):
             self.dialog_text.config(state='normal')
             self.dialog_text.delete("1.0", tk.END)
             self.dialog_text.config(state='disabled')
+            self.reasoning_view.reset()
 
-            self.dialog_history = []
-            self.total_prompt_tokens = 0
-            self.total_completion_tokens = 0
+            self.dialog_history.clear()
+            self.engine.prompt_tokens = 0
+            self.engine.completion_tokens = 0
+            self.persist("clear")
+            self.persist("tokens", prompt=0, completion=0)
 
             self.status_var.set("准备就绪")
             self.progress_var.set("进度: 0/0")
 
+    def export_dialog_history(self):
+        """把对话记录导出为Markdown/JSONL/HTML（后台逐轮写入，运行中也可导出已完成的轮次）"""
+        if not len(self.dialog_history):
+            messagebox.showinfo("提示", "没有可导出的对话")
+            return
+
+        path = filedialog.asksaveasfilename(
+            title="导出对话",
+            defaultextension=".md",
+            initialfile=f"multi_role_{self.tab_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
+            filetypes=[(f"{name}文件", f"*.{ext}") for ext, name in DIALOG_EXPORT_FORMATS.items()]
+        )
+        if not path:
+            return
+
+        def run():
+            try:
+                count = export_dialog(self.dialog_history, path)
+                self.status_var.set(f"已导出 {count} 轮对话到 {os.path.basename(path)}")
+            except Exception as e:
+                print(f"导出对话失败: {e}")
+                self.status_var.set(f"导出对话失败: {e}")
+
+        self.status_var.set("正在导出对话...")
+        threading.Thread(target=run, daemon=True).start()
+
+    def persist(self, op, **fields):
+        """向会话日志追加一条操作（后台写入）"""
+        if self.session_store:
+            self.session_store.append(self.tab_id, dict(fields, op=op))
+
+    def restore_state(self, state, meta):
+        """从会话日志恢复配置、对话记录和Token统计"""
+        if state.get("config"):
+            self.apply_config(state["config"])
+
+        self.dialog_history.clear()
+        self.dialog_history.extend(state.get("history") or [])
+        self.engine.prompt_tokens = state.get("prompt_tokens", 0)
+        self.engine.completion_tokens = state.get("completion_tokens", 0)
+
+        # 一次性插入全部对话，避免逐条刷新界面
+        parts = []
+        last_iteration = None
+        for entry in self.dialog_history:
+            if entry.get("iteration") != last_iteration:
+                last_iteration = entry.get("iteration")
+                parts.append(f"\n{'=' * 40}\n第 {last_iteration} 轮对话\n{'=' * 40}\n\n")
+            parts.append(f"【{entry.get('role_name', '')}】\n{entry.get('response', '')}\n\n")
+        self.dialog_text.config(state='normal')
+        self.dialog_text.delete("1.0", tk.END)
+        self.dialog_text.insert(tk.END, "".join(parts))
+        self.dialog_text.see(tk.END)
+        self.dialog_text.config(state='disabled')
+
+    def get_workspace_meta(self):
+        """工作区布局中本标签页的摘要（用于启动时延迟加载）"""
+        last_time = self.dialog_history[-1].get("timestamp") if self.dialog_history else None
+        return {
+            "tab_id": self.tab_id,
+            "type": "multi_role",
+            "title": f"多角色协同(优化) {self.tab_id}",
+            "role_name": "多角色协同(优化)",
+            "role_config": None,
+            "prompt_tokens": self.engine.prompt_tokens,
+            "completion_tokens": self.engine.completion_tokens,
+            "message_count": len(self.dialog_history),
+            "last_time": last_time
+        }
+
     def get_dialog_history(self):
         """获取对话历史"""
         return self.dialog_history
 
     def get_token_counts(self):
         """获取Token计数"""
-        return self.total_prompt_tokens, self.total_completion_tokens
+        return self.engine.prompt_tokens, self.engine.completion_tokens
 
 
 class SessionTab(ttk.Frame):
@@ -1703,13 +7013,16 @@ class SessionTab(ttk.Frame):
     def __init__(self, parent, tab_id, global_api_key, global_base_url,
                  global_timeout, global_stream_response, global_roles,
                  on_token_update=None, on_save_role=None, on_load_role=None,
-                 on_update_tab_title=None, log_dir="api_logs"):
+                 on_update_tab_title=None, log_dir="api_logs", api_router=None,
+                 log_writer=None, session_store=None):
         super().__init__(parent)
 
         self.tab_id = tab_id
         self.parent = parent
         self.on_update_tab_title = on_update_tab_title
         self.log_dir = log_dir
+        self.log_writer = log_writer or ApiLogWriter(log_dir)  # 异步日志写入器
+        self.session_store = session_store  # 会话持久化（为None时不保存）
 
         # 全局配置引用
         self.global_api_key = global_api_key
@@ -1717,6 +7030,9 @@ class SessionTab(ttk.Frame):
         self.global_timeout = global_timeout
         self.global_stream_response = global_stream_response
 
+        # API路由（按角色选择端点、API Key和连接池）
+        self.api_router = api_router or ApiRouter()
+
         # 回调函数
         self.on_token_update = on_token_update
         self.on_save_role = on_save_role
@@ -1731,18 +7047,25 @@ class SessionTab(ttk.Frame):
         self.temperature = tk.DoubleVar(value=0.7)
         self.max_tokens = tk.IntVar(value=2000)
         self.deep_thought = tk.BooleanVar(value=False)
-
-        # 对话历史
-        self.conversation_history = []
-
-        # Token统计
-        self.prompt_tokens = 0
-        self.completion_tokens = 0
+        self.model = tk.StringVar(value="")  # 为空时按深度思考选择默认模型
+        self.role_base_url = tk.StringVar(value="")  # 为空时使用接口配置或全局Base URL
+        self.api_profile = tk.StringVar(value="")  # 为空时使用全局API Key
+        self.role_tags = tk.StringVar(value="")  # 逗号分隔的标签，用于角色库分类和筛选
+        self.memory_enabled = tk.BooleanVar(value=False)  # 记忆压缩：较早的历史在后台合并为摘要
+        self.memory_model = tk.StringVar(value="")  # 摘要使用的模型，为空时使用非思考模型
+
+        # 对话引擎（对话历史、请求、流式解析、Token统计和日志），标签页只负责配置和显示
+        self.response_queue = queue.Queue()  # 引擎产出的流式输出，由界面线程显示
+        self.engine = ChatSessionEngine(tab_id, self.api_router, self.log_writer,
+                                        emit=self.response_queue.put, on_token_update=self.on_engine_tokens,
+                                        on_history_entry=lambda entry: self.persist("append", entry=entry),
+                                        on_memory_update=self.on_memory_update)
 
         # 流式请求控制
         self.is_streaming = False
         self.stop_streaming = False
-        self.response_queue = queue.Queue()
+        self.cancel_token = CancelToken()  # 当前请求的取消令牌
+        self.request_timings = deque(maxlen=REQUEST_TIMING_HISTORY)  # 最近请求的分阶段计时
 
         # 创建界面
         self.create_widgets()
@@ -1783,9 +7106,12 @@ class SessionTab(ttk.Frame):
         role_select_frame.pack(fill=tk.X, pady=(0, 10))
 
         ttk.Label(role_select_frame, text="选择角色:").pack(side=tk.LEFT)
-        self.role_combo = ttk.Combobox(role_select_frame, textvariable=self.current_role,
-                                       state="readonly", width=20)
+        # 可输入名称或提示词筛选，下拉时才从角色库索引取匹配结果
+        self.role_combo = ttk.Combobox(role_select_frame, textvariable=self.current_role, width=20,
+                                       postcommand=self.update_role_combobox)
         self.role_combo.pack(side=tk.LEFT, padx=(5, 10))
+        self.role_combo.bind("<<ComboboxSelected>>", lambda e: self.load_selected_role())
+        self.role_combo.bind("<Return>", lambda e: self.role_combo.event_generate("<Down>"))
 
         # 加载按钮
         ttk.Button(role_select_frame, text="加载",
@@ -1800,6 +7126,8 @@ class SessionTab(ttk.Frame):
         name_frame.pack(fill=tk.X, pady=(0, 5))
         ttk.Label(name_frame, text="角色名称:").pack(side=tk.LEFT)
         ttk.Entry(name_frame, textvariable=self.role_name, width=30).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(name_frame, text="标签:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(name_frame, textvariable=self.role_tags, width=16).pack(side=tk.LEFT, padx=(5, 0))
 
         # 系统提示
         prompt_frame = ttk.LabelFrame(role_frame, text="系统提示", padding="5")
@@ -1829,6 +7157,33 @@ class SessionTab(ttk.Frame):
         ttk.Checkbutton(param_frame, text="深度思考",
                         variable=self.deep_thought).pack(side=tk.LEFT)
 
+        # 路由配置：模型、接口地址、接口配置
+        route_frame = ttk.Frame(role_frame)
+        route_frame.pack(fill=tk.X, pady=(0, 10))
+
+        ttk.Label(route_frame, text="模型:").pack(side=tk.LEFT)
+        ttk.Combobox(route_frame, textvariable=self.model, width=16,
+                     values=["", DEFAULT_CHAT_MODEL, DEFAULT_REASONER_MODEL]).pack(side=tk.LEFT, padx=(5, 10))
+
+        ttk.Label(route_frame, text="接口配置:").pack(side=tk.LEFT)
+        self.profile_combo = ttk.Combobox(route_frame, textvariable=self.api_profile, width=12,
+                                          postcommand=self.update_profile_combobox)
+        self.profile_combo.pack(side=tk.LEFT, padx=(5, 0))
+
+        url_frame = ttk.Frame(role_frame)
+        url_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(url_frame, text="接口地址:").pack(side=tk.LEFT)
+        ttk.Entry(url_frame, textvariable=self.role_base_url, width=40).pack(side=tk.LEFT, padx=(5, 0))
+
+        # 记忆压缩：超出上下文的历史合并为摘要，而不是直接丢弃
+        memory_frame = ttk.Frame(role_frame)
+        memory_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Checkbutton(memory_frame, text="记忆压缩", variable=self.memory_enabled).pack(side=tk.LEFT)
+        ttk.Label(memory_frame, text="摘要模型:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Combobox(memory_frame, textvariable=self.memory_model, width=16,
+                     values=["", DEFAULT_CHAT_MODEL]).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Button(memory_frame, text="查看记忆", command=self.show_memory, width=10).pack(side=tk.LEFT)
+
         # 状态显示
         self.status_var = tk.StringVar(value="准备就绪")
         ttk.Label(role_frame, textvariable=self.status_var,
@@ -1845,6 +7200,9 @@ class SessionTab(ttk.Frame):
                                                       state='disabled')
         self.history_text.pack(fill=tk.BOTH, expand=True)
 
+        # 思考过程区域
+        self.reasoning_view = CollapsibleReasoningView(self.history_text)
+
         # 输入区域
         input_frame = ttk.LabelFrame(parent, text="输入消息", padding="10")
         input_frame.pack(fill=tk.X, pady=(10, 0))
@@ -1882,21 +7240,26 @@ class SessionTab(ttk.Frame):
 
         self.token_label = ttk.Label(token_frame, text="Tokens: 0/0 (输入/输出)")
         self.token_label.pack(side=tk.LEFT)
+        self.memory_label = ttk.Label(token_frame, text="")  # 记忆摘要的消耗（已计入左侧合计）
+        self.memory_label.pack(side=tk.LEFT, padx=(10, 0))
+
+        # 最近请求的计时
+        self.timing_panel = TimingPanel(parent, rows=3)
+        self.timing_panel.pack(fill=tk.X, pady=(10, 0))
 
     def initialize_roles(self):
-        """初始化角色列表"""
-        self.update_role_combobox()
+        """初始化角色"""
         if self.global_roles:
-            first_role = list(self.global_roles.keys())[0]
+            first_role = next(iter(self.global_roles))
             self.current_role.set(first_role)
             self.load_selected_role()
 
     def update_role_combobox(self):
-        """更新角色下拉框"""
-        role_names = list(self.global_roles.keys())
-        self.role_combo['values'] = role_names
-        if role_names and not self.current_role.get():
-            self.current_role.set(role_names[0])
+        """下拉前按输入内容从角色库索引取匹配的角色（最多显示前200个）"""
+        query = self.current_role.get()
+        if query in self.global_roles:
+            query = ""  # 已选中角色时显示全部
+        self.role_combo['values'] = self.global_roles.search(query, limit=200)
 
     def load_selected_role(self):
         """加载选中的角色"""
@@ -1906,439 +7269,2369 @@ class SessionTab(ttk.Frame):
 
         role_config = self.global_roles.get(role_name)
         if role_config:
-            self.set_role_config(role_config)
-            if self.on_update_tab_title:
-                self.on_update_tab_title(role_name)
+            self.set_role_config(role_config)
+            if self.on_update_tab_title:
+                self.on_update_tab_title(role_name)
+
+    def set_role_config(self, role_config):
+        """设置角色配置"""
+        self.role_name.set(role_config.get("name", ""))
+        self.system_prompt.set(role_config.get("system_prompt", ""))
+        self.temperature.set(role_config.get("temperature", 0.7))
+        self.max_tokens.set(role_config.get("max_tokens", 2000))
+        self.deep_thought.set(role_config.get("deep_thought", False))
+        self.model.set(role_config.get("model", ""))
+        self.role_base_url.set(role_config.get("base_url", ""))
+        self.api_profile.set(role_config.get("api_profile", ""))
+        self.role_tags.set(", ".join(role_tags(role_config)))
+        self.memory_enabled.set(role_config.get("memory", False))
+        self.memory_model.set(role_config.get("memory_model", ""))
+
+        # 更新文本框
+        self.prompt_text.delete("1.0", tk.END)
+        self.prompt_text.insert("1.0", self.system_prompt.get())
+
+        self.persist("role", config=self.get_role_config())
+
+    def get_role_config(self):
+        """获取当前角色配置"""
+        return {
+            "name": self.role_name.get(),
+            "system_prompt": self.system_prompt.get(),
+            "temperature": self.temperature.get(),
+            "max_tokens": self.max_tokens.get(),
+            "deep_thought": self.deep_thought.get(),
+            "model": self.model.get().strip(),
+            "base_url": self.role_base_url.get().strip(),
+            "api_profile": self.api_profile.get().strip(),
+            "tags": role_tags({"tags": self.role_tags.get()}),
+            "memory": self.memory_enabled.get(),
+            "memory_model": self.memory_model.get().strip()
+        }
+
+    def update_profile_combobox(self):
+        """更新接口配置下拉框"""
+        self.profile_combo['values'] = [""] + self.api_router.profile_names()
+
+    def save_current_role(self):
+        """保存当前角色"""
+        role_name = self.role_name.get()
+        if not role_name:
+            messagebox.showerror("错误", "请输入角色名称")
+            return
+
+        role_config = self.get_role_config()
+
+        # 角色库会通知所有标签页更新角色下拉框
+        if self.on_save_role:
+            self.on_save_role(role_name, role_config)
+
+        messagebox.showinfo("成功", f"角色 '{role_name}' 已保存")
+
+    def send_message(self):
+        """发送消息"""
+        # 检查API Key（使用自定义接口配置时可以不依赖全局API Key）
+        api_key = self.global_api_key.get().strip()
+        if not self.api_router.has_key(self.get_role_config(), api_key):
+            messagebox.showerror("错误", "请输入API Key")
+            return
+
+        # 获取用户输入
+        user_input = self.input_text.get("1.0", tk.END).strip()
+        if not user_input:
+            return
+
+        # 清空输入框
+        self.input_text.delete("1.0", tk.END)
+
+        # 显示用户消息
+        self.append_to_history(f"用户: {user_input}\n\n")
+
+        # 更新状态
+        self.status_var.set("正在思考...")
+        self.send_button.config(state='disabled')
+        self.stop_button.config(state='normal')
+        self.is_streaming = True
+        self.stop_streaming = False
+        self.cancel_token = CancelToken()
+
+        # 在新线程中发送请求（接口设置和角色配置在界面线程读取）
+        settings = ApiSettings(api_key, self.global_base_url.get().strip(), self.global_timeout.get(),
+                               stream=self.global_stream_response.get())
+        thread = threading.Thread(target=self.send_api_request,
+                                  args=(user_input, self.get_role_config(), settings, self.cancel_token))
+        thread.daemon = True
+        thread.start()
+
+    def stop_stream(self):
+        """停止流式响应"""
+        if self.is_streaming:
+            self.stop_streaming = True
+            self.cancel_token.cancel()
+            self.status_var.set("正在停止...")
+
+    def send_api_request(self, user_input, role_config, settings, cancel_token):
+        """发送API请求（工作线程）"""
+        try:
+            self.engine.send(user_input, role_config, settings, cancel_token)
+        except Exception as e:
+            self.after(0, self.append_to_history, f"发生错误: {str(e)}\n\n")
+        finally:
+            self.after(0, self.finish_request)
+
+    def process_response_queue(self):
+        """处理响应队列"""
+        try:
+            while True:
+                try:
+                    text = self.response_queue.get_nowait()
+                    if isinstance(text, tuple):
+                        kind, payload = text
+                        if kind == "text":
+                            content, timer, enqueued_at = payload
+                            self.append_to_history(content)
+                            timer.on_render(enqueued_at)
+                        elif kind == "log":
+                            self.save_timed_log(payload)
+                        elif kind == "status":
+                            self.status_var.set(payload)
+                        elif kind == "reasoning":
+                            self.reasoning_view.append(payload)
+                        elif kind == "reasoning_end":
+                            self.reasoning_view.close(payload)
+                        elif kind == "memory":
+                            self.update_token_display()
+                        continue
+                    self.append_to_history(text)
+                except queue.Empty:
+                    break
+        except:
+            pass
+        finally:
+            self.after(100, self.process_response_queue)
+
+    def append_to_history(self, text):
+        """追加文本到历史记录"""
+        self.history_text.config(state='normal')
+        self.history_text.insert(tk.END, text)
+        self.history_text.see(tk.END)
+        self.history_text.config(state='disabled')
+
+    def on_engine_tokens(self, prompt_delta, completion_delta):
+        """引擎计入token增量（工作线程）：通知全局并刷新本标签页显示"""
+        if self.on_token_update:
+            self.on_token_update(prompt_delta, completion_delta)
+        self.after(0, self.update_token_display)
+
+    def update_token_display(self):
+        """更新Token显示"""
+        self.token_label.config(
+            text=f"Tokens: {self.engine.prompt_tokens}/{self.engine.completion_tokens} (输入/输出)")
+        memory = self.engine.memory
+        if memory["covered"]:
+            self.memory_label.config(text=f"其中记忆摘要: {memory['prompt_tokens']}/{memory['completion_tokens']}"
+                                          f"（已压缩 {memory['covered']} 条消息）")
+        else:
+            self.memory_label.config(text="")
+
+    def on_memory_update(self, memory):
+        """引擎更新了记忆摘要（后台线程）：保存摘要和包含摘要消耗的Token统计"""
+        self.persist("memory", memory=memory)
+        self.persist("tokens", prompt=self.engine.prompt_tokens, completion=self.engine.completion_tokens)
+
+    def show_memory(self):
+        """查看当前的记忆摘要"""
+        memory = self.engine.memory
+        if not memory["summary"]:
+            messagebox.showinfo("记忆摘要", "尚未生成记忆摘要" if self.memory_enabled.get()
+                                else "未启用记忆压缩，只发送最近的历史消息")
+            return
+        window = tk.Toplevel(self)
+        window.title(f"记忆摘要 - 已压缩 {memory['covered']} 条消息")
+        window.geometry("520x400")
+        text = scrolledtext.ScrolledText(window, wrap=tk.WORD, font=("微软雅黑", 10))
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        text.insert("1.0", memory["summary"])
+        text.config(state='disabled')
+
+    def finish_request(self):
+        """完成请求"""
+        self.is_streaming = False
+        self.send_button.config(state='normal')
+        self.stop_button.config(state='disabled')
+        self.status_var.set("准备就绪")
+        self.persist("tokens", prompt=self.engine.prompt_tokens, completion=self.engine.completion_tokens)
+
+    def clear_history(self):
+        """清空对话历史"""
+        if self.is_streaming:
+            messagebox.showwarning("警告", "请先停止当前请求")
+            return
+
+        if messagebox.askyesno("确认清空", "确定要清空对话历史吗？"):
+            self.history_text.config(state='normal')
+            self.history_text.delete("1.0", tk.END)
+            self.history_text.config(state='disabled')
+            self.reasoning_view.reset()
+
+            self.engine.clear()
+            self.update_token_display()
+            self.persist("clear")
+            self.persist("tokens", prompt=0, completion=0)
+
+    def persist(self, op, **fields):
+        """向会话日志追加一条操作（后台写入）"""
+        if self.session_store:
+            self.session_store.append(self.tab_id, dict(fields, op=op))
+
+    def restore_state(self, state, meta):
+        """从会话日志恢复角色、历史和Token统计"""
+        if state.get("role_config"):
+            self.set_role_config(state["role_config"])
+            self.current_role.set(state["role_config"].get("name", ""))
+
+        self.engine.history = list(state.get("history") or [])
+        self.engine.memory = state.get("memory") or empty_memory()
+        self.engine.prompt_tokens = state.get("prompt_tokens", 0)
+        self.engine.completion_tokens = state.get("completion_tokens", 0)
+        self.update_token_display()
+
+        # 一次性插入全部历史，避免逐条刷新界面
+        parts = []
+        for entry in self.engine.history:
+            if entry.get("role") == "user":
+                parts.append(f"用户: {entry.get('content', '')}\n\n")
+            else:
+                parts.append(f"AI: {entry.get('content', '')}\n\n")
+        self.history_text.config(state='normal')
+        self.history_text.delete("1.0", tk.END)
+        self.history_text.insert(tk.END, "".join(parts))
+        self.history_text.see(tk.END)
+        self.history_text.config(state='disabled')
+
+    def get_workspace_meta(self):
+        """工作区布局中本标签页的摘要（用于启动时延迟加载）"""
+        history = self.engine.history
+        last_time = history[-1].get("timestamp") if history else None
+        return {
+            "tab_id": self.tab_id,
+            "type": "session",
+            "title": f"标签页 {self.tab_id}: {self.role_name.get()}",
+            "role_name": self.role_name.get(),
+            "role_config": self.get_role_config(),
+            "prompt_tokens": self.engine.prompt_tokens,
+            "completion_tokens": self.engine.completion_tokens,
+            "message_count": len(history),
+            "last_time": last_time
+        }
+
+    def get_conversation_history(self):
+        """获取对话历史"""
+        return self.engine.history
+
+    def get_token_counts(self):
+        """获取Token计数"""
+        return self.engine.prompt_tokens, self.engine.completion_tokens
+
+    def save_timed_log(self, log_entry):
+        """界面已显示本次请求的全部内容：补全计时（含显示延迟）后写日志并刷新计时面板"""
+        timing = self.engine.write_log(log_entry)
+        self.request_timings.append(dict(timing, role=log_entry.get("role_name"),
+                                         time=datetime.fromtimestamp(log_entry["ts"]).strftime("%H:%M:%S")))
+        self.timing_panel.show(self.request_timings)
+
+
+class ComparisonColumn(ttk.LabelFrame):
+    """A/B对比中的一个变体：基础角色 + 可覆盖的系统提示、温度和深度思考，下方显示回复"""
+
+    def __init__(self, parent, label, global_roles):
+        super().__init__(parent, text=f"变体 {label}", padding="5")
+        self.label = label
+        self.global_roles = global_roles
+        self.base_config = {}
+        self.role_var = tk.StringVar()
+        self.temperature = tk.DoubleVar(value=0.7)
+        self.deep_thought = tk.BooleanVar(value=False)
+        self.status_var = tk.StringVar(value="")
+
+        config_frame = ttk.Frame(self)
+        config_frame.pack(fill=tk.X)
+        self.role_combo = ttk.Combobox(config_frame, textvariable=self.role_var, width=14,
+                                       postcommand=self.update_role_combobox)
+        self.role_combo.pack(side=tk.LEFT)
+        self.role_combo.bind("<<ComboboxSelected>>", lambda e: self.load_role(self.role_var.get()))
+        ttk.Label(config_frame, text="温度:").pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Spinbox(config_frame, from_=0.0, to=2.0, increment=0.1, textvariable=self.temperature,
+                    width=5).pack(side=tk.LEFT, padx=(2, 5))
+        ttk.Checkbutton(config_frame, text="深度思考", variable=self.deep_thought).pack(side=tk.LEFT)
+
+        self.prompt_text = tk.Text(self, height=4, wrap=tk.WORD, font=("微软雅黑", 9))
+        self.prompt_text.pack(fill=tk.X, pady=(5, 5))
+
+        self.output_text = scrolledtext.ScrolledText(self, height=18, font=("微软雅黑", 10), wrap=tk.WORD,
+                                                     state='disabled')
+        self.output_text.pack(fill=tk.BOTH, expand=True)
+        self.output_text.tag_configure("trial", foreground="gray")
+        ttk.Label(self, textvariable=self.status_var, font=("微软雅黑", 9), foreground="blue").pack(fill=tk.X)
+
+    def update_role_combobox(self):
+        query = self.role_var.get()
+        if query in self.global_roles:
+            query = ""
+        self.role_combo['values'] = self.global_roles.search(query, limit=200)
+
+    def load_role(self, role_name):
+        role_config = self.global_roles.get(role_name)
+        if role_config:
+            self.set_config(dict(role_config, name=role_name))
 
-    def set_role_config(self, role_config):
-        """设置角色配置"""
-        self.role_name.set(role_config.get("name", ""))
-        self.system_prompt.set(role_config.get("system_prompt", ""))
+    def set_config(self, role_config):
+        self.base_config = dict(role_config)
+        self.role_var.set(role_config.get("name", ""))
         self.temperature.set(role_config.get("temperature", 0.7))
-        self.max_tokens.set(role_config.get("max_tokens", 2000))
         self.deep_thought.set(role_config.get("deep_thought", False))
-
-        # 更新文本框
         self.prompt_text.delete("1.0", tk.END)
-        self.prompt_text.insert("1.0", self.system_prompt.get())
+        self.prompt_text.insert("1.0", role_config.get("system_prompt", ""))
 
-    def get_role_config(self):
-        """获取当前角色配置"""
-        return {
-            "name": self.role_name.get(),
-            "system_prompt": self.system_prompt.get(),
-            "temperature": self.temperature.get(),
-            "max_tokens": self.max_tokens.get(),
-            "deep_thought": self.deep_thought.get()
-        }
+    def get_config(self):
+        """基础角色的路由和模型设置 + 本列覆盖的参数"""
+        return dict(self.base_config, name=self.role_var.get() or f"变体 {self.label}",
+                    system_prompt=self.prompt_text.get("1.0", tk.END).strip(),
+                    temperature=self.temperature.get(), deep_thought=self.deep_thought.get())
 
-    def save_current_role(self):
-        """保存当前角色"""
-        role_name = self.role_name.get()
-        if not role_name:
-            messagebox.showerror("错误", "请输入角色名称")
-            return
+    def append(self, text, *tags):
+        self.output_text.config(state='normal')
+        self.output_text.insert(tk.END, text, tags)
+        self.output_text.see(tk.END)
+        self.output_text.config(state='disabled')
 
-        role_config = self.get_role_config()
+    def clear(self):
+        self.output_text.config(state='normal')
+        self.output_text.delete("1.0", tk.END)
+        self.output_text.config(state='disabled')
+        self.status_var.set("")
 
-        if self.on_save_role:
-            self.on_save_role(role_name, role_config)
 
-        # 更新角色下拉框
-        self.update_role_combobox()
+class ComparisonTab(ttk.Frame):
+    """A/B对比标签页：同一条输入并发发给多个角色变体，逐列流式显示，统计各变体的首token、耗时和长度分布"""
 
-        messagebox.showinfo("成功", f"角色 '{role_name}' 已保存")
+    MIN_VARIANTS = 2
+    MAX_VARIANTS = 6
+    METRIC_COLUMNS = (("variant", "变体", 150), ("runs", "成功/次数", 70), ("first_p50", "首token p50", 80),
+                      ("first_p95", "首token p95", 80), ("total_mean", "总耗时 平均", 80),
+                      ("total_stdev", "总耗时 标准差", 90), ("tokens", "输出tokens 平均(最小-最大)", 160),
+                      ("chars", "字数 平均", 70))
+
+    def __init__(self, parent, tab_id, global_api_key, global_base_url,
+                 global_timeout, global_stream_response, global_roles,
+                 on_token_update=None, on_save_role=None, on_load_role=None,
+                 on_update_tab_title=None, log_dir="api_logs", api_router=None,
+                 log_writer=None, session_store=None):
+        super().__init__(parent)
+
+        self.tab_id = tab_id
+        self.parent = parent
+        self.tab_type = "compare"
+        self.log_writer = log_writer or ApiLogWriter(log_dir)
+        self.global_api_key = global_api_key
+        self.global_base_url = global_base_url
+        self.global_timeout = global_timeout
+        self.global_stream_response = global_stream_response
+        self.global_roles = global_roles
+        self.api_router = api_router or ApiRouter()
+        self.on_token_update = on_token_update
+        self.trials = tk.IntVar(value=1)
+        self.status_var = tk.StringVar(value="准备就绪")
+        self.last_input = ""
+
+        self.response_queue = queue.Queue()
+        self.engine = ComparisonEngine(tab_id, self.api_router, self.log_writer, emit=self.response_queue.put,
+                                       on_token_update=self.on_engine_tokens)
+        self.is_running = False
+        self.running_trials = 1
+        self.cancel_token = CancelToken()
+
+        self.columns = []
+        self.create_widgets()
+        role_names = self.global_roles.keys()
+        for index in range(self.MIN_VARIANTS):
+            self.add_variant(role_names[0] if role_names else None)
+        self.process_response_queue()
+
+    def create_widgets(self):
+        """创建界面组件"""
+        input_frame = ttk.LabelFrame(self, text="输入消息（同时发给所有变体）", padding="10")
+        input_frame.pack(fill=tk.X)
+        self.input_text = tk.Text(input_frame, height=3, wrap=tk.WORD, font=("微软雅黑", 10))
+        self.input_text.pack(fill=tk.X)
+        self.input_text.bind("<Control-Return>", lambda e: self.send_message())
+
+        control_frame = ttk.Frame(self)
+        control_frame.pack(fill=tk.X, pady=(10, 0))
+        self.send_button = ttk.Button(control_frame, text="发送", command=self.send_message, width=10,
+                                      style="Primary.TButton")
+        self.send_button.pack(side=tk.LEFT, padx=(0, 10))
+        self.stop_button = ttk.Button(control_frame, text="停止", command=self.stop, width=10, state='disabled')
+        self.stop_button.pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Label(control_frame, text="重复次数:").pack(side=tk.LEFT)
+        ttk.Spinbox(control_frame, from_=1, to=50, textvariable=self.trials, width=5).pack(side=tk.LEFT,
+                                                                                           padx=(5, 10))
+        ttk.Button(control_frame, text="添加变体", command=self.add_variant, width=10).pack(side=tk.LEFT,
+                                                                                          padx=(0, 5))
+        ttk.Button(control_frame, text="删除变体", command=self.remove_variant, width=10).pack(side=tk.LEFT,
+                                                                                             padx=(0, 10))
+        ttk.Button(control_frame, text="差异对比", command=self.show_diff, width=10).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(control_frame, text="导出结果", command=self.export_results, width=10).pack(side=tk.LEFT,
+                                                                                             padx=(0, 5))
+        ttk.Button(control_frame, text="清空", command=self.clear_results, width=8).pack(side=tk.LEFT)
+        ttk.Label(control_frame, textvariable=self.status_var, foreground="blue").pack(side=tk.LEFT, padx=(10, 0))
+
+        self.columns_frame = ttk.Frame(self)
+        self.columns_frame.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+        self.columns_frame.rowconfigure(0, weight=1)
+
+        metrics_frame = ttk.LabelFrame(self, text="📊 各变体统计（成功的请求）", padding="5")
+        metrics_frame.pack(fill=tk.X, pady=(10, 0))
+        self.metrics_tree = ttk.Treeview(metrics_frame, columns=[name for name, _, _ in self.METRIC_COLUMNS],
+                                         show="headings", height=self.MIN_VARIANTS)
+        for name, title, width in self.METRIC_COLUMNS:
+            self.metrics_tree.heading(name, text=title)
+            self.metrics_tree.column(name, width=width, minwidth=40, anchor=tk.W if name == "variant" else tk.E)
+        self.metrics_tree.pack(fill=tk.X)
+        self.token_label = ttk.Label(metrics_frame, text="Tokens: 0/0 (输入/输出)")
+        self.token_label.pack(anchor=tk.W, pady=(5, 0))
+
+    def add_variant(self, role_name=None):
+        """添加一列变体（默认复制最后一列的配置）"""
+        if self.is_running or len(self.columns) >= self.MAX_VARIANTS:
+            return
+        column = ComparisonColumn(self.columns_frame, chr(ord("A") + len(self.columns)), self.global_roles)
+        if self.columns and not role_name:
+            column.set_config(self.columns[-1].get_config())
+        elif role_name:
+            column.load_role(role_name)
+        self.columns_frame.columnconfigure(len(self.columns), weight=1, uniform="variant")
+        column.grid(row=0, column=len(self.columns), sticky=tk.NSEW, padx=2)
+        self.columns.append(column)
+        self.update_metrics()
+
+    def remove_variant(self):
+        """删除最后一列变体（对比结果随之清空）"""
+        if self.is_running or len(self.columns) <= self.MIN_VARIANTS:
+            return
+        column = self.columns.pop()
+        self.columns_frame.columnconfigure(len(self.columns), weight=0, uniform="")
+        column.destroy()
+        self.engine.results = [result for result in self.engine.results if result["variant"] < len(self.columns)]
+        self.update_metrics()
+
+    def variant_title(self, index):
+        column = self.columns[index]
+        return f"{column.label}: {column.role_var.get()}"
 
     def send_message(self):
-        """发送消息"""
-        # 检查API Key
+        """把输入同时发给所有变体，重复指定次数"""
+        if self.is_running:
+            return
         api_key = self.global_api_key.get().strip()
-        if not api_key:
+        variants = [column.get_config() for column in self.columns]
+        if not all(self.api_router.has_key(variant, api_key) for variant in variants):
             messagebox.showerror("错误", "请输入API Key")
             return
-
-        # 获取用户输入
         user_input = self.input_text.get("1.0", tk.END).strip()
         if not user_input:
             return
+        try:
+            trials = max(1, self.trials.get())
+        except tk.TclError:
+            trials = 1
 
-        # 清空输入框
-        self.input_text.delete("1.0", tk.END)
-
-        # 显示用户消息
-        self.append_to_history(f"用户: {user_input}\n\n")
+        # 新的输入重新开始统计，同一输入再次发送时累加样本
+        if user_input != self.last_input:
+            self.clear_results()
+        self.last_input = user_input
 
-        # 更新状态
-        self.status_var.set("正在思考...")
+        self.is_running = True
+        self.running_trials = trials
+        self.cancel_token = CancelToken()
         self.send_button.config(state='disabled')
         self.stop_button.config(state='normal')
-        self.is_streaming = True
-        self.stop_streaming = False
-
-        # 在新线程中发送请求
-        thread = threading.Thread(target=self.send_api_request, args=(user_input,))
-        thread.daemon = True
+        self.status_var.set("正在请求...")
+        settings = ApiSettings(api_key, self.global_base_url.get().strip(), self.global_timeout.get(),
+                               stream=self.global_stream_response.get())
+        thread = threading.Thread(target=self.run_comparison,
+                                  args=(user_input, variants, settings, trials, self.cancel_token), daemon=True)
         thread.start()
 
-    def stop_stream(self):
-        """停止流式响应"""
-        if self.is_streaming:
-            self.stop_streaming = True
-            self.status_var.set("正在停止...")
-
-    def send_api_request(self, user_input):
-        """发送API请求"""
+    def run_comparison(self, user_input, variants, settings, trials, cancel_token):
+        """运行对比（工作线程）"""
         try:
-            # 构建消息历史
-            messages = self.build_messages(user_input)
-
-            # 调用API
-            if self.global_stream_response.get():
-                # 流式响应
-                self.call_api_stream(messages, user_input)
-            else:
-                # 非流式响应
-                self.call_api_normal(messages, user_input)
-
+            self.engine.run(user_input, variants, settings, trials, cancel_token)
         except Exception as e:
-            self.after(0, self.append_to_history, f"发生错误: {str(e)}\n\n")
+            self.response_queue.put((None, f"发生错误: {str(e)}\n"))
         finally:
             self.after(0, self.finish_request)
 
-    def build_messages(self, user_input):
-        """构建消息列表"""
-        messages = []
+    def stop(self):
+        if self.is_running:
+            self.cancel_token.cancel()
+            self.status_var.set("正在停止...")
 
-        # 添加系统提示
-        system_prompt = self.system_prompt.get()
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
+    def finish_request(self):
+        self.is_running = False
+        self.send_button.config(state='normal')
+        self.stop_button.config(state='disabled')
+        self.status_var.set("已停止" if self.cancel_token.cancelled else "完成")
 
-        # 添加上下文历史（最近10条）
-        for entry in self.conversation_history[-10:]:
-            if entry["role"] == "user":
-                messages.append({"role": "user", "content": entry["content"]})
-            else:
-                messages.append({"role": "assistant", "content": entry["content"]})
+    def process_response_queue(self):
+        """处理响应队列：按变体序号分发到各列"""
+        try:
+            while True:
+                try:
+                    index, item = self.response_queue.get_nowait()
+                except queue.Empty:
+                    break
+                columns = self.columns if index is None else self.columns[index:index + 1]
+                for column in columns:
+                    self.render_item(index, column, item)
+        except Exception as e:
+            print(f"显示对比结果失败: {e}")
+        finally:
+            self.after(100, self.process_response_queue)
 
-        # 添加当前用户输入
-        messages.append({"role": "user", "content": user_input})
+    def render_item(self, index, column, item):
+        if not isinstance(item, tuple):
+            column.append(item)
+            return
+        kind, payload = item
+        if kind == "text":
+            content, timer, enqueued_at = payload
+            column.append(content)
+            timer.on_render(enqueued_at)
+        elif kind == "trial":
+            separator = "" if payload == 1 else "\n\n"
+            column.append(f"{separator}── 第 {payload} 次 ──\n", "trial")
+            self.status_var.set(f"第 {payload}/{self.running_trials} 次")
+        elif kind == "status":
+            column.status_var.set(payload)
+        elif kind == "reasoning_end":
+            column.append(f"（深度思考 {payload.get('reasoning_tokens', 0)} tokens，"
+                          f"{payload.get('reasoning_seconds', 0):.1f}秒）\n", "trial")
+        elif kind == "log":
+            self.engine.write_log(payload)
+        elif kind == "result":
+            if payload["status"] == "ok":
+                column.status_var.set(f"首token {TimingPanel._ms(payload['first_token'])}，"
+                                      f"总耗时 {TimingPanel._ms(payload['total'])}，"
+                                      f"{payload['completion_tokens']} tokens，{payload['chars']} 字")
+            elif payload["status"] == "cancelled":
+                column.status_var.set("已停止")
+            self.update_metrics()
+
+    def update_metrics(self):
+        """刷新各变体的统计表"""
+        self.metrics_tree.delete(*self.metrics_tree.get_children())
+        self.metrics_tree.config(height=len(self.columns))
+        ms = TimingPanel._ms
+        for index, summary in enumerate(summarize_comparison(self.engine.results, len(self.columns))):
+            tokens = "-"
+            if summary["tokens_mean"] is not None:
+                tokens = f"{summary['tokens_mean']:.0f} ({summary['tokens_min']}-{summary['tokens_max']})"
+            self.metrics_tree.insert("", tk.END, values=(
+                self.variant_title(index), f"{summary['succeeded']}/{summary['runs']}",
+                ms(summary["first_token_p50"]), ms(summary["first_token_p95"]),
+                ms(summary["total_mean"]), ms(summary["total_stdev"]), tokens,
+                "-" if summary["chars_mean"] is None else f"{summary['chars_mean']:.0f}"
+            ))
+
+    def show_diff(self):
+        """比较两个变体最近一次都成功的回复"""
+        titles = [self.variant_title(index) for index in range(len(self.columns))]
+        dialog = tk.Toplevel(self)
+        dialog.title("差异对比")
+        dialog.transient(self.winfo_toplevel())
+        frame = ttk.Frame(dialog, padding="10")
+        frame.pack(fill=tk.BOTH, expand=True)
+        first_var = tk.StringVar(value=titles[0])
+        second_var = tk.StringVar(value=titles[1])
+        ttk.Label(frame, text="比较:").grid(row=0, column=0, sticky=tk.W)
+        ttk.Combobox(frame, textvariable=first_var, values=titles, state="readonly",
+                     width=24).grid(row=0, column=1, padx=5)
+        ttk.Label(frame, text="与:").grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Combobox(frame, textvariable=second_var, values=titles, state="readonly",
+                     width=24).grid(row=1, column=1, padx=5, pady=(5, 0))
+
+        def on_compare():
+            first, second = titles.index(first_var.get()), titles.index(second_var.get())
+            latest = {}
+            for result in self.engine.results:
+                if result["status"] == "ok":
+                    latest.setdefault(result["trial"], {})[result["variant"]] = result["content"]
+            trials = [trial for trial, contents in latest.items() if first in contents and second in contents]
+            if not trials:
+                messagebox.showinfo("提示", "这两个变体还没有都成功的回复", parent=dialog)
+                return
+            trial = max(trials)
+            dialog.destroy()
+            show_text_diff(self, f"{titles[first]}（第{trial}次）", latest[trial][first],
+                           f"{titles[second]}（第{trial}次）", latest[trial][second])
 
-        return messages
+        ttk.Button(frame, text="比较", command=on_compare, width=10).grid(row=2, column=0, columnspan=2, pady=(10, 0))
 
-    def call_api_stream(self, messages, user_input):
-        """流式调用API"""
+    def export_results(self):
+        """导出输入、各变体配置、逐次结果和统计（JSON）"""
+        if not self.engine.results:
+            messagebox.showinfo("提示", "还没有对比结果")
+            return
+        path = filedialog.asksaveasfilename(
+            defaultextension=".json", filetypes=[("JSON文件", "*.json"), ("所有文件", "*.*")],
+            initialfile=f"compare_{self.tab_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        if not path:
+            return
+        data = {
+            "input": self.last_input,
+            "variants": [dict(column.get_config(), label=column.label) for column in self.columns],
+            "results": self.engine.results,
+            "summary": summarize_comparison(self.engine.results, len(self.columns))
+        }
         try:
-            api_key = self.global_api_key.get().strip()
-            base_url = self.global_base_url.get().strip()
-            timeout = self.global_timeout.get()
-
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
+            atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=2))
+        except OSError as e:
+            messagebox.showerror("错误", f"导出失败: {str(e)}")
 
-            data = {
-                "model": "deepseek-chat",
-                "messages": messages,
-                "temperature": self.temperature.get(),
-                "max_tokens": self.max_tokens.get(),
-                "stream": True
-            }
+    def clear_results(self):
+        if self.is_running:
+            return
+        for column in self.columns:
+            column.clear()
+        self.engine.clear()
+        self.update_metrics()
 
-            if self.deep_thought.get():
-                data["deep_thought"] = True
-                data["model"] = "deepseek-reasoner"
-                del data["max_tokens"]
-
-            # 记录请求
-            log_entry = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "role_name": self.role_name.get(),
-                "request": {
-                    "url": base_url,
-                    "headers": {"Authorization": "Bearer ***" + api_key[-4:]},
-                    "data": data
-                }
-            }
+    def on_engine_tokens(self, prompt_delta, completion_delta):
+        """引擎计入token增量（工作线程）"""
+        if self.on_token_update:
+            self.on_token_update(prompt_delta, completion_delta)
+        self.after(0, self.update_token_display)
 
-            # 显示AI标签
-            self.response_queue.put("AI: ")
+    def update_token_display(self):
+        self.token_label.config(
+            text=f"Tokens: {self.engine.prompt_tokens}/{self.engine.completion_tokens} (输入/输出)")
 
-            # 发送请求
-            response = requests.post(base_url, headers=headers, json=data, timeout=timeout, stream=True)
+    def get_token_counts(self):
+        return self.engine.prompt_tokens, self.engine.completion_tokens
 
-            if response.status_code == 200:
-                collected_content = ""
-                usage_data = {}
+    def get_conversation_history(self):
+        """各变体逐次的结果（用于搜索和内存报告）"""
+        return self.engine.results
+
+    def restore_state(self, state, meta):
+        """恢复变体配置（对比结果不保存）"""
+        for index, variant in enumerate(meta.get("variants") or []):
+            if index >= len(self.columns):
+                self.add_variant()
+            self.columns[index].set_config(variant)
+        self.trials.set(meta.get("trials", 1))
+        self.engine.prompt_tokens = meta.get("prompt_tokens", 0)
+        self.engine.completion_tokens = meta.get("completion_tokens", 0)
+        self.update_token_display()
+        self.update_metrics()
+
+    def get_workspace_meta(self):
+        """工作区布局中本标签页的摘要"""
+        try:
+            trials = self.trials.get()
+        except tk.TclError:
+            trials = 1
+        return {
+            "tab_id": self.tab_id,
+            "type": "compare",
+            "title": f"A/B对比 {self.tab_id}",
+            "variants": [column.get_config() for column in self.columns],
+            "trials": trials,
+            "prompt_tokens": self.engine.prompt_tokens,
+            "completion_tokens": self.engine.completion_tokens,
+            "message_count": 0
+        }
 
-                # 处理流式响应
-                for line in response.iter_lines():
-                    if self.stop_streaming:
-                        break
 
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_str = line[6:]
-
-                            if data_str == '[DONE]':
-                                break
-
-                            try:
-                                data_json = json.loads(data_str)
-                                if 'choices' in data_json and data_json['choices']:
-                                    choice = data_json['choices'][0]
-                                    if 'delta' in choice and 'content' in choice['delta']:
-                                        content = choice['delta']['content']
-                                        if content:
-                                            collected_content += content
-                                            self.response_queue.put(content)
-
-                                    # 检查是否有token使用信息
-                                    if 'usage' in data_json:
-                                        usage_data = data_json.get('usage', {})
-                            except json.JSONDecodeError:
-                                continue
-
-                # 添加换行
-                self.response_queue.put("\n\n")
-
-                # 记录对话历史
-                self.conversation_history.append({
-                    "role": "user",
-                    "content": user_input,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": collected_content,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
+def build_arg_parser():
+    """命令行参数（不带参数时启动图形界面）"""
+    parser = argparse.ArgumentParser(description="多角色版 DeepSeek API 调用工具")
+
+    stats_group = parser.add_argument_group("日志统计（不启动界面）")
+    stats_group.add_argument("--analyze-logs", action="store_true",
+                             help="统计API日志的用量、错误率和延迟")
+    stats_group.add_argument("--log-dir", default="api_logs", help="日志目录（默认api_logs，命令行对话也写入此目录）")
+    stats_group.add_argument("--group-by", default="day",
+                             help=f"分组维度，逗号分隔，可选: {','.join(LOG_STATS_DIMENSIONS)}（默认day）")
+    stats_group.add_argument("--since", help="起始日期（含），格式YYYY-MM-DD")
+    stats_group.add_argument("--until", help="结束日期（含），格式YYYY-MM-DD")
+    stats_group.add_argument("--format", choices=("table", "csv", "json"), default="table", help="输出格式")
+    stats_group.add_argument("--workers", type=int, default=None, help="并行解析的进程数（默认CPU核数）")
+    stats_group.add_argument("--no-index", action="store_true", help="不使用SQLite索引，全部重新解析日志文件")
+    stats_group.add_argument("--output", help="输出到文件（默认标准输出）")
+
+    chat_group = parser.add_argument_group("命令行对话（不启动界面，输出到标准输出）")
+    chat_group.add_argument("--role", help="运行角色库中的角色；不指定--prompt时从标准输入读取（终端中可多轮对话）")
+    chat_group.add_argument("--pipeline", metavar="CONFIG", help="运行多角色协同配置（标签页\"保存配置\"的JSON文件）")
+    chat_group.add_argument("--prompt", help="用户消息；对--pipeline为初始提示（覆盖配置中的值）")
+    chat_group.add_argument("--iterations", type=int, help="覆盖多角色配置中的循环次数")
+    chat_group.add_argument("--roles-file", default="global_roles.json", help="角色库文件（默认global_roles.json）")
+    chat_group.add_argument("--api-key", help="API Key（默认读取环境变量DEEPSEEK_API_KEY）")
+    chat_group.add_argument("--base-url", default=DEFAULT_BASE_URL, help="接口地址")
+    chat_group.add_argument("--timeout", type=int, default=60, help="请求超时秒数（默认60）")
+    chat_group.add_argument("--no-stream", action="store_true", help="角色对话使用非流式请求")
+    chat_group.add_argument("--hide-reasoning", action="store_true", help="不输出深度思考内容（默认输出到标准错误）")
+    chat_group.add_argument("--no-log", action="store_true", help="不写API日志（默认写入--log-dir）")
+
+    bench_group = parser.add_argument_group("基准测试（不启动界面）")
+    bench_group.add_argument("--benchmark", nargs="?", const="all", metavar="NAMES",
+                             help=f"运行热点路径的基准测试，可逗号分隔指定: {','.join(BENCHMARKS)}（默认全部）")
+    bench_group.add_argument("--benchmark-baseline", default=BENCHMARK_BASELINE_FILE,
+                             help=f"基准结果文件（默认{BENCHMARK_BASELINE_FILE}）")
+    bench_group.add_argument("--benchmark-save", action="store_true", help="把本次结果写入基准结果文件")
+    bench_group.add_argument("--benchmark-repeat", type=int, default=BENCHMARK_REPEAT,
+                             help=f"每项重复的组数（默认{BENCHMARK_REPEAT}）")
+    bench_group.add_argument("--benchmark-tolerance", type=float, default=BENCHMARK_TOLERANCE,
+                             help=f"最小耗时超过基准的比例达到此值视为回退（默认{BENCHMARK_TOLERANCE}）")
+
+    cassette_group = parser.add_argument_group("磁带录制/回放（对图形界面、命令行对话、负载测试都有效）")
+    cassette_mode = cassette_group.add_mutually_exclusive_group()
+    cassette_mode.add_argument("--record-cassette", metavar="FILE",
+                               help="把每个请求的响应逐行连同到达间隔追加录制到磁带文件")
+    cassette_mode.add_argument("--replay-cassette", metavar="FILE", help="不联网，从磁带文件回放录制的响应")
+    cassette_group.add_argument("--cassette-time-scale", type=float, default=1.0,
+                                help="回放时间隔乘以此值（1为原始节奏，0为不等待，默认1）")
+
+    bulk_group = parser.add_argument_group("批量处理（配合--role，不启动界面）")
+    bulk_group.add_argument("--bulk", metavar="INPUT", help="用--role指定的角色处理JSONL/CSV文件中的每一条输入")
+    bulk_group.add_argument("--bulk-output", help="结果JSONL文件（默认 输入文件名.out.jsonl；已存在时续跑）")
+    bulk_group.add_argument("--bulk-field", help="输入字段/列名（默认依次查找input、text、prompt、content）")
+    bulk_group.add_argument("--bulk-concurrency", type=int, default=4, help="并发请求数（默认4）")
+    bulk_group.add_argument("--bulk-rpm", type=int, default=0, help="每分钟最多请求数（默认0不限）")
+    bulk_group.add_argument("--bulk-retries", type=int, default=3, help="429、5xx和网络错误的最多重试次数（默认3）")
+    bulk_group.add_argument("--bulk-ordered", action="store_true", help="按输入顺序写出结果（默认按完成顺序）")
+
+    proxy_group = parser.add_argument_group("本地代理（不启动界面，上游设置同命令行对话的--api-key/--base-url/--roles-file）")
+    proxy_group.add_argument("--proxy", type=int, metavar="PORT",
+                             help="运行OpenAI兼容代理（/v1/chat/completions），请求可用\"role\"字段指定角色库中的角色")
+    proxy_group.add_argument("--proxy-host", default="127.0.0.1", help="代理监听地址（默认只监听本机）")
+    proxy_group.add_argument("--proxy-metrics", metavar="FILE", help="退出时把各客户端用量以JSON写入文件")
+
+    load_group = parser.add_argument_group("负载测试（默认在独立进程中启动模拟接口）")
+    load_group.add_argument("--load-test", metavar="SESSIONS",
+                            help="逐档运行负载测试，逗号分隔每档的单角色标签页数，如 10,50,100")
+    load_group.add_argument("--load-test-multi", type=int, default=0, help="每档同时运行的多角色标签页数（默认0）")
+    load_group.add_argument("--load-test-rate", type=float, default=5.0, help="向单角色标签页发送消息的到达率（次/秒，默认5）")
+    load_group.add_argument("--load-test-duration", type=float, default=30.0, help="每档持续秒数（默认30）")
+    load_group.add_argument("--load-test-headless", action="store_true",
+                            help="不创建界面，用引擎和Tcl事件循环模拟标签页（没有显示器时自动使用）")
+    load_group.add_argument("--load-test-endpoint", help="使用已有的接口地址，不启动模拟接口（不统计丢失块）")
+    load_group.add_argument("--load-test-report", help="把每档结果以JSON写入文件")
+    load_group.add_argument("--mock-server", type=int, metavar="PORT", help="只在前台运行模拟接口（0为随机端口）")
+    load_group.add_argument("--mock-chunks", type=int, default=50, help="模拟接口每次回复的正文块数（默认50）")
+    load_group.add_argument("--mock-interval", type=float, default=0.02, help="模拟接口正文块间隔秒数（默认0.02）")
+    load_group.add_argument("--mock-latency", type=float, default=0.1, help="模拟接口首个数据块前的等待秒数（默认0.1）")
+
+    diagnostics_group = parser.add_argument_group("诊断（运行中也可从\"诊断\"菜单开始/停止）")
+    diagnostics_group.add_argument("--profile", action="store_true",
+                                   help="启动即开始CPU分析，退出时（或--profile-seconds到期时）写出结果")
+    diagnostics_group.add_argument("--profile-seconds", type=float, help="CPU分析持续的秒数（图形界面）")
+    diagnostics_group.add_argument("--tracemalloc", action="store_true", help="启动即开始内存跟踪，退出时写出快照")
+    diagnostics_group.add_argument("--diagnostics-dir", default="diagnostics", help="诊断结果目录（默认diagnostics）")
+    return parser
+
+
+def run_log_analytics(args):
+    """命令行日志统计"""
+    group_by = [dimension.strip() for dimension in args.group_by.split(",") if dimension.strip()]
+    try:
+        started = time.time()
+        stats = analyze_logs(args.log_dir, group_by, args.since, args.until,
+                             workers=args.workers, use_index=not args.no_index)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+    text = format_log_stats(stats, args.format)
+    if args.output:
+        atomic_write_text(args.output, text + "\n")
+    else:
+        print(text)
+    print(f"统计完成，用时 {time.time() - started:.2f} 秒", file=sys.stderr)
+    return 0
+
+
+class ConsoleOutput:
+    """命令行输出：接收引擎事件，正文和提示写到标准输出，思考内容写到标准错误，请求结束时写API日志"""
+
+    def __init__(self, show_reasoning=True, stdout=None, stderr=None):
+        self.engine = None  # 创建引擎后设置，用于写日志
+        self.show_reasoning = show_reasoning
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+
+    def __call__(self, item):
+        if item is None:
+            return
+        if not isinstance(item, tuple):
+            self.stdout.write(item)
+            self.stdout.flush()
+            return
 
-                # 记录API日志
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "content": collected_content,
-                    "usage": usage_data
+        kind, payload = item
+        if kind == "text":
+            content, timer, enqueued_at = payload
+            self.stdout.write(content)
+            self.stdout.flush()
+            timer.on_render(enqueued_at)
+        elif kind == "reasoning" and self.show_reasoning:
+            self.stderr.write(payload)
+            self.stderr.flush()
+        elif kind == "reasoning_end" and self.show_reasoning:
+            self.stderr.write("\n")
+        elif kind == "log" and self.engine is not None:
+            self.engine.write_log(payload)
+
+
+def load_json_file(path, what):
+    """读取JSON文件，失败时抛出ValueError"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"读取{what}失败: {e}")
+
+
+def run_cli_chat(args):
+    """命令行运行单个角色或多角色协同配置"""
+    settings = ApiSettings(args.api_key or os.environ.get("DEEPSEEK_API_KEY", ""), args.base_url,
+                           args.timeout, stream=not args.no_stream)
+    api_router = ApiRouter()
+    output = ConsoleOutput(show_reasoning=not args.hide_reasoning)
+
+    try:
+        if args.pipeline:
+            config = load_json_file(args.pipeline, "多角色配置")
+            if args.prompt:
+                config["initial_prompt"] = args.prompt
+            if args.iterations:
+                config["iteration_count"] = args.iterations
+            roles = [role_info["role"] for role_info in config.get("ordered_roles", [])]
+        else:
+            role_library = load_json_file(args.roles_file, "角色库")
+            if args.role not in role_library:
+                raise ValueError(f"角色库 {args.roles_file} 中没有角色 '{args.role}'")
+            role_config = dict(role_library[args.role], name=args.role)
+            roles = [role_config]
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+
+    for role in roles:
+        if not api_router.has_key(role, settings.api_key):
+            print("错误: 请通过--api-key或环境变量DEEPSEEK_API_KEY提供API Key", file=sys.stderr)
+            return 2
+
+    log_writer = None if args.no_log else ApiLogWriter(args.log_dir)
+    try:
+        if args.pipeline:
+            engine = MultiRolePipelineEngine("cli", api_router, log_writer, emit=output)
+            output.engine = engine
+            try:
+                engine.prepare(config)
+            except (ValueError, TypeError) as e:
+                print(f"错误: 多角色配置无效: {e}", file=sys.stderr)
+                return 2
+            end_reason = engine.run(settings)
+            print(f"结束原因: {end_reason}，共 {len(engine.history)} 轮，"
+                  f"Tokens: {engine.prompt_tokens}/{engine.completion_tokens} (输入/输出)", file=sys.stderr)
+            return 0 if len(engine.history) else 1
+
+        engine = ChatSessionEngine("cli", api_router, log_writer, emit=output)
+        output.engine = engine
+        if args.prompt:
+            prompts = [args.prompt]
+        elif sys.stdin.isatty():
+            # 终端中逐行输入，多轮对话直到EOF（Ctrl+D）
+            def read_prompts():
+                while True:
+                    print("用户: ", end="", file=sys.stderr, flush=True)
+                    line = sys.stdin.readline()
+                    if not line:
+                        return
+                    if line.strip():
+                        yield line.strip()
+            prompts = read_prompts()
+        else:
+            # 管道输入作为一条消息
+            prompts = [sys.stdin.read().strip()]
+
+        failed = False
+        for prompt in prompts:
+            if prompt and engine.send(prompt, role_config, settings) is None:
+                failed = True
+        engine.wait_for_compaction(settings.timeout)
+        print(f"Tokens: {engine.prompt_tokens}/{engine.completion_tokens} (输入/输出)", file=sys.stderr)
+        if engine.memory["covered"]:
+            print(f"记忆摘要: 已压缩 {engine.memory['covered']} 条消息，Tokens: "
+                  f"{engine.memory['prompt_tokens']}/{engine.memory['completion_tokens']} (输入/输出，已计入上面的合计)",
+                  file=sys.stderr)
+        return 1 if failed else 0
+    except KeyboardInterrupt:
+        print("\n已中断", file=sys.stderr)
+        return 130
+    finally:
+        if log_writer is not None:
+            log_writer.close()
+
+
+def run_bulk_cli(args):
+    """命令行批量处理：进度输出到标准错误，Ctrl+C停止后可用相同命令续跑"""
+    if not args.role:
+        print("错误: --bulk 需要用 --role 指定角色", file=sys.stderr)
+        return 2
+    settings = ApiSettings(args.api_key or os.environ.get("DEEPSEEK_API_KEY", ""), args.base_url,
+                           args.timeout, stream=False)
+    api_router = ApiRouter()
+    try:
+        role_library = load_json_file(args.roles_file, "角色库")
+        if args.role not in role_library:
+            raise ValueError(f"角色库 {args.roles_file} 中没有角色 '{args.role}'")
+        role_config = dict(role_library[args.role], name=args.role)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 2
+    if not api_router.has_key(role_config, settings.api_key):
+        print("错误: 请通过--api-key或环境变量DEEPSEEK_API_KEY提供API Key", file=sys.stderr)
+        return 2
+
+    output_path = args.bulk_output or default_bulk_output(args.bulk)
+    log_writer = None if args.no_log else ApiLogWriter(args.log_dir)
+    job = BulkInferenceJob(args.bulk, output_path, role_config, settings, api_router, log_writer,
+                           concurrency=args.bulk_concurrency, rpm=args.bulk_rpm, max_retries=args.bulk_retries,
+                           ordered=args.bulk_ordered, field=args.bulk_field)
+    errors = []
+
+    def run():
+        try:
+            job.run()
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, name="BulkInference", daemon=True)
+    thread.start()
+    interactive = sys.stderr.isatty()
+    interrupted = False
+    try:
+        while True:
+            try:
+                thread.join(1.0 if interactive else 10.0)
+            except KeyboardInterrupt:
+                interrupted = True
+                job.stop()
+                print("\n正在停止，等待进行中的请求完成...", file=sys.stderr)
+                continue
+            if not thread.is_alive():
+                break
+            if job.started_at is not None:
+                print(("\r" if interactive else "") + job.progress_text(), end="" if interactive else "\n",
+                      file=sys.stderr, flush=True)
+    finally:
+        if log_writer is not None:
+            log_writer.close()
+
+    if errors:
+        print(f"\n错误: {errors[0]}", file=sys.stderr)
+        return 2
+    print(("\n" if interactive else "") + job.progress_text(), file=sys.stderr)
+    print(f"结果已写入 {output_path}", file=sys.stderr)
+    if interrupted:
+        print("已中断，用相同的命令再次运行即可续跑", file=sys.stderr)
+        return 130
+    return 0 if job.failed == 0 else 1
+
+
+# 本地代理：请求中用 "role" 字段或 "model": "role:名称" 指定角色库中的角色
+PROXY_ROLE_PREFIX = "role:"
+PROXY_LATENCY_HISTORY = 200  # 每个客户端保留的最近请求耗时数（用于分位数）
+
+
+class ProxyMetrics:
+    """代理按客户端累计的用量：请求数、错误数、输入/输出token、首token和总耗时"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def record(self, client, status_code, prompt_tokens, completion_tokens, first_token, total, role_name=""):
+        with self.lock:
+            stats = self.clients.get(client)
+            if stats is None:
+                stats = self.clients[client] = {
+                    "requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "roles": {},
+                    "first_token": deque(maxlen=PROXY_LATENCY_HISTORY),
+                    "total": deque(maxlen=PROXY_LATENCY_HISTORY)}
+            stats["requests"] += 1
+            if status_code != 200:
+                stats["errors"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            if role_name:
+                stats["roles"][role_name] = stats["roles"].get(role_name, 0) + 1
+            if first_token is not None:
+                stats["first_token"].append(first_token)
+            if total is not None:
+                stats["total"].append(total)
+
+    def snapshot(self):
+        """各客户端的用量和最近请求的延迟分位数（秒）"""
+        def rounded(value):
+            return round(value, 4) if value is not None else None
+
+        with self.lock:
+            clients = {}
+            for client, stats in self.clients.items():
+                clients[client] = {
+                    "requests": stats["requests"], "errors": stats["errors"],
+                    "prompt_tokens": stats["prompt_tokens"], "completion_tokens": stats["completion_tokens"],
+                    "roles": dict(stats["roles"]),
+                    "first_token_p50": rounded(_percentile(stats["first_token"], 50)),
+                    "first_token_p95": rounded(_percentile(stats["first_token"], 95)),
+                    "total_p50": rounded(_percentile(stats["total"], 50)),
+                    "total_p95": rounded(_percentile(stats["total"], 95)),
                 }
-                self.save_api_log(log_entry)
-
-                # 更新token统计
-                prompt_tokens = usage_data.get('prompt_tokens', 0)
-                completion_tokens = usage_data.get('completion_tokens', 0)
+        return {"uptime": round(time.time() - self.started, 1), "clients": clients}
 
-                self.prompt_tokens += prompt_tokens
-                self.completion_tokens += completion_tokens
+    def prometheus_text(self):
+        """Prometheus文本格式"""
+        lines = []
+        clients = self.snapshot()["clients"]
+        for name, help_text in (("requests", "请求数"), ("errors", "上游返回错误的请求数"),
+                                ("prompt_tokens", "输入token"), ("completion_tokens", "输出token")):
+            lines.append(f"# HELP deepseek_proxy_{name}_total {help_text}")
+            lines.append(f"# TYPE deepseek_proxy_{name}_total counter")
+            for client, stats in clients.items():
+                label = client.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'deepseek_proxy_{name}_total{{client="{label}"}} {stats[name]}')
+        return "\n".join(lines) + "\n"
 
-                if self.on_token_update:
-                    self.on_token_update(prompt_tokens, completion_tokens)
 
-                self.after(0, self.update_token_display)
+class ProxyEngine(ChatEngineBase):
+    """代理的Token统计和API日志（各请求在各自的处理线程中计数）"""
 
-            else:
-                error_msg = f"API错误: {response.status_code}\n{response.text}"
-                self.response_queue.put(f"API错误: {response.status_code}\n\n")
-
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "error": response.text
-                }
-                self.save_api_log(log_entry)
+    tab_type = "proxy"
 
-        except Exception as e:
-            self.response_queue.put(f"API调用失败: {str(e)}\n\n")
+    def __init__(self, api_router=None, log_sink=None):
+        super().__init__(0, api_router, log_sink)
+        self.run_id = new_run_id("proxy")
 
-    def call_api_normal(self, messages, user_input):
-        """非流式调用API"""
-        try:
-            api_key = self.global_api_key.get().strip()
-            base_url = self.global_base_url.get().strip()
-            timeout = self.global_timeout.get()
 
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
+class _ProxyHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
 
-            data = {
-                "model": "deepseek-chat",
-                "messages": messages,
-                "temperature": self.temperature.get(),
-                "max_tokens": self.max_tokens.get(),
-                "stream": False
-            }
 
-            if self.deep_thought.get():
-                data["deep_thought"] = True
-                data["model"] = "deepseek-reasoner"
-                del data["max_tokens"]
-
-            # 记录请求
-            log_entry = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "role_name": self.role_name.get(),
-                "request": {
-                    "url": base_url,
-                    "headers": {"Authorization": "Bearer ***" + api_key[-4:]},
-                    "data": data
-                }
-            }
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    response_started = False  # 流式响应已开始转发
 
-            # 发送请求
-            response = requests.post(base_url, headers=headers, json=data, timeout=timeout)
+    def log_message(self, format, *args):
+        pass
 
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"]
-                usage = result.get("usage", {})
+    def do_GET(self):
+        proxy = self.server.proxy
+        path = urlparse(self.path)
+        if path.path == "/v1/models":
+            self.send_json(200, proxy.list_models())
+        elif path.path == "/metrics":
+            if "format=prometheus" in path.query:
+                self.send_body(200, proxy.metrics.prometheus_text().encode('utf-8'), "text/plain; version=0.0.4; charset=utf-8")
+            else:
+                self.send_json(200, proxy.metrics.snapshot())
+        else:
+            self.send_json(404, proxy_error(f"未知路径: {path.path}"))
 
-                # 显示AI响应
-                self.response_queue.put(f"AI: {ai_response}\n\n")
+    def do_POST(self):
+        proxy = self.server.proxy
+        self.response_started = False
+        if urlparse(self.path).path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self.send_json(404, proxy_error(f"未知路径: {self.path}"))
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not isinstance(body, dict) or not isinstance(body.get("messages"), list):
+                raise ValueError("请求体需要messages列表")
+            request = proxy.prepare(body)
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_json(400, proxy_error(str(e)))
+            return
+        proxy.forward(self, request, self.client_id())
+
+    def client_id(self):
+        """客户端标识：X-Client-Id请求头，其次为客户端API Key的末4位，最后为IP"""
+        client = self.headers.get("X-Client-Id")
+        if client:
+            return client.strip()[:64]
+        authorization = self.headers.get("Authorization") or ""
+        if authorization.startswith("Bearer ") and len(authorization) > 7:
+            return "key-" + authorization[-4:]
+        return self.client_address[0]
+
+    def send_json(self, status_code, data):
+        self.send_body(status_code, json.dumps(data, ensure_ascii=False).encode('utf-8'), "application/json")
+
+    def send_body(self, status_code, payload, content_type):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def proxy_error(message, error_type="invalid_request_error"):
+    """OpenAI格式的错误响应"""
+    return {"error": {"message": message, "type": error_type}}
+
+
+class ChatProxyServer:
+    """本地OpenAI兼容代理：POST /v1/chat/completions 转发到上游，GET /v1/models 列出角色，GET /metrics 导出用量
+
+    - 请求中的 "role" 字段或 "model": "role:名称" 指定角色库中的角色：使用角色的系统提示（加在消息最前）、
+      模型、温度等参数和路由（接口配置），请求中显式给出的参数优先
+    - 所有客户端共用ApiRouter，同一上游的连接池和并发限制是共享的
+    - 流式响应逐行原样转发，转发后再解析用于Token统计；客户端没有要求usage时，代理请求的usage数据块不转发
+    - 上游API Key由代理持有，客户端的Authorization只用于区分客户端
+    """
+
+    def __init__(self, roles, settings, api_router=None, log_sink=None, host="127.0.0.1", port=8000):
+        self.roles = roles
+        self.settings = settings
+        self.api_router = api_router or ApiRouter()
+        self.engine = ProxyEngine(self.api_router, log_sink)
+        self.metrics = ProxyMetrics()
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self):
+        self.httpd = _ProxyHTTPServer((self.host, self.port), _ProxyHandler)
+        self.httpd.proxy = self
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="ChatProxyServer", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def list_models(self):
+        models = [{"id": model, "object": "model", "owned_by": "upstream"}
+                  for model in (DEFAULT_CHAT_MODEL, DEFAULT_REASONER_MODEL)]
+        models += [{"id": PROXY_ROLE_PREFIX + name, "object": "model", "owned_by": "roles"}
+                   for name in self.roles.keys()]
+        return {"object": "list", "data": models}
+
+    def prepare(self, body):
+        """由客户端请求体构建上游请求，返回字典：route、data、role_name、strip_usage；角色不存在时抛出ValueError"""
+        body = dict(body)
+        role_name = body.pop("role", None)
+        model = body.get("model") or ""
+        if not role_name and model.startswith(PROXY_ROLE_PREFIX):
+            role_name = model[len(PROXY_ROLE_PREFIX):]
+        if role_name and (model.startswith(PROXY_ROLE_PREFIX) or not model):
+            body.pop("model", None)
+
+        if role_name:
+            if role_name not in self.roles:
+                raise ValueError(f"角色库中没有角色 '{role_name}'")
+            role_config = dict(self.roles[role_name], name=role_name)
+            messages = body.pop("messages")
+            if role_config.get("system_prompt"):
+                messages = [{"role": "system", "content": role_config["system_prompt"]}] + messages
+            data = build_chat_request(role_config, messages, stream=bool(body.get("stream")))
+            data.pop("stream_options", None)
+            data.update(body)
+        else:
+            role_config = {}
+            data = body
+            data.setdefault("model", DEFAULT_CHAT_MODEL)
+
+        if not self.api_router.has_key(role_config, self.settings.api_key):
+            raise ValueError("代理未配置上游API Key（--api-key或环境变量DEEPSEEK_API_KEY）")
+
+        # 流式请求总是要求usage用于统计，客户端没有要求时不转发usage数据块
+        strip_usage = False
+        if data.get("stream") and not (data.get("stream_options") or {}).get("include_usage"):
+            data["stream_options"] = dict(data.get("stream_options") or {}, **STREAM_OPTIONS)
+            strip_usage = True
+        route = self.api_router.resolve(role_config, self.settings.base_url, self.settings.api_key)
+        return {"route": route, "data": data, "role_name": role_name or "", "strip_usage": strip_usage}
+
+    def forward(self, handler, request, client):
+        """转发一个请求并记录用量和API日志（处理线程）"""
+        route, data = request["route"], request["data"]
+        log_entry = self.engine.new_log_entry(route, data, role_name=request["role_name"])
+        try:
+            if data.get("stream"):
+                response, timer, meter = self._forward_stream(handler, route, data, request["strip_usage"])
+            else:
+                response, timer, meter = self._forward_normal(handler, route, data)
+        except requests.RequestException as e:
+            # 已开始转发时只能中断连接，否则返回错误
+            if handler.response_started:
+                handler.close_connection = True
+            else:
+                handler.send_json(502, proxy_error(f"上游请求失败: {e}", "upstream_error"))
+            self.metrics.record(client, 502, 0, 0, None, None, request["role_name"])
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开，上游连接随之关闭（按惯例记为499）
+            handler.close_connection = True
+            self.metrics.record(client, 499, 0, 0, None, None, request["role_name"])
+            return
 
-                # 记录对话历史
-                self.conversation_history.append({
-                    "role": "user",
-                    "content": user_input,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": ai_response,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
+        prompt_tokens = completion_tokens = 0
+        if response["status_code"] == 200:
+            prompt_tokens, completion_tokens = meter.prompt_tokens, meter.completion_tokens
+            self.engine.add_tokens(prompt_tokens, completion_tokens)
+        self.metrics.record(client, response["status_code"], prompt_tokens, completion_tokens,
+                            timer.first_token, timer.total, request["role_name"])
+        response["client"] = client
+        log_entry["response"] = response
+        log_entry["timer"] = timer
+        self.engine.write_log(log_entry)
+
+    def _forward_stream(self, handler, route, data, strip_usage):
+        timer = RequestTimer()
+        meter = StreamTokenMeter(data.get("messages"))
+        content_parts = []
+        with route.open_stream(data, timeout=self.settings.timeout) as upstream:
+            timer.mark_headers(upstream)
+            if upstream.status_code != 200:
+                timer.finish()
+                handler.send_body(upstream.status_code, upstream.content,
+                                  upstream.headers.get("Content-Type", "application/json"))
+                return {"status_code": upstream.status_code, "error": upstream.text}, timer, meter
+
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/event-stream")
+            handler.send_header("Cache-Control", "no-cache")
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+            handler.response_started = True
+            for line in upstream.iter_lines():
+                if not line:
+                    continue
+                timer.on_chunk()
+                timer.add_bytes(len(line) + 1)
+                chunk = None
+                if line.startswith(b"data: {"):
+                    try:
+                        chunk = json.loads(line[6:])
+                    except json.JSONDecodeError:
+                        pass
+                if not (strip_usage and chunk and chunk.get("usage") and not chunk.get("choices")):
+                    # 先转发再解析，统计不增加转发延迟
+                    handler.write_chunk(line + b"\n\n")
+                if not chunk:
+                    continue
+                if chunk.get("usage"):
+                    meter.set_usage(chunk["usage"])
+                delta = ((chunk.get("choices") or [{}])[0] or {}).get("delta") or {}
+                if delta.get("reasoning_content"):
+                    timer.mark_first_token()
+                    meter.feed_reasoning(delta["reasoning_content"])
+                if delta.get("content"):
+                    timer.mark_first_token()
+                    meter.feed(delta["content"])
+                    content_parts.append(delta["content"])
+            handler.write_chunk(b"")
+            timer.finish()
+        route.record_latency(timer.first_token, timer.total)
+        route.record_usage(upstream, meter.prompt_tokens, meter.completion_tokens)
+        return {"status_code": 200, "content": "".join(content_parts), "usage": meter.usage or {},
+                "token_meter": meter.summary(), "stream": True}, timer, meter
+
+    def _forward_normal(self, handler, route, data):
+        timer = RequestTimer()
+        meter = StreamTokenMeter(data.get("messages"))
+        key_state = route.acquire_key(data)
+        with route.slot():
+            upstream = route.post(data, timeout=self.settings.timeout, stream=True, key_state=key_state)
+            timer.mark_headers(upstream)
+            try:
+                payload = upstream.content
+            finally:
+                release_response(upstream)
+        timer.add_bytes(len(payload))
+        timer.finish()
+        route.record_latency(None, timer.total)
+        handler.send_body(upstream.status_code, payload, upstream.headers.get("Content-Type", "application/json"))
+        if upstream.status_code != 200:
+            return {"status_code": upstream.status_code, "error": upstream.text}, timer, meter
+        try:
+            result = json.loads(payload)
+            content = result["choices"][0]["message"].get("content") or ""
+        except (ValueError, KeyError, IndexError, TypeError):
+            result, content = {}, ""
+        meter.feed(content)
+        if result.get("usage"):
+            meter.set_usage(result["usage"])
+        route.record_usage(upstream, meter.prompt_tokens, meter.completion_tokens)
+        return {"status_code": 200, "content": content, "usage": meter.usage or {}, "stream": False}, timer, meter
+
+
+def run_proxy_server(args):
+    """在前台运行本地代理，直到按Ctrl+C；退出时输出各客户端用量（--proxy-metrics时另写入文件）"""
+    roles = RoleStore(args.roles_file)
+    try:
+        roles.load()
+    except Exception as e:
+        print(f"错误: 读取角色库失败: {e}", file=sys.stderr)
+        roles.close()
+        return 2
+    settings = ApiSettings(args.api_key or os.environ.get("DEEPSEEK_API_KEY", ""), args.base_url, args.timeout)
+    log_writer = None if args.no_log else ApiLogWriter(args.log_dir)
+    try:
+        server = ChatProxyServer(roles, settings, ApiRouter(), log_writer, host=args.proxy_host,
+                                 port=args.proxy).start()
+    except OSError as e:
+        print(f"错误: 启动代理失败: {e}", file=sys.stderr)
+        roles.close()
+        return 2
+    print(f"代理已启动: {server.base_url}/chat/completions，{len(roles)} 个角色（Ctrl+C 停止）", file=sys.stderr)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())  # 被服务管理器停止时同样正常退出
+    try:
+        while not stop_event.wait(2):
+            roles.check_external_changes()  # 角色库被界面或其他实例修改时自动生效
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        if log_writer is not None:
+            log_writer.close()
+        roles.close()
+
+    metrics = server.metrics.snapshot()
+    for client, stats in metrics["clients"].items():
+        print(f"{client}: {stats['requests']} 次请求，{stats['errors']} 次错误，"
+              f"Tokens {stats['prompt_tokens']}/{stats['completion_tokens']}", file=sys.stderr)
+    if args.proxy_metrics:
+        atomic_write_text(args.proxy_metrics, json.dumps(metrics, ensure_ascii=False, indent=2) + "\n")
+    return 0
+
+
+# 基准测试：结果文件（与代码一起提交，用于发现性能回退）、默认重复次数和回退阈值
+BENCHMARK_BASELINE_FILE = "benchmark_baseline.json"
+BENCHMARK_REPEAT = 7
+BENCHMARK_TOLERANCE = 0.25
+
+# 生成测试数据用的中英文混排文本
+BENCHMARK_TEXT = ("流式输出时每个数据块通常只有一两个词，tokens arrive in small pieces; "
+                  "多角色对话会把上一个角色的回复和连接词一起作为下一个角色的提问。")
+
+
+def sse_chunk(delta=None, finish_reason=None, usage=None, model="deepseek-reasoner"):
+    """一个与DeepSeek格式相同的流式数据块（SSE的data行，不含换行）；usage块的choices为空"""
+    chunk = {"id": "bench-0001", "object": "chat.completion.chunk", "created": 1700000000,
+             "model": model, "system_fingerprint": "fp_bench",
+             "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}]}
+    if usage is not None:
+        chunk["choices"] = []
+        chunk["usage"] = usage
+    return b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def text_pieces(rng):
+    """无限产出1~4个字的文本片段，模拟流式输出的token"""
+    while True:
+        start = rng.randrange(len(BENCHMARK_TEXT) - 4)
+        yield BENCHMARK_TEXT[start:start + rng.randint(1, 4)]
+
+
+def make_sse_fixture(content_chunks=1000, reasoning_chunks=200, seed=42):
+    """生成与DeepSeek流式响应格式相同的SSE行（固定随机种子，每次生成的内容相同）
+
+    先是思考内容，然后是正文，最后是finish_reason、usage数据块和[DONE]，数据块之间有空行。
+    """
+    pieces = text_pieces(random.Random(seed))
+    lines = []
+
+    def add_chunk(delta=None, finish_reason=None, usage=None):
+        lines.append(sse_chunk(delta, finish_reason, usage))
+        lines.append(b"")
+
+    def piece():
+        return next(pieces)
+
+    add_chunk({"role": "assistant", "content": None, "reasoning_content": ""})
+    for _ in range(reasoning_chunks):
+        add_chunk({"content": None, "reasoning_content": piece()})
+    for _ in range(content_chunks):
+        add_chunk({"content": piece(), "reasoning_content": None})
+    add_chunk({"content": "", "reasoning_content": None}, finish_reason="stop")
+    completion_tokens = content_chunks + reasoning_chunks
+    add_chunk(usage={"prompt_tokens": 120, "completion_tokens": completion_tokens,
+                     "total_tokens": 120 + completion_tokens,
+                     "completion_tokens_details": {"reasoning_tokens": reasoning_chunks}})
+    lines.append(b"data: [DONE]")
+    lines.append(b"")
+    return lines
+
+
+def make_history_fixture(count=5000, seed=42):
+    """生成单角色会话历史：用户和助手交替，长度从几十字到两千字"""
+    rng = random.Random(seed)
+    history = []
+    for index in range(count):
+        length = rng.randint(50, 2000)
+        history.append({"role": "user" if index % 2 == 0 else "assistant",
+                        "content": (BENCHMARK_TEXT * (length // len(BENCHMARK_TEXT) + 1))[:length],
+                        "timestamp": "12:00:00"})
+    return history
+
+
+def make_pipeline_fixture(role_count=50):
+    """生成多角色协同配置：role_count个角色（名称有重复，用于测试编号显示），相邻角色之间都有连接词"""
+    ordered_roles = [{"id": index,
+                      "role": {"name": f"角色{index % 20}", "system_prompt": f"你是第{index}个角色。" * 10,
+                               "model": "deepseek-chat", "temperature": 0.7, "max_tokens": 2000}}
+                     for index in range(role_count)]
+    connections = [{"from": ordered_roles[index]["id"],
+                    "to": ordered_roles[(index + 1) % role_count]["id"],
+                    "connector": f"，请第{index + 1}位继续："}
+                   for index in range(role_count)]
+    return {"ordered_roles": ordered_roles, "connections": connections, "iteration_count": 3,
+            "initial_prompt": "讨论一下远程办公", "keep_mind": True, "connect_end_to_start": True}
+
+
+class BenchmarkSkipped(Exception):
+    """当前环境无法运行的基准测试"""
+
+
+class BenchmarkFixtures:
+    """基准测试共用的数据和资源（按需生成，结束时清理临时目录和Tk窗口）"""
+
+    def __init__(self, cassette_path=None):
+        self.cassette_path = cassette_path  # 录制的磁带，用于回放真实流量
+        self.sse_lines = make_sse_fixture()
+        self.history = make_history_fixture()
+        self.pipeline = make_pipeline_fixture()
+        self._temp_dir = None
+        self._tk_root = None
+
+    @property
+    def temp_dir(self):
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.mkdtemp(prefix="deepseek_bench_")
+        return self._temp_dir
+
+    @property
+    def tk_root(self):
+        """隐藏的Tk根窗口；没有显示器时抛出tk.TclError，相应的测试会被跳过"""
+        if self._tk_root is None:
+            self._tk_root = tk.Tk()
+            self._tk_root.withdraw()
+        return self._tk_root
+
+    def log_record(self):
+        """一条典型的流式请求日志：10条上下文消息和一段回复"""
+        messages = [{"role": "system", "content": BENCHMARK_TEXT * 5}]
+        messages += [{"role": entry["role"], "content": entry["content"]} for entry in self.history[-10:]]
+        return {"kind": "api", "timestamp": "2024-01-01 12:00:00", "ts": 1704081600.0, "tab_id": 1,
+                "tab_type": "session", "run_id": "1-bench", "route": "default", "role_name": "编程助手",
+                "request": {"url": DEFAULT_BASE_URL, "data": build_chat_request({"name": "编程助手"}, messages)},
+                "response": {"status_code": 200, "content": BENCHMARK_TEXT * 40, "reasoning_content": "",
+                             "usage": {"prompt_tokens": 5000, "completion_tokens": 1200}},
+                "timing": RequestTimer().summary()}
+
+    def close(self):
+        if self._tk_root is not None:
+            self._tk_root.destroy()
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+
+def _bench_sse_parse(fixtures):
+    lines = fixtures.sse_lines
+
+    def run():
+        for _ in iter_sse_json(ReplayResponse(lines), timer=RequestTimer()):
+            pass
+    return run
+
+
+def _bench_stream_chat(fixtures):
+    lines = fixtures.sse_lines
+    route = ApiRoute("bench", DEFAULT_BASE_URL, "sk-bench")
+    route.post = lambda data, timeout, stream=False, key_state=None: ReplayResponse(lines)
+    data = build_chat_request({"name": "bench"}, [{"role": "user", "content": BENCHMARK_TEXT}])
+    events = []
+
+    def run():
+        events.clear()
+        stream_chat(route, data, 60, CancelToken(), events.append, lambda meter: meter.status_text())
+    return run
+
+
+def _bench_cancel_latency(fixtures):
+    # 流在第一个正文块之后停滞；收到该块时通知另一个线程调用cancel()，计时到stream_chat返回为止
+    lines = make_sse_fixture(content_chunks=2, reasoning_chunks=0)
+    delays = [0.0] * len(lines)
+    delays[4] = 60.0  # 第二个正文块
+    route = ApiRoute("bench", DEFAULT_BASE_URL, "sk-bench")
+    route.post = lambda data, timeout, stream=False, key_state=None: ReplayResponse(lines, delays=delays)
+    data = build_chat_request({"name": "bench"}, [{"role": "user", "content": BENCHMARK_TEXT}])
+    pending = queue.Queue()
+
+    def canceller():
+        while True:
+            pending.get().cancel()
+    threading.Thread(target=canceller, name="BenchCancel", daemon=True).start()
+
+    def run():
+        cancel_token = CancelToken()
+        started = []
+
+        def emit(item):
+            if not started and isinstance(item, tuple) and item[0] == "text":
+                started.append(True)
+                pending.put(cancel_token)
+        stream_chat(route, data, 60, cancel_token, emit)
+    return run
+
+
+def _bench_cassette_replay(fixtures):
+    if not fixtures.cassette_path:
+        raise BenchmarkSkipped("未指定--replay-cassette")
+    recorded = [([text.encode('utf-8') for _, text in interaction["lines"]], interaction["request"])
+                for interaction in CassettePlayer(fixtures.cassette_path).interactions
+                if interaction.get("lines") and interaction.get("status_code") == 200]
+    if not recorded:
+        raise BenchmarkSkipped("磁带中没有成功的流式响应")
+    route = ApiRoute("bench", DEFAULT_BASE_URL, "sk-bench")
+    events = []
+
+    def run():
+        for lines, data in recorded:
+            route.post = lambda data, timeout, stream=False, key_state=None, lines=lines: ReplayResponse(lines)
+            events.clear()
+            stream_chat(route, data, 60, CancelToken(), events.append, lambda meter: meter.status_text())
+    return run
+
+
+def _bench_collect_content(fixtures):
+    pieces = [chunk["choices"][0]["delta"]["content"] for chunk in iter_sse_json(ReplayResponse(fixtures.sse_lines))
+              if chunk.get("choices") and chunk["choices"][0]["delta"].get("content")]
+
+    def run():
+        content_parts = []
+        for content in pieces:
+            content_parts.append(content)
+        return "".join(content_parts)
+    return run
+
+
+def _bench_log_encode(fixtures):
+    record = fixtures.log_record()
+    index = LogIndex(fixtures.temp_dir)
+
+    def run():
+        json.dumps(index.dedup_record(record), ensure_ascii=False, separators=(',', ':'))
+    return run
+
+
+def _bench_build_messages(fixtures):
+    engine = ChatSessionEngine(0)
+    engine.history = fixtures.history
+    role_config = {"name": "bench", "system_prompt": BENCHMARK_TEXT}
+
+    def run():
+        engine.build_messages(role_config, BENCHMARK_TEXT)
+    return run
+
+
+def _bench_build_messages_for_role(fixtures):
+    engine = MultiRolePipelineEngine(0)
+    engine.config = fixtures.pipeline
+    roles = engine.ordered_roles
+    last_response = BENCHMARK_TEXT * 20
+
+    def run():
+        for role_index, role_info in enumerate(roles):
+            engine.build_messages_for_role(role_info["role"], role_info["id"],
+                                           roles[(role_index + 1) % len(roles)]["id"], last_response, 1, role_index)
+    return run
+
+
+def _bench_get_connector(fixtures):
+    engine = MultiRolePipelineEngine(0)
+    engine.config = fixtures.pipeline
+    pairs = [(connection["from"], connection["to"]) for connection in fixtures.pipeline["connections"]]
+
+    def run():
+        for from_id, to_id in pairs:
+            engine.get_connector(from_id, to_id)
+    return run
+
+
+def _bench_save_connection(fixtures):
+    # save_connection只使用connections属性，不需要创建界面
+    holder = types.SimpleNamespace(connections=list(fixtures.pipeline["connections"]))
+    saved = [(connection["from"], connection["to"], connection["connector"])
+             for connection in fixtures.pipeline["connections"]]
+
+    def run():
+        for from_id, to_id, connector in saved:
+            OptimizedMultiRoleTab.save_connection(holder, from_id, to_id, connector)
+    return run
+
+
+def _bench_dialog_turn_append(fixtures):
+    store = DialogTurnStore()
+    response = BENCHMARK_TEXT * 20
+    entry = {"iteration": 1, "role_index": 0, "role_name": "角色0", "message": response + "，请继续：",
+             "response": response, "timestamp": "12:00:00"}
+
+    def run():
+        # 定期清空，避免溢出文件随计时次数无限增长
+        if len(store) >= 1000:
+            store.clear()
+        store.append(dict(entry))
+    return run
+
+
+def _bench_ordered_roles_display(fixtures):
+    holder = types.SimpleNamespace(ordered_roles=fixtures.pipeline["ordered_roles"],
+                                   ordered_listbox=tk.Listbox(fixtures.tk_root))
+
+    def run():
+        OptimizedMultiRoleTab.update_ordered_roles_display(holder)
+    return run
+
+
+def _bench_text_insert(fixtures):
+    holder = types.SimpleNamespace(history_text=scrolledtext.ScrolledText(fixtures.tk_root))
+    pieces = [BENCHMARK_TEXT[index % 40:index % 40 + 3] for index in range(1000)]
+
+    def run():
+        holder.history_text.config(state='normal')
+        holder.history_text.delete("1.0", tk.END)
+        for piece in pieces:
+            SessionTab.append_to_history(holder, piece)
+    return run
+
+
+# 名称 -> (说明, 单次操作的内容, 准备函数)；准备函数返回被计时的无参函数
+BENCHMARKS = {
+    "sse_parse": ("iter_sse_json逐行解析", "1条流(1200块)", _bench_sse_parse),
+    "stream_chat": ("stream_chat完整处理流式响应", "1条流(1200块)", _bench_stream_chat),
+    "cancel_latency": ("停止流式请求：另一线程cancel()到stream_chat返回", "1次停止", _bench_cancel_latency),
+    "cassette_replay": ("stream_chat处理磁带中录制的全部流（需要--replay-cassette）", "整盘磁带", _bench_cassette_replay),
+    "collect_content": ("正文数据块累积拼接", "1条流(1000块)", _bench_collect_content),
+    "log_encode": ("API日志去重并序列化", "1条日志", _bench_log_encode),
+    "build_messages": ("单角色构建上下文（5000条历史）", "1次", _bench_build_messages),
+    "build_messages_for_role": ("多角色构建消息（50个角色）", "1轮(50次)", _bench_build_messages_for_role),
+    "get_connector": ("查找连接词（50个连接）", "50次", _bench_get_connector),
+    "save_connection": ("保存连接词（50个连接）", "50次", _bench_save_connection),
+    "dialog_turn_append": ("对话记录追加一轮", "1轮", _bench_dialog_turn_append),
+    "ordered_roles_display": ("刷新已排序角色列表（50个角色，需要显示器）", "1次", _bench_ordered_roles_display),
+    "text_insert": ("文本区逐块插入（需要显示器）", "1000块", _bench_text_insert),
+}
+
+
+def run_benchmark(func, repeat=BENCHMARK_REPEAT, min_time=0.05):
+    """计时：先确定每组的调用次数（每组至少min_time秒），再重复repeat组，返回每次调用的秒数"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    timings = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {"min": min(timings), "median": statistics.median(timings), "number": number, "repeat": repeat}
+
+
+def format_duration(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds * 1e6:.1f}µs"
+
+
+def run_benchmarks(args):
+    """命令行基准测试：与基准结果文件比较，最小耗时超出阈值视为性能回退（返回码1）"""
+    names = [name.strip() for name in args.benchmark.split(",") if name.strip()] if args.benchmark != "all" else []
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"错误: 未知的基准测试 {', '.join(unknown)}，可选: {', '.join(BENCHMARKS)}", file=sys.stderr)
+        return 2
+    names = names or list(BENCHMARKS)
+
+    baseline = {}
+    if os.path.exists(args.benchmark_baseline):
+        try:
+            baseline = load_json_file(args.benchmark_baseline, "基准结果")
+        except ValueError as e:
+            print(f"错误: {e}", file=sys.stderr)
+            return 2
+        if baseline.get("python") != platform.python_version() or baseline.get("machine") != platform.machine():
+            print(f"注意: 基准结果来自 Python {baseline.get('python')} / {baseline.get('machine')}，"
+                  f"与当前环境不同，比较结果仅供参考", file=sys.stderr)
+    baseline_results = baseline.get("results", {})
+
+    widths = (24, 11, 11, 11, 9)
+
+    def render(*values):
+        # 按显示宽度对齐（中文占两列），名称左对齐、数值右对齐
+        cells = [values[0] + " " * (widths[0] - _display_width(values[0]))]
+        cells += [" " * (width - _display_width(value)) + value for value, width in zip(values[1:], widths[1:])]
+        return "  ".join(cells + list(values[len(widths):]))
+
+    fixtures = BenchmarkFixtures(args.replay_cassette)
+    results = {}
+    regressions = []
+    print(render("名称", "每次(最小)", "每次(中位)", "基准", "变化", "单位"))
+    try:
+        for name in names:
+            description, unit, setup = BENCHMARKS[name]
+            try:
+                result = run_benchmark(setup(fixtures), repeat=args.benchmark_repeat)
+            except (tk.TclError, BenchmarkSkipped) as e:
+                print(render(name, "跳过", "", "", "", str(e)))
+                continue
+            result["unit"] = unit
+            results[name] = result
+
+            base = baseline_results.get(name)
+            change = ""
+            if base:
+                ratio = result["min"] / base["min"] - 1
+                change = f"{ratio:+.0%}"
+                if ratio > args.benchmark_tolerance:
+                    regressions.append(name)
+                    change += " 回退"
+            print(render(name, format_duration(result["min"]), format_duration(result["median"]),
+                         format_duration(base["min"]) if base else "-", change, unit, description))
+    finally:
+        fixtures.close()
+
+    if args.benchmark_save:
+        # 只更新本次运行的项目，保留其他项目（如本机无法运行的界面测试）的基准
+        saved = dict(baseline_results, **results)
+        atomic_write_text(args.benchmark_baseline, json.dumps({
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {name: {key: round(value, 9) if isinstance(value, float) else value
+                               for key, value in result.items()} for name, result in saved.items()}
+        }, ensure_ascii=False, indent=2))
+        print(f"基准结果已保存到 {args.benchmark_baseline}")
+
+    if regressions:
+        print(f"性能回退（超过基准 {args.benchmark_tolerance:.0%}）: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 负载测试时大量连接同时到达
+
+
+class _MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # 不输出每个请求的访问日志
+
+    def do_POST(self):
+        mock = self.server.mock
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            self.send_error(400)
+            return
+        mock.count_request()
+        time.sleep(mock.latency)
+
+        if not body.get("stream"):
+            payload = json.dumps(mock.completion(body), ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
 
-                # 记录API日志
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "content": ai_response,
-                    "usage": usage
-                }
-                self.save_api_log(log_entry)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in mock.stream_lines(body):
+                data = line + b"\n\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端停止读取（取消请求）
+            self.close_connection = True
+
+
+class MockChatServer:
+    """本地模拟的OpenAI兼容聊天接口（负载测试使用），接受任意路径的POST请求
+
+    流式请求等待latency秒后，每隔interval秒发送一个正文数据块，共chunks块，
+    最后发送usage数据块和[DONE]；非流式请求等待后返回完整回复。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, chunks=50, interval=0.02, latency=0.1):
+        self.host = host
+        self.port = port
+        self.chunks = chunks
+        self.interval = interval
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/chat/completions"
+
+    def start(self):
+        self.httpd = _MockHTTPServer((self.host, self.port), _MockChatHandler)
+        self.httpd.mock = self
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="MockChatServer", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def usage(self, body):
+        prompt_tokens = estimate_messages_tokens(body.get("messages"))
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": self.chunks,
+                "total_tokens": prompt_tokens + self.chunks}
+
+    def stream_lines(self, body):
+        """逐块产出流式响应的data行（按interval间隔）"""
+        pieces = text_pieces(random.Random(self.requests))
+        model = body.get("model", "mock")
+        yield sse_chunk({"role": "assistant", "content": ""}, model=model)
+        for _ in range(self.chunks):
+            time.sleep(self.interval)
+            yield sse_chunk({"content": next(pieces)}, model=model)
+        yield sse_chunk({"content": ""}, finish_reason="stop", model=model)
+        yield sse_chunk(usage=self.usage(body), model=model)
+        yield b"data: [DONE]"
+
+    def completion(self, body):
+        pieces = text_pieces(random.Random(self.requests))
+        time.sleep(self.interval * self.chunks)
+        return {"id": "mock-0001", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant",
+                                         "content": "".join(next(pieces) for _ in range(self.chunks))}}],
+                "usage": self.usage(body)}
+
+
+def _serve_mock_process(conn, options):
+    """子进程入口：启动模拟接口并把端口发回父进程，一直运行到被结束"""
+    server = MockChatServer(**options).start()
+    conn.send(server.port)
+    conn.close()
+    threading.Event().wait()
+
+
+def start_mock_process(chunks, interval, latency):
+    """在独立进程中启动模拟接口（不占用被测进程的线程和CPU），返回(进程, 接口地址)"""
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_serve_mock_process, name="MockChatServer", daemon=True,
+                              args=(child_conn, {"chunks": chunks, "interval": interval, "latency": latency}))
+    process.start()
+    port = parent_conn.recv()
+    return process, f"http://127.0.0.1:{port}/chat/completions"
+
+
+def current_rss():
+    """当前进程的常驻内存（字节），取不到时返回None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 取不到当前值时退而使用峰值（macOS单位为字节，Linux为KB）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100.0 * (len(ordered) - 1))))]
+
+
+class LoadTestSink:
+    """负载测试期间收集API日志记录，同时转交给原来的日志写入器"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.records = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        if record.get("kind") == "api":
+            with self.lock:
+                self.records.append(record)
+        if self.inner is not None:
+            self.inner.write(record)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+
+class HeadlessLoadTab:
+    """无显示器时代替标签页：与标签页相同，每个请求一个工作线程、每个标签页一个响应队列，
+    由Tcl事件循环每100ms取出队列内容（只计时不显示）"""
+
+    def __init__(self, root, engine_class, tab_id, api_router, log_sink):
+        self.root = root
+        self.response_queue = queue.Queue()
+        self.engine = engine_class(tab_id, api_router, log_sink, emit=self.response_queue.put)
+        self.is_busy = False
+        self.cancel_token = None
+        self.process_response_queue()
 
-                # 更新token统计
-                prompt_tokens = usage.get('prompt_tokens', 0)
-                completion_tokens = usage.get('completion_tokens', 0)
+    def process_response_queue(self):
+        while True:
+            try:
+                item = self.response_queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                kind, payload = item
+                if kind == "text":
+                    payload[1].on_render(payload[2])
+                elif kind == "log":
+                    self.engine.write_log(payload)
+        self.root.after(100, self.process_response_queue)
+
+    def send(self, text, role_config, settings):
+        self.cancel_token = CancelToken()
+        self._start(self.engine.send, text, role_config, settings, self.cancel_token)
+
+    def start_pipeline(self, config, settings):
+        self.engine.prepare(config)
+        self._start(self.engine.run, settings)
+
+    def stop(self):
+        if isinstance(self.engine, MultiRolePipelineEngine):
+            self.engine.stop()
+        elif self.cancel_token is not None:
+            self.cancel_token.cancel()
+
+    def _start(self, func, *args):
+        self.is_busy = True
+
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"负载测试请求失败: {e}")
+            finally:
+                self.is_busy = False
+        threading.Thread(target=run, daemon=True).start()
 
-                self.prompt_tokens += prompt_tokens
-                self.completion_tokens += completion_tokens
 
-                if self.on_token_update:
-                    self.on_token_update(prompt_tokens, completion_tokens)
+class GuiLoadTab:
+    """把真实标签页包装成负载测试使用的接口（通过界面操作发送和停止）"""
 
-                self.after(0, self.update_token_display)
+    def __init__(self, tab):
+        self.tab = tab
 
-            else:
-                error_msg = f"API错误: {response.status_code}\n{response.text}"
-                self.response_queue.put(f"API错误: {response.status_code}\n\n")
+    @property
+    def is_busy(self):
+        if isinstance(self.tab, SessionTab):
+            return self.tab.is_streaming
+        return self.tab.engine.is_running
 
-                log_entry["response"] = {
-                    "status_code": response.status_code,
-                    "error": response.text
-                }
-                self.save_api_log(log_entry)
+    def send(self, text, role_config, settings):
+        self.tab.input_text.insert("1.0", text)
+        self.tab.send_message()
 
-        except Exception as e:
-            self.response_queue.put(f"API调用失败: {str(e)}\n\n")
+    def start_pipeline(self, config, settings):
+        self.tab.apply_config(config)
+        self.tab.start_dialog()
 
-    def process_response_queue(self):
-        """处理响应队列"""
+    def stop(self):
+        if isinstance(self.tab, SessionTab):
+            self.tab.stop_stream()
+        else:
+            self.tab.stop_dialog()
+
+
+# 负载测试：单角色标签页使用的角色，多角色标签页的配置（循环次数足够覆盖整个测试时长）
+LOAD_TEST_ROLE = {"name": "负载测试", "system_prompt": "你是一个负载测试助手。", "model": "deepseek-chat",
+                  "temperature": 0.7, "max_tokens": 2000}
+LOAD_TEST_PIPELINE = {
+    "ordered_roles": [{"id": index, "role": dict(LOAD_TEST_ROLE, name=f"负载测试{index + 1}")} for index in range(3)],
+    "connections": [], "iteration_count": 10000, "initial_prompt": "负载测试", "connect_end_to_start": True,
+}
+
+
+class LoadTest:
+    """一档负载：打开N个单角色标签页和M个多角色标签页，按泊松到达率向空闲的单角色标签页发送消息，
+    多角色标签页持续运行；结束后统计吞吐量、界面延迟、线程数、内存和丢失/迟到的正文数据块
+
+    有显示器时创建真实的主窗口和标签页，否则（或headless=True时）用HeadlessLoadTab和Tcl事件循环。
+    在临时目录中运行，不影响现有的角色、会话和日志。
+    """
+
+    def __init__(self, base_url, sessions, multi_roles=0, rate=5.0, duration=30.0, expected_chunks=None,
+                 headless=False, seed=42):
+        self.base_url = base_url
+        self.sessions = sessions
+        self.multi_roles = multi_roles
+        self.rate = rate
+        self.duration = duration
+        self.expected_chunks = expected_chunks  # 每次回复应显示的正文块数（模拟接口已知时用于统计丢失）
+        self.headless = headless
+        self.rng = random.Random(seed)
+        self.sent = 0
+        self.skipped = 0  # 到达时所有单角色标签页都在忙
+
+    def run(self):
+        """运行并返回统计结果"""
+        workdir = tempfile.mkdtemp(prefix="deepseek_load_")
+        previous_cwd = os.getcwd()
+        os.chdir(workdir)
         try:
-            while True:
-                try:
-                    text = self.response_queue.get_nowait()
-                    self.append_to_history(text)
-                except queue.Empty:
-                    break
-        except:
-            pass
+            return self._run()
         finally:
-            self.after(100, self.process_response_queue)
-
-    def append_to_history(self, text):
-        """追加文本到历史记录"""
-        self.history_text.config(state='normal')
-        self.history_text.insert(tk.END, text)
-        self.history_text.see(tk.END)
-        self.history_text.config(state='disabled')
+            os.chdir(previous_cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
 
-    def update_token_display(self):
-        """更新Token显示"""
-        self.token_label.config(text=f"Tokens: {self.prompt_tokens}/{self.completion_tokens} (输入/输出)")
+    def _open_tabs(self):
+        """创建根窗口和标签页，返回(root, 结束时的清理函数, 卡顿监视器, 日志收集器, 单角色标签页, 多角色标签页)"""
+        if not self.headless:
+            try:
+                root = tk.Tk()
+            except tk.TclError:
+                print("没有可用的显示器，改用无界面模式", file=sys.stderr)
+                self.headless = True
+
+        if self.headless:
+            root = tk.Tcl()
+            sink = LoadTestSink()
+            router = ApiRouter()
+            monitor = TkLagMonitor(root)
+            monitor.start()
+            session_tabs = [HeadlessLoadTab(root, ChatSessionEngine, index + 1, router, sink)
+                            for index in range(self.sessions)]
+            multi_tabs = [HeadlessLoadTab(root, MultiRolePipelineEngine, self.sessions + index + 1, router, sink)
+                          for index in range(self.multi_roles)]
+
+            # 只有Tcl解释器，没有窗口可销毁
+            return root, monitor.stop, monitor, sink, session_tabs, multi_tabs
+
+        app = DeepSeekAPIMultiTabTool(root)
+        sink = LoadTestSink(app.log_writer)
+        app.log_writer = sink  # 之后创建的标签页把日志交给收集器
+        app.api_key.set("sk-load-test")
+        app.base_url.set(self.base_url)
+        session_tabs = []
+        for _ in range(self.sessions):
+            app.create_new_tab(LOAD_TEST_ROLE["name"], LOAD_TEST_ROLE)
+            session_tabs.append(GuiLoadTab(app.tabs[app.current_tab_id]))
+        multi_tabs = []
+        for _ in range(self.multi_roles):
+            app.add_optimized_multi_role_tab()
+            multi_tabs.append(GuiLoadTab(app.tabs[app.current_tab_id]))
+        root.update()
+
+        def cleanup():
+            app.lag_monitor.stop()
+            sink.inner.close()
+            app.session_store.close()
+            root.destroy()
+        return root, cleanup, app.lag_monitor, sink, session_tabs, multi_tabs
+
+    def _run(self):
+        root, cleanup, monitor, sink, session_tabs, multi_tabs = self._open_tabs()
+        all_tabs = session_tabs + multi_tabs
+        settings = ApiSettings("sk-load-test", self.base_url, timeout=60, stream=True)
+        monitor.reset()
+        monitor.lags = deque()  # 记录整个测试期间的延迟（默认只保留最近一分钟）
+
+        # 后台采样线程数和内存
+        samples = []
+        sampling_done = threading.Event()
+
+        def sample():
+            while not sampling_done.wait(0.5):
+                samples.append((threading.active_count(), current_rss()))
+        sampler = threading.Thread(target=sample, name="LoadTestSampler", daemon=True)
+        sampler.start()
+
+        started = time.perf_counter()
+        deadline = started + self.duration
+        drain_deadline = deadline + 15
+        finished = []
+
+        def arrive():
+            if time.perf_counter() >= deadline:
+                return
+            idle = [tab for tab in session_tabs if not tab.is_busy]
+            if idle:
+                self.sent += 1
+                self.rng.choice(idle).send(f"负载测试消息 {self.sent}", LOAD_TEST_ROLE, settings)
+            else:
+                self.skipped += 1
+            root.after(max(1, int(self.rng.expovariate(self.rate) * 1000)), arrive)
 
-    def finish_request(self):
-        """完成请求"""
-        self.is_streaming = False
-        self.send_button.config(state='normal')
-        self.stop_button.config(state='disabled')
-        self.status_var.set("准备就绪")
+        def stop_all():
+            for tab in all_tabs:
+                tab.stop()
+            wait_idle()
 
-    def clear_history(self):
-        """清空对话历史"""
-        if self.is_streaming:
-            messagebox.showwarning("警告", "请先停止当前请求")
-            return
+        def wait_idle():
+            if any(tab.is_busy for tab in all_tabs) and time.perf_counter() < drain_deadline:
+                root.after(100, wait_idle)
+            else:
+                # 再等待队列处理器取完剩余内容
+                root.after(300, finished.append, True)
+
+        if session_tabs and self.rate > 0:
+            root.after(0, arrive)
+        for tab in multi_tabs:
+            tab.start_pipeline(LOAD_TEST_PIPELINE, settings)
+        root.after(int(self.duration * 1000), stop_all)
+        # 只有Tcl解释器时mainloop会立即返回（没有窗口），因此自行处理事件
+        while not finished:
+            root.tk.dooneevent(0)
+        elapsed = time.perf_counter() - started
+
+        sampling_done.set()
+        sampler.join()
+        lags = [lag * 1000 for _, lag in monitor.lags]
+        cleanup()
+        return self.summarize(sink.records, lags, samples, elapsed)
+
+    def summarize(self, records, lags, samples, elapsed):
+        completed = []
+        errors = cancelled = 0
+        for record in records:
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                errors += 1
+            elif response.get("cancelled"):
+                cancelled += 1
+            else:
+                completed.append(response)
 
-        if messagebox.askyesno("确认清空", "确定要清空对话历史吗？"):
-            self.history_text.config(state='normal')
-            self.history_text.delete("1.0", tk.END)
-            self.history_text.config(state='disabled')
+        timings = [response.get("timing") or {} for response in completed]
+        first_tokens = [timing["first_token"] * 1000 for timing in timings if timing.get("first_token") is not None]
+        dropped = None
+        if self.expected_chunks is not None:
+            dropped = sum(max(0, self.expected_chunks - (timing.get("rendered") or 0)) for timing in timings)
+        tokens = sum((response.get("usage") or {}).get("completion_tokens", 0) for response in completed)
+        threads = [count for count, _ in samples]
+        rss = [value for _, value in samples if value is not None]
 
-            self.conversation_history = []
-            self.prompt_tokens = 0
-            self.completion_tokens = 0
-            self.update_token_display()
+        def rounded(value, digits=1):
+            return round(value, digits) if value is not None else None
 
-    def get_conversation_history(self):
-        """获取对话历史"""
-        return self.conversation_history
+        return {
+            "sessions": self.sessions,
+            "multi_roles": self.multi_roles,
+            "mode": "headless" if self.headless else "gui",
+            "elapsed": round(elapsed, 2),
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "completed": len(completed),
+            "cancelled": cancelled,
+            "errors": errors,
+            "completions_per_s": round(len(completed) / elapsed, 2),
+            "tokens_per_s": round(tokens / elapsed, 1),
+            "first_token_p50_ms": rounded(_percentile(first_tokens, 50)),
+            "first_token_p95_ms": rounded(_percentile(first_tokens, 95)),
+            "lag_p50_ms": rounded(_percentile(lags, 50)),
+            "lag_p95_ms": rounded(_percentile(lags, 95)),
+            "lag_p99_ms": rounded(_percentile(lags, 99)),
+            "lag_max_ms": rounded(max(lags) if lags else None),
+            "threads_avg": rounded(sum(threads) / len(threads) if threads else None),
+            "threads_max": max(threads) if threads else None,
+            "rss_max_mb": rounded(max(rss) / 1048576 if rss else None),
+            "dropped_chunks": dropped,
+            "late_chunks": sum(timing.get("render_late") or 0 for timing in timings),
+        }
 
-    def get_token_counts(self):
-        """获取Token计数"""
-        return self.prompt_tokens, self.completion_tokens
 
-    def save_api_log(self, log_entry):
-        """保存API调用日志到文件，按日期目录+JSON格式"""
+# 负载测试报告的列：(结果字段, 表头)
+LOAD_TEST_COLUMNS = (
+    ("sessions", "单角色"), ("multi_roles", "多角色"), ("completed", "完成"), ("errors", "错误"),
+    ("skipped", "忙碌跳过"), ("completions_per_s", "完成/s"), ("tokens_per_s", "token/s"),
+    ("first_token_p50_ms", "首token p50"), ("first_token_p95_ms", "首token p95"),
+    ("lag_p50_ms", "延迟p50"), ("lag_p95_ms", "延迟p95"), ("lag_p99_ms", "延迟p99"), ("lag_max_ms", "延迟max"),
+    ("threads_max", "线程max"), ("rss_max_mb", "内存MB"), ("dropped_chunks", "丢失块"), ("late_chunks", "迟到块"),
+)
+
+
+def format_load_test(results):
+    cells = [[("-" if result[key] is None else str(result[key])) for key, _ in LOAD_TEST_COLUMNS]
+             for result in results]
+    widths = [max([_display_width(title)] + [_display_width(line[i]) for line in cells])
+              for i, (_, title) in enumerate(LOAD_TEST_COLUMNS)]
+
+    def render(values):
+        return "  ".join(" " * (width - _display_width(value)) + value for value, width in zip(values, widths))
+
+    lines = [render([title for _, title in LOAD_TEST_COLUMNS])]
+    lines.extend(render(line) for line in cells)
+    return "\n".join(lines)
+
+
+def run_load_test(args):
+    """命令行负载测试：按--load-test给出的单角色标签页数逐档运行（延迟单位毫秒）"""
+    try:
+        steps = [int(value) for value in args.load_test.split(",") if value.strip()]
+    except ValueError:
+        print("错误: --load-test 应为逗号分隔的标签页数，如 10,50,100", file=sys.stderr)
+        return 2
+
+    mock_process = None
+    expected_chunks = None
+    base_url = args.load_test_endpoint
+    if args.replay_cassette:
+        # 回放磁带时不发出网络请求，接口地址不会被使用
+        base_url = base_url or DEFAULT_BASE_URL
+    elif not base_url:
+        mock_process, base_url = start_mock_process(args.mock_chunks, args.mock_interval, args.mock_latency)
+        expected_chunks = args.mock_chunks
+        print(f"模拟接口: {base_url}（每次回复{args.mock_chunks}块，间隔{args.mock_interval}s）", file=sys.stderr)
+
+    results = []
+    headless = args.load_test_headless
+    try:
+        for sessions in steps:
+            print(f"运行: {sessions} 个单角色标签页，{args.load_test_multi} 个多角色标签页，"
+                  f"{args.load_test_duration}s ...", file=sys.stderr)
+            load_test = LoadTest(base_url, sessions, args.load_test_multi, args.load_test_rate,
+                                 args.load_test_duration, expected_chunks, headless)
+            results.append(load_test.run())
+            headless = load_test.headless  # 没有显示器时后续各档不再尝试创建窗口
+    except KeyboardInterrupt:
+        print("已中断", file=sys.stderr)
+    finally:
+        if mock_process is not None:
+            mock_process.terminate()
+
+    if results:
+        print(format_load_test(results))
+    if args.load_test_report:
         try:
-            # 获取当前日期时间，用于创建子目录，保存每一次协同对话内容
-            current_date, time_tag = datetime.now().strftime("%Y-%m-%d %H-%M-%S").split(" ")
-
-            # 创建日期子目录
-            date_log_dir = os.path.join(self.log_dir, current_date)
-            if not os.path.exists(date_log_dir):
-                os.makedirs(date_log_dir)
-
-            # 构建文件名：{角色名}{编号}_iter{循环次数}.json
-            # 会话模式下，循环次数固定为0
-            role_name = log_entry['role_name']
-            tab_id = self.tab_id
-            iteration = 0  # 会话模式下没有迭代次数
-
-            # 生成文件名
-            log_filename = f"{time_tag}_{role_name}{tab_id}_iter{iteration}.json"
-            log_path = os.path.join(date_log_dir, log_filename)
-
-            # 准备JSON格式的日志数据
-            json_log = {
-                "timestamp": log_entry['timestamp'],
-                "role_name": log_entry['role_name'],
-                "tab_id": self.tab_id,
-                "iteration": iteration,
-                "request": log_entry['request'],
-                "response": log_entry.get('response', {})
-            }
-
-            # 写入JSON文件
-            with open(log_path, 'w', encoding='utf-8') as f:
-                json.dump(json_log, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存API日志失败: {e}")
-
-
-def main():
+            atomic_write_text(args.load_test_report, json.dumps(results, ensure_ascii=False, indent=2))
+        except OSError as e:
+            print(f"错误: 写入报告失败: {e}", file=sys.stderr)
+            return 1
+    return 0 if results else 130
+
+
+def run_mock_server(args):
+    """在前台运行模拟接口，直到按Ctrl+C"""
+    server = MockChatServer(port=args.mock_server, chunks=args.mock_chunks, interval=args.mock_interval,
+                            latency=args.mock_latency).start()
+    print(f"模拟接口已启动: {server.base_url}（Ctrl+C 停止）", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+def main(argv=None):
     """主程序入口"""
+    args = build_arg_parser().parse_args(argv)
+
+    # 启动即开始的诊断（尽早开始以覆盖启动过程）
+    diagnostics = Diagnostics(args.diagnostics_dir)
+    if args.tracemalloc:
+        diagnostics.start_tracemalloc()
+    if args.profile:
+        diagnostics.start_profile()
+
+    # 磁带录制/回放：所有API请求经由它发送
+    try:
+        if args.record_cassette:
+            ApiRoute.transport = CassetteRecorder(args.record_cassette)
+        elif args.replay_cassette:
+            ApiRoute.transport = CassettePlayer(args.replay_cassette, args.cassette_time_scale)
+            MultiRolePipelineEngine.TURN_PAUSE *= args.cassette_time_scale
+    except (OSError, ValueError) as e:
+        print(f"错误: 打开磁带失败: {e}", file=sys.stderr)
+        return 2
+
+    def close_cassette():
+        if ApiRoute.transport is not None:
+            ApiRoute.transport.close()
+            print(ApiRoute.transport.summary(), file=sys.stderr)
+            ApiRoute.transport = None
+
+    if (args.analyze_logs or args.role or args.pipeline or args.benchmark or args.load_test
+            or args.mock_server is not None or args.bulk or args.proxy is not None):
+        try:
+            if args.proxy is not None:
+                return run_proxy_server(args)
+            if args.bulk:
+                return run_bulk_cli(args)
+            if args.benchmark:
+                return run_benchmarks(args)
+            if args.load_test:
+                return run_load_test(args)
+            if args.mock_server is not None:
+                return run_mock_server(args)
+            return run_log_analytics(args) if args.analyze_logs else run_cli_chat(args)
+        finally:
+            close_cassette()
+            for path in diagnostics.finish():
+                print(f"诊断结果已保存: {path}", file=sys.stderr)
+
     root = tk.Tk()
-    app = DeepSeekAPIMultiTabTool(root)
+    app = DeepSeekAPIMultiTabTool(root, diagnostics)
+    diagnostics.enable_signal_dump()
+    if args.profile and args.profile_seconds:
+        root.after(int(args.profile_seconds * 1000), app.stop_profiling)
 
     # 设置窗口最小大小
     root.minsize(1400, 800)
@@ -2353,6 +9646,28 @@ def main():
             app.save_all_roles()
         except Exception as e:
             print(f"保存配置时出错: {e}")
+        # 保存工作区，压缩各标签页会话日志
+        try:
+            app.save_workspace_layout()
+            app.session_store.close()
+        except Exception as e:
+            print(f"保存工作区时出错: {e}")
+        # 写出仍在进行的诊断
+        try:
+            for path in app.diagnostics.finish():
+                print(f"诊断结果已保存: {path}")
+        except Exception as e:
+            print(f"保存诊断结果时出错: {e}")
+        try:
+            close_cassette()
+        except Exception as e:
+            print(f"关闭磁带时出错: {e}")
+        # 写完队列中的API日志
+        try:
+            app.lag_monitor.stop()
+            app.log_writer.close()
+        except Exception as e:
+            print(f"关闭API日志时出错: {e}")
         root.destroy()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
@@ -2360,4 +9675,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())